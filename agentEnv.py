@@ -1,5 +1,7 @@
-from ctrnn import CTRNN
+from ctrnn import CTRNN, BatchCTRNN
 import math 
+import instrument
+from trajectory import TrajectoryRecorder, maxSteps, ov_labels
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -10,12 +12,14 @@ class AgentEnv():
     this class does not record trajectory data. This is because trajectories are fully deterministic 
     given a set of starting states; therefore recording this data is unnecessary and cumbersome."""
 
-    def __init__(self, genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt):
+    def __init__(self, genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, inputWeights='last'):
 
         #CONTROLLER ATTRIBUTES
         self.Dt = Dt    # Integration step of task, CTRNN (sec)
         self.NN = CTRNN(Size)   # Number of interneurons plus output neurons
-        self.NN.setParameters(genotype,WeightRange,BiasRange,TimeConstMin,TimeConstMax,InputWeightRange)
+        self.Ranges = (WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange)
+        self.inputWeights = inputWeights    # How input weights are decoded, 'last' (as evolved in Data/) or 'each' (see GenotypeLayout)
+        self.NN.setParameters(genotype,WeightRange,BiasRange,TimeConstMin,TimeConstMax,InputWeightRange,inputWeights)
         
         #AGENT ATTRIBUTES
         self.Brake_constant = 3.    # Scale factor for motor neuron output --> brake force
@@ -38,6 +42,13 @@ class AgentEnv():
                              1.]        # (4) Proportional rate (PR)
         
         
+    def setGenotype(self, genotype):
+        """Re-parameterizes the controller with a new genotype, in place, so that the agent can be 
+        reused instead of building a new one."""
+        self.NN.setParameters(genotype, *self.Ranges, self.inputWeights)
+        self.Brake_effectiveness = 1.
+
+
     def setInitialState(self, velocity, distance, target_size): 
         """Simulates a few moments of constant motion to initialize the optical variables. This is 
         required because the image expansion rate, tau-dot, and proportional rate are all based on 
@@ -87,48 +98,245 @@ class AgentEnv():
         """This method runs one simulation given some starting conditions and plots many different 
         variables (both physical and optical) against time. trial_length is the maximum trial length
         in seconds."""
-        Acceleration_history = []
-        Velocity_history = []
-        Distance_history = []
-        Optical_history = []
+        recorder = TrajectoryRecorder(self.NN.Size, maxSteps(trial_length, self.Dt))    # See trajectory.py
         #Generate data
         self.setInitialState(velocity, distance, target_size)
         self.Optical_variable = optical_variable
         self.Time = 0
-        i = 0 
         # While distance is still positive, agent is still moving forward significantly, and not too much time has elapsed
         while (self.Distance > 0) and (self.Velocity > 0.005) and (self.Time < trial_length):
             self.sense()
             self.think()
             self.act()
-            Acceleration_history.append(self.Acceleration)
-            Velocity_history.append(self.Velocity)
-            Distance_history.append(self.Distance)
-            Optical_history.append(self.Optical_info)
+            recorder.record(self)
+        trajectory = recorder.trajectory()
+        time = trajectory['time']    # Time at the end of each step, so always the same length as the data
             
         #Plot physics data    
-        time = np.arange(0, self.Time, self.Dt)
-        data = [Acceleration_history, Velocity_history, Distance_history]
+        fields = ['acceleration', 'velocity', 'distance']
         labels = ['Acceleration (m/sec^2)]', 'Velocity (m/sec)', 'Distance (m)']
-        for i in range(len(data)):    # This is necessary because of an inconsistent error I was getting
-            try: 
-                plt.plot(time, data[i])
-            except ValueError:    # If the time vector is the wrong size, shorten it slightly and try again
-                time = np.arange(0, self.Time-self.Dt, self.Dt)
-                plt.plot(time, data[i])
-                
+        for i in range(len(fields)):
+            plt.plot(time, trajectory[fields[i]])
             plt.xlabel('Time (sec)')
             plt.ylabel(labels[i])
             plt.show()
 
         # Plot optical data
-        ov_labels = ['Image size', 'Image expansion rate', 'Tau', 'Tau-dot', 'Proportional Rate']
-        Optical_history = np.array(Optical_history)
-        for i in range(len(self.Optical_info)):
-            plt.plot(time, Optical_history[:,i])
+        for i in range(len(ov_labels)):
+            plt.plot(time, trajectory['optical'][:,i])
             plt.xlabel('Time (sec)')
             plt.ylabel(ov_labels[i])
             plt.show()
         
-        return Acceleration_history, Velocity_history, Distance_history, Optical_history
-    
\ No newline at end of file
+        return trajectory['acceleration'], trajectory['velocity'], trajectory['distance'], trajectory['optical']
+
+
+
+def optics(target_size, distance, optical_info):
+    """Returns the optical variables (rows as in AgentEnv.Optical_info) of trials with the given target 
+    sizes and distances, given their optical variables from the step before. Shared by 
+    BatchAgentEnv.sense() and initialStates()."""
+    with np.errstate(divide='ignore', invalid='ignore'):    # Frozen trials may divide by zero; they are masked out by the caller
+        image_size = np.arctan(target_size/distance)
+        image_expansion_rate = image_size - optical_info[0]     # Difference between image_size and the last image_size (i=0)
+        tau = image_size / image_expansion_rate
+        tau_dot = tau - optical_info[2]
+        PR = tau/tau_dot
+    return np.array([image_size, image_expansion_rate, tau, tau_dot, PR])
+
+
+initialTables = {}    # Cache of initialStates() tables, keyed by the trial grid and Dt
+maxTables = 64
+
+
+def initialStates(velocity, distance, target_size, Dt):
+    """Returns a table of the state of every trial right after the warm-up in setInitialState(): a 
+    dictionary of read-only arrays (Velocity, Distance, Target_size, and Optical_info, with one column 
+    per trial). The warm-up only depends on the trial grid, not on the genotype, so each grid is only 
+    ever warmed up once per process and the table is then reused by every agent. Worker processes 
+    forked after a table is built share its memory with the parent."""
+    velocity = np.asarray(velocity, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    target_size = np.asarray(target_size, dtype=float)
+    key = (velocity.tobytes(), distance.tobytes(), target_size.tobytes(), Dt)
+    if key not in initialTables:
+        steps = 3   # 3 steps is all that is required for the values of the optical information to stabilize
+        D = distance + (steps*Dt*velocity)    # Set back initial distance some amount to allow for initial constant motion
+        optical_info = np.ones((5, len(velocity)))   # After 3 steps nothing is left of these starting values
+        for step in range(steps):
+            optical_info = optics(target_size, D, optical_info)    # Calculate optical variables
+            D = D - velocity * Dt    # Move
+        table = {'Velocity': velocity.copy(), 'Distance': D, 'Target_size': target_size.copy(), 'Optical_info': optical_info}
+        for array in table.values():
+            array.flags.writeable = False
+        if len(initialTables) >= maxTables:
+            initialTables.clear()
+        initialTables[key] = table
+    return initialTables[key]
+
+
+class BatchAgentEnv():
+    """Vectorized version of AgentEnv that runs many trials of one genotype in lockstep. Every 
+    attribute that is a scalar in AgentEnv (distance, velocity, acceleration, motor output, time, 
+    and each of the optical variables) is an array here with one entry per trial, and the 
+    controller is a BatchCTRNN with one network per trial. The Running mask records which trials 
+    still meet the stop condition used everywhere else (Distance > 0, Velocity > 0.005, Time < 
+    trial_length); trials that fail it are frozen in place while the rest keep going. Since the 
+    fitness functions only need the final state of each trial and its total jerk, the squared jerk 
+    is summed as the trials run instead of keeping a list of accelerations.
+
+    dtype sets the precision of the state of the agents, the environment, and the controllers: 
+    float64 like AgentEnv, or float32 to halve the memory traffic of each step (see precision.py for 
+    what it costs in accuracy). Time stays float64 either way, so that a trial lasts the same number 
+    of steps in both."""
+
+    def __init__(self, genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials, dtype=float, inputWeights='last'):
+
+        #CONTROLLER ATTRIBUTES
+        self.Dt = Dt    # Integration step of task, CTRNN (sec)
+        self.ntrials = ntrials   # Number of trials run in lockstep
+        self.dtype = np.dtype(dtype)    # Precision of the state (see above)
+        self.NN = BatchCTRNN(ntrials, Size, dtype)   # One network per trial, all with the same genotype
+        self.Ranges = (WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange)
+        self.inputWeights = inputWeights    # How input weights are decoded, 'last' (as evolved in Data/) or 'each' (see GenotypeLayout)
+        self.NN.setParameters(genotype,WeightRange,BiasRange,TimeConstMin,TimeConstMax,InputWeightRange,inputWeights)
+
+        #AGENT ATTRIBUTES
+        self.Brake_constant = 3.    # Scale factor for motor neuron output --> brake force
+        self.Brake_effectiveness = 1.    # This is a scale factor that can be perturbed (scalar or one value per trial)
+        self.output = np.zeros(ntrials, dtype)     # Activation of motor neuron
+        self.Acceleration = np.zeros(ntrials, dtype)   # Brake force that agent is applying (m*m/sec)
+        self.Velocity = np.zeros(ntrials, dtype)    # Agent's velocity in the direction of the target (m/sec)
+
+        #ENVIRONMENT ATTRIBUTES
+        self.Target_size = np.zeros(ntrials, dtype)    # Size of target (m)
+        self.Distance = np.zeros(ntrials, dtype)   # Distance from agent to target (m)
+        self.Time = np.zeros(ntrials)
+
+        # OPTICAL ATTRIBUTES
+        self.Optical_variable = 5   # Which optical variable is this agent paying attention to? (0-4)
+        self.Optical_info = np.ones((5, ntrials), dtype)   # Same rows as AgentEnv.Optical_info, one column per trial
+
+        # TRIAL BOOKKEEPING
+        self.Running = np.zeros(ntrials, dtype=bool)   # Which trials have not yet hit the stop condition
+        self.Steps = np.zeros(ntrials, dtype=int)    # Number of sense/think/act steps taken in each trial
+        self.Jerk = np.zeros(ntrials, dtype)    # Running sum of squared changes in acceleration (see SquaredJerk in simulation.py)
+
+
+    def setGenotype(self, genotype):
+        """Same as AgentEnv.setGenotype(): every network of the stack gets the new genotype, in place."""
+        self.NN.setParameters(genotype, *self.Ranges, self.inputWeights)
+        self.Brake_effectiveness = 1.
+
+
+    def setInitialState(self, velocity, distance, target_size):
+        """Same as AgentEnv.setInitialState(), but velocity, distance, and target_size are arrays with 
+        one entry per trial. After this, every trial is marked as running. The warm-up is looked up in 
+        a table of precomputed states rather than simulated (see initialStates())."""
+        table = initialStates(velocity, distance, target_size, self.Dt)    # Always warmed up in float64
+        self.Velocity = table['Velocity'].astype(self.dtype)
+        self.Distance = table['Distance'].astype(self.dtype)
+        self.Target_size = table['Target_size'].astype(self.dtype)
+        self.Optical_info = table['Optical_info'].astype(self.dtype)
+        self.Acceleration = np.zeros(self.ntrials, self.dtype)
+        self.output = np.zeros(self.ntrials, self.dtype)
+        self.Time = np.zeros(self.ntrials)
+        self.Running = np.ones(self.ntrials, dtype=bool)
+        self.Steps = np.zeros(self.ntrials, dtype=int)
+        self.Jerk = np.zeros(self.ntrials, self.dtype)
+        self.NN.initializeState(np.zeros(self.NN.Size))
+
+
+    def sense(self):
+        """Update optical variables of running trials."""
+        self.Optical_info = np.where(self.Running, optics(self.Target_size, self.Distance, self.Optical_info), self.Optical_info)
+
+
+    def think(self):
+        """Integrate CTRNN controllers and read outputs."""
+        self.NN.Input = np.repeat(self.Optical_info[self.Optical_variable][:,None], self.NN.Size, axis=1)
+        self.NN.step(self.Dt)
+        motor_neuron = 0  # Pick which neuron is the motor neuron (this is arbitrary, really)
+        self.output = np.where(self.Running, self.NN.Output[:,motor_neuron], self.output)
+
+
+    def act(self):
+        """Calculate action and update the agent and environment of running trials."""
+        acceleration = (-1) * self.output * self.Brake_constant * self.Brake_effectiveness      # Note the (-1) inversion
+        self.Jerk = np.where(self.Running & (self.Steps > 0), self.Jerk + (acceleration - self.Acceleration)**2, self.Jerk)
+        self.Acceleration = np.where(self.Running, acceleration, self.Acceleration)
+        self.Velocity = np.where(self.Running, self.Velocity + self.Acceleration * self.Dt, self.Velocity)
+        self.Distance = np.where(self.Running, self.Distance - self.Velocity * self.Dt, self.Distance)
+        self.Time = np.where(self.Running, self.Time + self.Dt, self.Time)
+        self.Steps += self.Running
+
+
+    def run(self, trial_length, reducers=()):
+        """Step every trial until all of them have hit the stop condition, the same one used by 
+        the fitness functions: distance is still positive, agent is still moving forward 
+        significantly, and not too much time has elapsed. Streaming reducers (see simulation.py) 
+        are updated after every step."""
+        self.Running &= (self.Distance > 0) & (self.Velocity > 0.005) & (self.Time < trial_length)
+        while self.Running.any():
+            took = self.Running.copy() if reducers else None
+            self.step(trial_length)
+            for reducer in reducers:
+                reducer.update(self, took)
+        if instrument.enabled:
+            instrument.count('trials', self.ntrials)
+            instrument.count('steps', int(np.sum(self.Steps)))
+            for outcome, n in self.outcomes(trial_length).items():
+                instrument.count('outcome: %s' % outcome, n)
+
+
+    def outcomes(self, trial_length):
+        """Returns how many trials ended in each way, using the same categories as 
+        analyzedData.trialAnalysis(): stopped too far from the target (early stop), crashed into it, 
+        ran out of time, or stopped close to it."""
+        return {outcome: int(np.sum(mask)) for outcome, mask in self.outcomeMasks(trial_length).items()}
+
+
+    def outcomeMasks(self, trial_length):
+        """Same as outcomes(), but returns a mask of the trials in each category instead of a count. 
+        Note that trialAnalysis() used to test Time > trial_length+Dt for timeouts, which is never true, 
+        so analyses from before this counted every timeout as a stop (see readme.txt)."""
+        early_stops = (self.Distance > 15)
+        crashes = ~early_stops & (self.Distance < 0)
+        timeouts = ~early_stops & ~crashes & (self.Time >= trial_length)
+        stops = ~early_stops & ~crashes & ~timeouts
+        return {'early stop': early_stops, 'crash': crashes, 'timeout': timeouts, 'stop': stops}
+
+
+    def step(self, trial_length):
+        """Takes one sense/think/act step and updates which trials are still running."""
+        t = instrument.start()
+        self.sense()
+        t = instrument.lap('sense', t)
+        self.think()
+        t = instrument.lap('think', t)
+        self.act()
+        instrument.lap('act', t)
+        self.Running &= (self.Distance > 0) & (self.Velocity > 0.005) & (self.Time < trial_length)
+
+
+class AgentPool():
+    """Keeps agents around between evaluations. agent() hands back an existing BatchAgentEnv with the 
+    same parameters, number of trials, dtype, and input weight decoding, re-parameterized in place with the new genotype (see 
+    setGenotype()), and only builds one when there is none yet. Up to maxAgents agents are kept."""
+
+    def __init__(self, maxAgents=16):
+        self.maxAgents = maxAgents
+        self.agents = {}
+
+
+    def agent(self, genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials, dtype=float, inputWeights='last'):
+        key = (Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials, np.dtype(dtype), inputWeights)
+        if key in self.agents:
+            agent = self.agents[key]
+            agent.setGenotype(genotype)
+            return agent
+        if len(self.agents) >= self.maxAgents:
+            del self.agents[next(iter(self.agents))]    # Drop the oldest
+        agent = BatchAgentEnv(genotype, *key)
+        self.agents[key] = agent
+        return agent
@@ -1,14 +1,26 @@
-from agentEnv import AgentEnv
-from tools import save, read
+from agentEnv import BatchAgentEnv
+from tools import save
+from runIndex import loadRun
+from trajectory import TrajectoryRecorder, maxSteps, ov_labels
+from trajectoryStore import TrajectoryStore, writeStore
+from perturbation import PerturbedAgentEnv, conditionGrid, parallelSweep, printTable, vectorSchedule
+import simulation
+from simulation import simulate, outcomeCounts, distanceVelocityJerk, FinalDistance, FinalVelocity, SquaredJerk, Outcome, Trajectory
 from matplotlib import pyplot as plt
 import numpy as np
 
 
-def jerk(accelerations):   # Sub-function used for calculating total jerk in a series of accelerations
-    jerk = 0
-    for i in range(1, len(accelerations)):
-        jerk += (accelerations[i] - accelerations[i-1])**2
-    return jerk
+def trialGrid():   # Sub-function that lays out the trial grid as arrays, in the same order as the nested loops used before
+    return simulation.trialGrid(target_size, initial_distance, initial_velocity)
+
+
+def trialIndex(traj_params):   # Sub-function that finds the trial (v, d, ts) in the trial grid
+    velocities, distances, sizes = trialGrid()
+    v, d, ts = traj_params
+    matches = np.flatnonzero((velocities == v) & (distances == d) & (sizes == ts))
+    if len(matches) == 0:
+        raise ValueError('No trial with (v, d, ts) = %s in the trial grid' % (traj_params,))
+    return matches[0]
 
 
 # ==============================    ANALYSIS DATA CLASS    =========================================
@@ -16,21 +28,60 @@ def jerk(accelerations):   # Sub-function used for calculating total jerk in a s
 
 class analyzedData():
 
-    def __init__(self, filename):
+    def __init__(self, filename, fitnessFunction=None):
+        """filename can be a pickled Microbial object or a checkpoint (.npz, see Microbial.checkpoint). 
+        Checkpoints do not hold the fitness function, so pass it in as fitnessFunction if popAnalysis() 
+        will need it."""
         self.filename = filename
-        self.data = read(filename)
-        self.Optical_variable = int(filename[len(self.data.fitnessFunction.__name__)+2])
-        
+        self.data, self.Optical_variable = loadRun(filename, fitnessFunction)    # See runIndex.py
+
 
 
     def save(self):
         save(('%s_Analyzed' % self.filename), self)
 
 
-    def popAnalysis(self):
-        fits = np.zeros(self.data.popsize)
-        for i in range(self.data.popsize):
-            fits[i] = self.data.fitnessFunction(self.data.pop[i])
+    def taskParams(self):
+        """Returns the task and CTRNN parameters of this analysis, with the same names as taskParams() in run.py."""
+        return {'Dt': Dt, 'target_size': target_size, 'initial_distance': initial_distance, 'initial_velocity': initial_velocity,
+                'trial_length': trial_length, 'optical_variable': self.Optical_variable, 'ntrials': ntrials, 'Size': Size,
+                'WeightRange': WeightRange, 'BiasRange': BiasRange, 'TimeConstMin': TimeConstMin, 'TimeConstMax': TimeConstMax,
+                'InputWeightRange': InputWeightRange}
+
+
+    def storeTrajectories(self, filename=None):
+        """Simulates every trial of every genotype in the population once and writes the trajectories to
+        a store (see trajectoryStore.py), named after the data file unless filename is given. After
+        this, trajectory() reads trials from the store instead of simulating them."""
+        if filename is None:
+            filename = '%s_Trajectories' % self.filename
+        writeStore(filename, self.data.pop, self.taskParams())
+        self.store = TrajectoryStore(filename)
+
+
+    def openStore(self, filename=None):
+        """Opens a store written earlier by storeTrajectories()."""
+        if filename is None:
+            filename = '%s_Trajectories' % self.filename
+        self.store = TrajectoryStore(filename)
+
+
+    def trajectory(self, genotype, traj_params):
+        """Returns the trajectory of one trial of genotype number genotype in the population, read lazily
+        from the store. traj_params is a tuple of (initial velocity, initial distance, target size)."""
+        v, d, ts = traj_params
+        return self.store.trial(genotype, ts, d, v)
+
+
+    def popAnalysis(self, evaluator=None):
+        """Evaluates every genotype in the population. evaluator can be an evaluation.PoolEvaluator, to
+        spread the evaluations across several processes."""
+        if evaluator is not None:
+            fits = evaluator.map(self.data.pop)
+        else:
+            fits = np.zeros(self.data.popsize)
+            for i in range(self.data.popsize):
+                fits[i] = self.data.fitnessFunction(self.data.pop[i])
         self.bestIndividual = self.data.pop[fits.argmax()]
         self.top25FitnessMean = np.average(np.sort(fits)[self.data.popsize-25:])
         self.bestFitness = np.sort(fits)[-1]
@@ -43,78 +94,27 @@ class analyzedData():
         # Step 1: Get genotype of best individual
         genotype = self.bestIndividual
 
-        # Step 2: Run simulation
-        final_distances = np.empty(ntrials)
-        final_velocities = np.empty(ntrials)
-        jerks = np.empty(ntrials)
-        trials = 0
-        successes = 0
-        crashes = 0
-        early_stops = 0
-        timeouts = 0
-        agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-        for ts in target_size:
-            for d in initial_distance:
-                for v in initial_velocity:
-                    agent.setInitialState(v, d, ts)
-                    agent.Optical_variable = self.Optical_variable
-                    acceleration = []
-                    distance = []
-                    velocity = []
-                    optical = []
-                    # Simulation loop
-                    i = 0
-                    while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                        agent.sense()
-                        agent.think()
-                        agent.act()
-                        i += 1
-                        acceleration.append(agent.Acceleration)    # Record data
-                        distance.append(agent.Distance)
-                        velocity.append(agent.Velocity)
-                        optical.append(agent.Optical_info[agent.Optical_variable])
-
-                    if show == True and (v, d, ts) == traj_params: # If this is the trial we want to visualize, record data for plotting
-                        series = [distance, velocity, acceleration, optical]
-                        time = agent.Time
-
-                    if agent.Velocity < 0:   # If agent finishes moving backwards, reset velocity to starting velocity
-                        agent.Velocity = v
-                        
-                    if agent.Distance > 15:  # If agent stopped prematurely
-                        early_stops += 1
-
-                    elif agent.Distance < 0:   # If agent crashed, reset distance to starting position
-                        agent.Distance = d
-                        crashes += 1
-                        
-                    elif agent.Time > trial_length+Dt:  # If agent never stops/times out
-                        timeouts += 1
-                    else:
-                        successes += 1
-                    final_distances[trials] = agent.Distance/d   # Record performance data for fitness function
-                    final_velocities[trials] = agent.Velocity/v
-                    jerks[trials] = jerk(acceleration)
-                    trials += 1
+        # Step 2: Run simulation (every trial at once, see simulation.py)
+        agent = BatchAgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials)
+        results = self.simulate(agent, [Outcome(trial_length)], show)
+        counts = outcomeCounts(results['outcome'])
 
         # Plot data
         if show == True:
-            for i in range(len(series)):    # This is necessary because of an inconsistent error I was getting
-                time = np.arange(0, trial_length, agent.Dt)
-                l = len(series[i])
-                time = time[:l]
-                plt.plot(time, series[i])
-                ov_labels = ['Image size', 'Image expansion rate', 'Tau', 'Tau-dot', 'Proportional Rate']
-                labels = ['Distance (m)', 'Velocity (m/sec)', 'Acceleration (m/sec^2)]', ov_labels[agent.Optical_variable] ]
+            series = results['trajectory'].trajectory(trialIndex(traj_params))
+            data = [series['distance'], series['velocity'], series['acceleration'], series['optical'][:,self.Optical_variable]]
+            for i in range(len(data)):
+                plt.plot(series['time'], data[i])
+                labels = ['Distance (m)', 'Velocity (m/sec)', 'Acceleration (m/sec^2)]', ov_labels[self.Optical_variable] ]
                 plt.xlabel('Time (sec)')
                 plt.ylabel(labels[i])
-                plt.title('%s-Guided Agent' % (ov_labels[agent.Optical_variable]))
+                plt.title('%s-Guided Agent' % (ov_labels[self.Optical_variable]))
                 plt.show()
 
-        self.successes = successes
-        self.crashes = crashes
-        self.earlyStops = early_stops
-        self.timeouts = timeouts
+        self.successes = counts['stop']
+        self.crashes = counts['crash']
+        self.earlyStops = counts['early stop']
+        self.timeouts = counts['timeout']
 
 
 
@@ -129,107 +129,63 @@ class analyzedData():
         # Step 1: Get genotype of best individual
         genotype = self.bestIndividual
     
-        # Step 2: Run simulation
-        final_distances = np.empty(ntrials)
-        final_velocities = np.empty(ntrials)
-        jerks = np.empty(ntrials)
-        trials = 0
-        crashes = 0
-        early_stops = 0
-        timeouts = 0
-        agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-        for ts in target_size:
-            for d in initial_distance:
-                for v in initial_velocity:
-                    agent.setInitialState(v, d, ts)
-                    agent.Optical_variable = self.Optical_variable
-                    acceleration = []
-                    distance = []
-                    velocity = []
-                    optical = []
-                    if ptype == 'Delay':
-                        outputs = []
-                        for o in range(perturbations):
-                            outputs.append(0)
-    
-                    # Simulation loop
-                    i = 0
-                    while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                        agent.sense()
-                        agent.think()
-                        if ptype == 'Delay':
-                            outputs.append(agent.output)   # Take self.output and append it to end of the list
-                            agent.output = outputs.pop(0)  # Remove first element from list and set it to self.output
-    
-                        agent.act()
-                        if ptype == 'Position':
-                            agent.Distance += perturbations[i]
-                        if ptype == 'Velocity':
-                            agent.Velocity += perturbations[i]
-                        if ptype == 'Mapping':
-                            agent.brake_effectiveness = perturbations[i]
-    
-                        i += 1
-                        acceleration.append(agent.Acceleration)    # Record data
-                        distance.append(agent.Distance)
-                        velocity.append(agent.Velocity)
-                        optical.append(agent.Optical_info[agent.Optical_variable])
-    
-                    if show == True and (v, d, ts) == traj_params:  # If this is the trial we want to visualize, record data for plotting
-                        series = [distance, velocity, acceleration, optical]
-                        time = agent.Time
-    
-                    if agent.Distance < 0:   # If agent crashed, reset distance to starting position
-                        agent.Distance = d
-                        crashes += 1
-    
-                    if agent.Distance > 15:  # If agent stopped prematurely
-                        early_stops += 1
-    
-                    if agent.Time > trial_length:  # If agent never stops/times out
-                        timeouts += 1
-    
-                    if agent.Velocity < 0:   # If agent finishes moving backwards, reset velocity to starting velocity
-                        agent.Velocity = v
-    
-    
-                    final_distances[trials] = agent.Distance/d   # Record performance data for fitness function
-                    final_velocities[trials] = agent.Velocity/v
-                    jerks[trials] = jerk(acceleration)
-                    trials += 1
+        # Step 2: Run simulation (every trial at once, see perturbation.py and simulation.py)
+        agent = PerturbedAgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials)
+        agent.setPerturbations(vectorSchedule(ptype, perturbations, maxSteps(trial_length, Dt)), np.zeros(ntrials, dtype=int))
+        results = self.simulate(agent, [FinalDistance(), FinalVelocity(), SquaredJerk(), Outcome(trial_length)], show)
+        counts = outcomeCounts(results['outcome'])
     
         # Plot data
-        fitness= ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - 1000*np.average(jerks)
+        fitness = distanceVelocityJerk(results, 1000)
         if show == True:
-            for i in range(len(series)):    # This is necessary because of an inconsistent error I was getting
-                time = np.arange(0, trial_length, agent.Dt)
-                l = len(series[i])
-                time = time[:l]
-                plt.plot(time, series[i])
-                ov_labels = ['Image size', 'Image expansion rate', 'Tau', 'Tau-dot', 'Proportional Rate']
-                labels = ['Distance (m)', 'Velocity (m/sec)', 'Acceleration (m/sec^2)]', ov_labels[agent.Optical_variable] ]
+            series = results['trajectory'].trajectory(trialIndex(traj_params))
+            data = [series['distance'], series['velocity'], series['acceleration'], series['optical'][:,self.Optical_variable]]
+            for i in range(len(data)):
+                plt.plot(series['time'], data[i])
+                labels = ['Distance (m)', 'Velocity (m/sec)', 'Acceleration (m/sec^2)]', ov_labels[self.Optical_variable] ]
                 plt.xlabel('Time (sec)')
                 plt.ylabel(labels[i])
-                plt.title('%s Perturbation (%s agent)' % (ptype, ov_labels[agent.Optical_variable]))
+                plt.title('%s Perturbation (%s agent)' % (ptype, ov_labels[self.Optical_variable]))
                 plt.show()
             print('Original Fitness: %f' % self.bestFitness)
             print('Perturbed Fitness: %f' % fitness)
     
-        successes = trials - crashes - early_stops - timeouts
+        stats = fitness, counts['stop'], counts['crash'], counts['early stop'], counts['timeout']
         if ptype=='Delay':
-            self.delayPerturbStats = fitness, successes, crashes, early_stops, timeouts
+            self.delayPerturbStats = stats
             self.delayPerturbation = perturbations
         elif ptype=='Position':
-            self.positionPerturbStats = fitness, successes, crashes, early_stops, timeouts
+            self.positionPerturbStats = stats
             self.positionPerturbation = perturbations
         elif ptype=='Velocity':
-            self.velocityPerturbStats = fitness, successes, crashes, early_stops, timeouts
+            self.velocityPerturbStats = stats
             self.velocityPerturbation = perturbations
         elif ptype=='Mapping':
-            self.mappingPerturbStats = fitness, successes, crashes, early_stops, timeouts
+            self.mappingPerturbStats = stats
             self.mappingPerturbation = perturbations
-        else:
-            print('Ptype argument not recognized!')
+
+
+    def simulate(self, agent, reducers, record=False):
+        """Runs every trial of the grid on agent and returns the results of reducers (see simulation.py).
+        If record is True, every trajectory is recorded too, under 'trajectory'."""
+        if record == True:
+            reducers = reducers + [Trajectory(TrajectoryRecorder(Size, maxSteps(trial_length, Dt), ntrials))]
+        velocities, distances, sizes = trialGrid()
+        return simulate(agent, velocities, distances, sizes, self.Optical_variable, trial_length, reducers)
+
+
+    def perturbationSweep(self, magnitudes, onsets=(0.,), durations=(None,), jweight=1000, workers=1, show=True):
+        """Runs the best individual under every combination of perturbation kind, magnitude, onset, and
+        duration (see conditionGrid() in perturbation.py), e.g. magnitudes={'Delay': [1, 2, 4], 'Mapping':
+        [0.5, 1.5]}. All conditions run as one batch, or across workers processes. Returns the results
+        table, with one row per condition, and keeps it as self.perturbationSweepResults."""
+        conditions = conditionGrid(magnitudes, onsets, durations)
+        table = parallelSweep(self.bestIndividual, conditions, self.taskParams(), jweight, workers)
+        if show == True:
+            print('Original Fitness: %f' % self.bestFitness)
+            printTable(table)
+        self.perturbationSweepResults = table
+        return table
 
 
 #============================================    PARAMETERS     ====================================
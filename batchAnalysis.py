@@ -0,0 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tools import saveCheckpoint, readCheckpoint
+from perturbation import conditionGrid, sweep, resultsDtype
+from runIndex import runFiles, loadRun
+from racing import jweights
+import run_carbonate
+import simulation
+import numpy as np
+import hashlib
+import json
+import sys
+import os
+
+"""This file analyzes every saved run in a directory (e.g. Data/) at once, spreading the runs across
+worker processes. For each run it evaluates every genotype in the final population, counts how each
+genotype's trials ended, and runs a perturbation sweep (see perturbation.py) on the best one. The
+results of each run are cached on disk under a hash of the run file's contents and of the analysis
+settings, so analyzing the directory again after one new run has been added only analyzes that run,
+and a run file that has been overwritten is analyzed again. Cache entries use the checkpoint format
+of tools.py (arrays plus JSON metadata)."""
+
+
+CACHE_VERSION = 1    # Bump whenever what analyzeRun() computes changes, so that old cache entries are not used
+defaultMagnitudes = {'Delay': [1, 2, 4], 'Mapping': [0.5, 0.75, 1.25, 1.5], 'Position': [-10, 10], 'Velocity': [-3, 3]}
+
+
+def cacheKey(filename, settings):
+    """Returns a hash of the contents of filename and of the analysis settings."""
+    digest = hashlib.sha256()
+    file_object = open(filename, 'rb')
+    for block in iter(lambda: file_object.read(1 << 20), b''):
+        digest.update(block)
+    file_object.close()
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def evaluate(genotype, fitnessName, optical_variable):
+    """Returns the fitness of genotype and how many of its trials ended in each way (in the order of
+    simulation.outcomeNames), with the task parameters of run_carbonate.py and the given optical
+    variable. For the KBB15 fitness functions, both come from a single simulation of the trial grid;
+    any other fitness function is run as it is, followed by a second simulation for the outcomes."""
+    outcome = simulation.Outcome(run_carbonate.trial_length)
+    if fitnessName in jweights:
+        results = run_carbonate.simulateTrials(genotype, None, [simulation.FinalDistance(), simulation.FinalVelocity(),
+                                                                simulation.SquaredJerk(), outcome], optical_variable)
+        fitness = simulation.distanceVelocityJerk(results, jweights[fitnessName])
+    else:
+        fitness = getattr(run_carbonate, fitnessName)(genotype, optical_variable=optical_variable)
+        results = run_carbonate.simulateTrials(genotype, None, [outcome], optical_variable)
+    return fitness, np.bincount(results['outcome'], minlength=len(simulation.outcomeNames))
+
+
+def analyzeRun(filename, conditions, jweight):
+    """Analyzes one run in a worker process, and returns the arrays and metadata of its cache entry."""
+    mga, optical_variable = loadRun(filename)
+    evaluations = [evaluate(genotype, mga.fitnessName(), optical_variable) for genotype in mga.pop]
+    fitness = np.array([f for f, counts in evaluations])
+    outcomes = np.array([counts for f, counts in evaluations], dtype=int)
+    best = fitness.argmax()
+    if len(conditions) > 0:
+        perturbations = sweep(mga.pop[best], conditions, dict(run_carbonate.taskParams(), optical_variable=optical_variable), jweight)
+    else:
+        perturbations = np.zeros(0, dtype=resultsDtype)
+    arrays = {'fitness': fitness, 'outcomes': outcomes, 'bestIndividual': mga.pop[best], 'perturbations': perturbations}
+    metadata = {'file': os.path.basename(filename), 'fitness': mga.fitnessName(), 'optical_variable': optical_variable,
+                'popsize': mga.popsize, 'generations': mga.generationsRun, 'bestFitness': float(fitness[best]),
+                'top25FitnessMean': float(np.average(np.sort(fitness)[-25:]))}
+    return arrays, metadata
+
+
+def analyzeDirectory(directory, magnitudes=defaultMagnitudes, onsets=(0.,), durations=(None,), jweight=1000, workers=None, cache=None):
+    """Analyzes every run in directory and returns a dictionary of filename -> (arrays, metadata) (see
+    analyzeRun()). Runs found in the cache (directory/.analysis_cache unless cache is given) are read
+    from it; the rest are analyzed across workers processes (the number of cores by default) and
+    added to it. magnitudes, onsets, and durations give the perturbation sweep (see conditionGrid())."""
+    if cache is None:
+        cache = os.path.join(directory, '.analysis_cache')
+    os.makedirs(cache, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count()
+    conditions = conditionGrid(magnitudes, onsets, durations)
+    task = run_carbonate.taskParams()
+    del task['optical_variable']    # Comes from each run
+    settings = {'version': CACHE_VERSION, 'task': task, 'conditions': conditions, 'jweight': jweight}
+    results = {}
+    missing = {}
+    for filename in runFiles(directory):
+        entry = os.path.join(cache, '%s.npz' % cacheKey(filename, settings))
+        if os.path.exists(entry):
+            results[filename] = readCheckpoint(entry)
+        else:
+            missing[filename] = entry
+    print('%i run(s) cached, %i to analyze' % (len(results), len(missing)))
+    if (workers <= 1) or (len(missing) <= 1):
+        for filename, entry in missing.items():
+            arrays, metadata = analyzeRun(filename, conditions, jweight)
+            saveCheckpoint(entry, arrays, metadata)
+            results[filename] = (arrays, metadata)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            futures = {executor.submit(analyzeRun, filename, conditions, jweight): filename for filename in missing}
+            for future in as_completed(futures):
+                filename = futures[future]
+                arrays, metadata = future.result()
+                saveCheckpoint(missing[filename], arrays, metadata)    # Cache each run as soon as it is done
+                results[filename] = (arrays, metadata)
+    return {filename: results[filename] for filename in sorted(results)}
+
+
+def printSummary(results):
+    """Prints one line per run: its condition, best and top-25 mean fitness, and how the best genotype's
+    trials ended."""
+    print('%-48s %-22s %2s %5s %12s %12s %6s %6s %8s %5s' % ('File', 'Fitness function', 'V', 'Gen', 'Best', 'Top 25 mean',
+                                                             'Early', 'Crash', 'Timeout', 'Stop'))
+    for filename, (arrays, metadata) in results.items():
+        counts = arrays['outcomes'][arrays['fitness'].argmax()]
+        print('%-48s %-22s %2i %5i %12.4f %12.4f %6i %6i %8i %5i' % ((metadata['file'], metadata['fitness'], metadata['optical_variable'],
+              metadata['generations'], metadata['bestFitness'], metadata['top25FitnessMean']) + tuple(counts)))
+
+
+if __name__ == '__main__':
+    results = analyzeDirectory(sys.argv[1] if len(sys.argv) > 1 else 'Data')
+    printSummary(results)
@@ -0,0 +1,176 @@
+from ctrnn import CTRNN, BatchCTRNN
+from agentEnv import AgentEnv, BatchAgentEnv
+from mga import Microbial
+import run_carbonate
+import numpy as np
+import platform
+import random
+import copy
+import json
+import time
+import sys
+from datetime import date
+
+"""This file contains a benchmark suite for the parts of the code that most of the run time goes
+into: the CTRNN, one sense/think/act cycle of the agent, a full DistanceVelocityJerk evaluation on
+the 168-trial grid of run_carbonate.py, and the tournaments and statistics of Microbial at several
+population sizes. Every benchmark starts from the same seeds. Running
+
+    python benchmark.py results.json
+
+times the whole suite and saves the results as JSON, and
+
+    python benchmark.py compare baseline.json [results.json]
+
+compares a set of results (re-running the suite if none is given) against a stored baseline and
+flags every benchmark that got slower by more than the tolerance."""
+
+
+Size = run_carbonate.Size    # Same CTRNN and task parameters as the evolutionary runs
+Ranges = (run_carbonate.WeightRange, run_carbonate.BiasRange, run_carbonate.TimeConstMin, run_carbonate.TimeConstMax, run_carbonate.InputWeightRange)
+GenotypeLength = run_carbonate.GenotypeLength
+Dt = run_carbonate.Dt
+Popsizes = [150, 1000, 3000]    # Population sizes for the statistics benchmarks
+Tolerance = 0.10    # Slowdown (as a fraction) that counts as a regression in compare mode
+
+
+def seed(s=0):
+    random.seed(s)
+    np.random.seed(s)
+
+
+def timeit(function, number, repeats=5, setup=None):
+    """Calls function number times, repeats times over, and returns the median and minimum time per
+    call (sec). If setup is given, it is called before every call of function, and left out of the
+    time."""
+    times = []
+    for r in range(repeats):
+        if setup is None:
+            start = time.perf_counter()
+            for n in range(number):
+                function()
+            times.append((time.perf_counter()-start)/number)
+        else:
+            total = 0.
+            for n in range(number):
+                setup()
+                start = time.perf_counter()
+                function()
+                total += time.perf_counter()-start
+            times.append(total/number)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'number': number, 'repeats': repeats}
+
+
+def cheapFitness(genotype):   # Stand-in fitness function, so that the statistics benchmarks only measure the statistics
+    return -np.sum(genotype**2)
+
+
+def benchCTRNN():
+    seed()
+    nn = CTRNN(Size)
+    genotype = np.random.rand(GenotypeLength)*2 - 1
+    results = {'CTRNN.setParameters': timeit(lambda: nn.setParameters(genotype, *Ranges), 2000)}
+    nn.initializeState(np.zeros(Size))
+    nn.Input = np.full(Size, 0.5)
+    results['CTRNN.step'] = timeit(lambda: nn.step(Dt), 5000)
+    batch = BatchCTRNN(run_carbonate.ntrials, Size)
+    batch.setParameters(genotype, *Ranges)
+    batch.initializeState(np.zeros((run_carbonate.ntrials, Size)))
+    batch.Input = np.full((run_carbonate.ntrials, Size), 0.5)
+    results['BatchCTRNN.step (168 trials)'] = timeit(lambda: batch.step(Dt), 2000)
+    return results
+
+
+def benchAgent():
+    seed()
+    genotype = np.random.rand(GenotypeLength)*2 - 1
+    agent = AgentEnv(genotype, Size, *Ranges, Dt)
+    agent.Optical_variable = 4
+    agent.setInitialState(13., 165., 55.)
+    start = copy.deepcopy(agent.__dict__)    # Put back before every cycle (untimed), so the agent never stops
+    def cycle():
+        agent.sense()
+        agent.think()
+        agent.act()
+    results = {'AgentEnv sense/think/act': timeit(cycle, 2000, setup=lambda: agent.__dict__.update(copy.deepcopy(start)))}
+    batch = BatchAgentEnv(genotype, Size, *Ranges, Dt, run_carbonate.ntrials)
+    velocities, distances, sizes = run_carbonate.trialGrid()
+    batch.Optical_variable = 4
+    batch.setInitialState(velocities, distances, sizes)
+    batchStart = copy.deepcopy(batch.__dict__)
+    results['BatchAgentEnv step (168 trials)'] = timeit(lambda: batch.step(run_carbonate.trial_length), 500,
+                                                        setup=lambda: batch.__dict__.update(copy.deepcopy(batchStart)))
+    return results
+
+
+def benchFitness():
+    seed()
+    genotype = np.random.rand(GenotypeLength)*2 - 1
+    run_carbonate.optical_variable = 4
+    return {'DistanceVelocityJerk (168 trials)': timeit(lambda: run_carbonate.DistanceVelocityJerk(genotype), 5, repeats=3)}
+
+
+def benchTournament():
+    seed()
+    run_carbonate.optical_variable = 4
+    mga = Microbial(run_carbonate.DistanceVelocityJerk, run_carbonate.Population, GenotypeLength, run_carbonate.RecombProb, run_carbonate.MutatProb)
+    mga.initStats()    # Evaluate the initial population outside of the timing
+    return {'Microbial.tournament (DistanceVelocityJerk, P=150)': timeit(mga.tournament, 10, repeats=3)}
+
+
+def benchStats():
+    results = {}
+    for popsize in Popsizes:
+        seed()
+        mga = Microbial(cheapFitness, popsize, GenotypeLength, run_carbonate.RecombProb, run_carbonate.MutatProb)
+        mga.initStats()
+        results['Microbial.tournament (cheap fitness, P=%i)' % popsize] = timeit(mga.tournament, 200)
+        results['Microbial.fitStats (P=%i)' % popsize] = timeit(mga.fitStats, 50)
+        results['Microbial.getDiversity (P=%i)' % popsize] = timeit(mga.getDiversity, 3, repeats=3)
+    return results
+
+
+def runSuite():
+    """Runs every benchmark and returns the results, along with a description of the machine."""
+    results = {}
+    for bench in [benchCTRNN, benchAgent, benchFitness, benchTournament, benchStats]:
+        results.update(bench())
+    meta = {'date': str(date.today()), 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'processor': platform.processor()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, tolerance=Tolerance):
+    """Prints how each benchmark's median time changed from baseline to current (both as returned by
+    runSuite()) and returns the names of those that got slower by more than tolerance."""
+    regressions = []
+    print('%-60s %12s %12s %8s' % ('Benchmark', 'Baseline', 'Current', 'Ratio'))
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print('%-60s %12s %12.3e %8s' % (name, 'n/a', result['median'], 'new'))
+            continue
+        ratio = result['median']/baseline['results'][name]['median']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-60s %12.3e %12.3e %8.2f%s' % (name, baseline['results'][name]['median'], result['median'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'compare'):
+        baseline = json.load(open(sys.argv[2]))
+        if len(sys.argv) > 3:
+            current = json.load(open(sys.argv[3]))
+        else:
+            current = runSuite()
+        regressions = compare(baseline, current)
+        print('\n%i regression(s)' % len(regressions))
+        sys.exit(1 if regressions else 0)
+    else:
+        results = runSuite()
+        for name, result in results['results'].items():
+            print('%-60s %12.3e sec' % (name, result['median']))
+        if len(sys.argv) > 1:
+            json.dump(results, open(sys.argv[1], 'w'), indent=2)
@@ -17,6 +17,7 @@ class CTRNN():
         self.Output = np.zeros(size)            # neuron output vector
         self.Input = np.zeros(size)             # external neuron input vector
         self.InputWeight = np.zeros(size)       # input weight vector
+        self.invTimeConstant = 1.0/self.TimeConstant
 
 
     def randomizeParameters(self):
@@ -28,22 +29,9 @@ class CTRNN():
 
 
     def setParameters(self, genotype, WeightRange, BiasRange, TimeConstMin, TimeConstMax, 
-                      InputWeightRange):
-        k = 0
-        for i in range(self.Size):
-            for j in range(self.Size):
-                self.Weight[i][j] = genotype[k]*WeightRange
-                k += 1
-        for i in range(self.Size):
-            self.Bias[i] = genotype[k]*BiasRange
-            k += 1
-        for i in range(self.Size):
-            self.TimeConstant[i] = ((genotype[k] + 1)/2)*(TimeConstMax-TimeConstMin) + TimeConstMin
-            k += 1
-        for i in range(self.Size):
-            self.InputWeight = genotype[k]*InputWeightRange
-            k += 1
-        self.invTimeConstant = 1.0/self.TimeConstant
+                      InputWeightRange, inputWeights='last'):
+        """Decodes genotype into the parameters of the network, in place (see GenotypeLayout)."""
+        genotypeLayout(self.Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, inputWeights).decodeInto(genotype, self)
 
 
     def initializeState(self, v):
@@ -55,3 +43,133 @@ class CTRNN():
         netinput = (self.Input * self.InputWeight) + np.dot(self.Weight.T, self.Output)
         self.Voltage += dt * (self.invTimeConstant*(-self.Voltage+netinput))
         self.Output = expit(self.Voltage+self.Bias)
+
+
+class BatchCTRNN():
+    """Batched version of the CTRNN class above. Instead of holding one network, this holds a stack 
+    of B networks of the same size, so that a single call to step() advances all of them at once. 
+    B can count population members, trials, or both (e.g. every trial of every genotype). With 
+    only 5 neurons per network, numpy's per-call overhead is most of the cost of CTRNN.step(), 
+    so stepping many networks per call is far cheaper than stepping them one at a time. The math 
+    is the same as CTRNN, including the way setParameters() encodes the input weights. dtype sets 
+    the precision of every array of the stack; with float32, expit() and matmul() also run in 
+    single precision, since both keep the type of their inputs."""
+
+    def __init__(self, batch, size, dtype=float):
+        self.Batch = batch                                     # number of networks in the stack
+        self.Size = size                                       # number of neurons in each network
+        self.dtype = np.dtype(dtype)                           # float64, or float32 for single precision
+        self.Voltage = np.zeros((batch,size), dtype)           # neuron activation vectors
+        self.TimeConstant = np.ones((batch,size), dtype)       # time-constant vectors
+        self.invTimeConstant = 1.0/self.TimeConstant
+        self.Bias = np.zeros((batch,size), dtype)              # bias vectors
+        self.Weight = np.zeros((batch,size,size), dtype)       # weight matrices
+        self.Output = np.zeros((batch,size), dtype)            # neuron output vectors
+        self.Input = np.zeros((batch,size), dtype)             # external neuron input vectors
+        self.InputWeight = np.zeros((batch,size), dtype)       # input weight vectors
+
+
+    def setParameters(self, genotypes, WeightRange, BiasRange, TimeConstMin, TimeConstMax, 
+                      InputWeightRange, inputWeights='last'):
+        """genotypes can be a single genotype, which is then shared by every network in the 
+        stack, or a (batch, genesize) matrix with one genotype per network. The parameters are 
+        decoded in place, so re-parameterizing the stack allocates nothing (see GenotypeLayout)."""
+        genotypeLayout(self.Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, inputWeights).decodeInto(genotypes, self)
+
+
+    def initializeState(self, v):
+        self.Voltage = np.array(np.broadcast_to(v, (self.Batch, self.Size)), dtype=self.dtype)
+        self.Output = expit(self.Voltage+self.Bias)
+
+
+    def step(self, dt):
+        netinput = (self.Input * self.InputWeight) + np.matmul(self.Output[:,None,:], self.Weight)[:,0,:]
+        self.Voltage += dt * (self.invTimeConstant*(-self.Voltage+netinput))
+        self.Output = expit(self.Voltage+self.Bias)
+
+
+    def derivative(self, voltage, inputs):
+        """Returns the time derivative of the given voltages, with the given external inputs, without 
+        changing the state of the networks. This is what step() integrates; the adaptive-step 
+        integrator (see integrator.py) calls it directly."""
+        output = expit(voltage+self.Bias)
+        netinput = (inputs * self.InputWeight) + np.matmul(output[:,None,:], self.Weight)[:,0,:]
+        return self.invTimeConstant*(-voltage+netinput)
+
+
+layouts = {}    # GenotypeLayout for each set of parameters, so that each is only built once
+
+
+def genotypeLayout(size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, inputWeights='last'):
+    key = (size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, inputWeights)
+    if key not in layouts:
+        layouts[key] = GenotypeLayout(*key)
+    return layouts[key]
+
+
+class GenotypeLayout():
+    """Describes where each parameter of a CTRNN with size neurons is encoded in a genotype (the weight 
+    matrix row by row, then the biases, the time constants, and the input weights), and how genes in 
+    [-1, 1] map onto parameter values. decode() turns one genotype, or a whole population matrix with 
+    one genotype per row, into parameter arrays with slices and reshapes of the genotype instead of 
+    loops over its genes; decodeInto() writes them straight into the arrays of an existing CTRNN or 
+    BatchCTRNN. 
+
+    The original CTRNN.setParameters() loop assigned self.InputWeight instead of self.InputWeight[i], 
+    so every neuron ended up with the input weight encoded by the last gene. Every run in Data/ was 
+    evolved that way, so it stays the default (inputWeights='last'); inputWeights='each' gives each 
+    neuron the input weight of its own gene instead."""
+
+    def __init__(self, size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, inputWeights='last'):
+        if inputWeights not in ['last', 'each']:
+            raise ValueError("inputWeights should be 'last' or 'each', not %s" % inputWeights)
+        self.size = size
+        self.length = size*size + 3*size    # Number of genes
+        self.WeightRange = WeightRange
+        self.BiasRange = BiasRange
+        self.TimeConstMin = TimeConstMin
+        self.TimeConstMax = TimeConstMax
+        self.InputWeightRange = InputWeightRange
+        self.inputWeights = inputWeights
+        k = size*size
+        self.weights = slice(0, k)    # Where each kind of parameter sits in the genotype
+        self.biases = slice(k, k+size)
+        self.timeConstants = slice(k+size, k+2*size)
+        self.inputWeightGenes = slice(k+2*size, k+3*size) if inputWeights == 'each' else slice(k+3*size-1, k+3*size)
+
+
+    def decode(self, genotypes):
+        """Returns the parameters encoded in genotypes (one genotype, or a matrix with one per row) as a 
+        dictionary with the same names as the CTRNN attributes. Every array has the leading dimensions 
+        of genotypes, e.g. Weight is (population, size, size) for a population matrix."""
+        genotypes = np.asarray(genotypes, dtype=float)
+        shape = genotypes.shape[:-1]
+        parameters = {'Weight': np.empty(shape + (self.size, self.size)), 'Bias': np.empty(shape + (self.size,)),
+                      'TimeConstant': np.empty(shape + (self.size,)), 'invTimeConstant': np.empty(shape + (self.size,)),
+                      'InputWeight': np.empty(shape + (self.size,))}
+        self.decodeArrays(genotypes, parameters)
+        return parameters
+
+
+    def decodeInto(self, genotypes, network):
+        """Decodes genotypes into the parameter arrays of network (a CTRNN or BatchCTRNN) in place. A 
+        single genotype is shared by every network of a BatchCTRNN."""
+        genotypes = np.asarray(genotypes, dtype=float)
+        if genotypes.shape[-1] != self.length:
+            raise ValueError('Genotypes of a %i-neuron CTRNN have %i genes, not %i' % (self.size, self.length, genotypes.shape[-1]))
+        self.decodeArrays(genotypes, network.__dict__)
+
+
+    def decodeArrays(self, genotypes, parameters):
+        """Writes the decoded parameters into the arrays of the dictionary parameters. genotypes can 
+        have fewer leading dimensions than the arrays, in which case it is broadcast across them."""
+        shape = genotypes.shape[:-1]
+        np.multiply(genotypes[..., self.weights].reshape(shape + (self.size, self.size)), self.WeightRange, out=parameters['Weight'])
+        np.multiply(genotypes[..., self.biases], self.BiasRange, out=parameters['Bias'])
+        timeConstant = parameters['TimeConstant']    # Same operations, in the same order, as the original loop
+        np.add(genotypes[..., self.timeConstants], 1, out=timeConstant)
+        timeConstant /= 2
+        timeConstant *= (self.TimeConstMax-self.TimeConstMin)
+        timeConstant += self.TimeConstMin
+        np.divide(1.0, timeConstant, out=parameters['invTimeConstant'])
+        np.multiply(genotypes[..., self.inputWeightGenes], self.InputWeightRange, out=parameters['InputWeight'])
@@ -0,0 +1,74 @@
+import numpy as np
+
+"""This file contains vectorized measures of gene pool diversity that are used by the Microbial class.
+All of them are based on the Hamming (L1) distance between genotypes, normalized by the genotype
+length so that they match the numbers recorded in divHistory and conHistory. The full distance
+matrix is computed a block of rows at a time, so memory stays bounded (see maxbytes) even for
+populations in the thousands, and the population-wide averages avoid the matrix altogether. For
+populations so large that even that is too slow, sampledDiversity() estimates the diversity from a
+random sample of pairs."""
+
+
+def blockRows(popsize, genesize, maxbytes):    # Sub-function that picks how many rows of the distance matrix to compute at once
+    return max(1, int(maxbytes // (8*popsize*genesize)))
+
+
+def pairwiseDistances(pop, maxbytes=2**25):
+    """Returns the (P, P) matrix of mean Hamming distances (per gene) between every pair of genotypes
+    in pop. maxbytes bounds the size of the temporary array used for each block of rows."""
+    pop = np.asarray(pop, dtype=float)
+    popsize, genesize = pop.shape
+    rows = blockRows(popsize, genesize, maxbytes)
+    distances = np.empty((popsize, popsize))
+    for start in range(0, popsize, rows):
+        block = pop[start:start+rows]
+        distances[start:start+rows] = np.sum(np.abs(block[:,None,:] - pop[None,:,:]), axis=2)
+    return distances/genesize
+
+
+def distanceSums(pop):
+    """Returns the sum of Hamming distances from each genotype to all of its peers (not normalized).
+    This is the row sum of the full distance matrix, but the matrix is never built. Because the
+    distance is a sum over genes, each gene can be handled on its own: after sorting a gene's values,
+    the summed distance from any value to all the others follows from prefix sums of the sorted
+    column. That makes this O(G*P*log(P)) in time and O(G*P) in memory, instead of O(G*P*P)."""
+    pop = np.asarray(pop, dtype=float)
+    popsize, genesize = pop.shape
+    order = np.argsort(pop, axis=0)
+    ordered = np.take_along_axis(pop, order, axis=0)
+    below = np.cumsum(ordered, axis=0) - ordered     # Sum of the values ranked below each value, per gene
+    above = np.sum(ordered, axis=0) - below - ordered    # Sum of the values ranked above each value, per gene
+    rank = np.arange(popsize)[:,None]
+    per_gene = (rank*ordered - below) + (above - (popsize-1-rank)*ordered)
+    sums = np.empty((popsize, genesize))
+    np.put_along_axis(sums, order, per_gene, axis=0)    # Undo the sort
+    return np.sum(sums, axis=1)
+
+
+def diversity(pop):
+    """Returns the average Hamming distance of all genotypes to all their peers, normalized by the
+    genotype length. Same definition as Microbial.getDiversity() always used (self-comparisons
+    included)."""
+    pop = np.asarray(pop, dtype=float)
+    popsize, genesize = pop.shape
+    return np.sum(distanceSums(pop))/(popsize*popsize)/genesize
+
+
+def sampledDiversity(pop, samples=10000, rng=None):
+    """Estimates diversity() from a random sample of genotype pairs, drawn with replacement (so, like
+    diversity(), a genotype can be compared with itself). The estimate is unbiased and its cost does
+    not depend on the population size. rng can be a numpy Generator, for reproducible estimates."""
+    pop = np.asarray(pop, dtype=float)
+    popsize, genesize = pop.shape
+    if rng is None:
+        rng = np.random.default_rng()
+    a = rng.integers(0, popsize, samples)
+    b = rng.integers(0, popsize, samples)
+    return np.average(np.sum(np.abs(pop[a] - pop[b]), axis=1))/genesize
+
+
+def convergence(pop, best):
+    """Returns the average Hamming distance of all genotypes to the genotype best, normalized by the
+    genotype length."""
+    pop = np.asarray(pop, dtype=float)
+    return np.average(np.sum(np.abs(pop - best), axis=1))/pop.shape[1]
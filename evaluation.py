@@ -0,0 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+
+"""This file contains a process-pool backend for evaluating many genotypes at once. The fitness
+functions in run.py read the task parameters (trial grid, optical variable, CTRNN ranges, etc.) as
+module globals, so each worker is set up exactly once, when it starts: it is handed the fitness
+function and a dictionary of those globals, and after that only genotypes and fitness values cross
+between processes."""
+
+
+fitnessFunction = None    # Fitness function of this worker process; set by initWorker()
+
+
+def initWorker(function, params):
+    """Runs once in each worker process as it starts up."""
+    global fitnessFunction
+    fitnessFunction = function
+    if params is not None:
+        function.__globals__.update(params)    # Make sure the worker's task parameters match the parent's
+
+
+def evaluateOne(genotype):
+    return fitnessFunction(genotype)
+
+
+def evaluateChunk(genotypes):
+    return [fitnessFunction(g) for g in genotypes]
+
+
+class PoolEvaluator():
+    """Evaluates lists of genotypes across a pool of worker processes. workers defaults to the number
+    of cores on the machine. params should be a dictionary of the globals that fitnessFunction reads
+    (see taskParams() in run.py); these are installed in each worker once, which matters when the
+    workers are started fresh rather than forked from the parent."""
+
+    def __init__(self, fitnessFunction, workers=None, params=None):
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(fitnessFunction, params))
+
+
+    def map(self, genotypes):
+        """Returns an array with the fitness of each genotype, in order."""
+        genotypes = np.asarray(genotypes, dtype=float)
+        if len(genotypes) == 0:
+            return np.zeros(0)
+        chunks = np.array_split(genotypes, min(len(genotypes), 4*self.workers))    # A few chunks per worker evens out the load
+        return np.array([f for chunk in self.executor.map(evaluateChunk, chunks) for f in chunk])
+
+
+    def submit(self, genotype):
+        """Starts evaluating one genotype and returns a Future for its fitness."""
+        return self.executor.submit(evaluateOne, genotype)
+
+
+    def close(self):
+        self.executor.shutdown()
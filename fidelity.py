@@ -0,0 +1,107 @@
+from collections import deque
+import instrument
+import numpy as np
+
+"""This file contains a multi-fidelity (successive-halving) evaluation mode. Instead of running every
+genotype on the whole (target_size, initial_distance, initial_velocity) grid, each new genotype is
+first scored on a small subset of the trials (the first rung). Only the ones that score among the
+best seen so far on that rung are promoted to the next, larger subset, and so on up to the full grid.
+The subsets are stratified, so that every target size, initial distance, and initial velocity shows
+up about equally often in each of them, and nested, so that promoting a genotype only runs the trials
+it has not run yet. Since every fitness function is an average of a per-trial score, the fitness on
+a larger subset follows from the fitness on the smaller one plus the new trials."""
+
+
+def stratifiedOrder(shape, seed=0):
+    """Returns an ordering of the trial indices of a grid with the given shape (target sizes, initial
+    distances, initial velocities), such that any prefix of the ordering is a stratified subset: each
+    level of each factor appears as evenly as the length of the prefix allows. Indices are the same as
+    in trialGrid() in run.py."""
+    rng = np.random.default_rng(seed)
+    levels = np.array(np.unravel_index(np.arange(np.prod(shape)), shape)).T    # Factor levels of each trial
+    counts = [np.zeros(n) for n in shape]    # How often each level has been used so far
+    pairs = [np.zeros((shape[i], shape[j])) for i, j in [(0, 1), (0, 2), (1, 2)]]    # Same, for pairs of factors
+    remaining = list(rng.permutation(len(levels)))    # Random tie-breaking
+    order = []
+    while remaining:
+        cost = [sum(counts[f][levels[t][f]] for f in range(3)) +
+                sum(p[levels[t][i], levels[t][j]] for p, (i, j) in zip(pairs, [(0, 1), (0, 2), (1, 2)]))/len(levels) for t in remaining]
+        t = remaining.pop(int(np.argmin(cost)))
+        for f in range(3):
+            counts[f][levels[t][f]] += 1
+        for p, (i, j) in zip(pairs, [(0, 1), (0, 2), (1, 2)]):
+            p[levels[t][i], levels[t][j]] += 1
+        order.append(t)
+    return np.array(order)
+
+
+class MultiFidelity():
+    """Evaluates genotypes at increasing fidelity. task is the dictionary of task parameters returned by
+    taskParams() in run.py, and fitnessFunction must accept a trials argument (all of those in run.py do).
+    rungs are the numbers of trials in each subset, smallest first; the full grid is always added as the
+    last rung. A genotype is promoted from a rung when its score there is in the top 1/eta of the last
+    history scores recorded on that rung. Two tournament contestants whose fitnesses are within margin
+    of each other are promoted until the comparison is clear or both are on the full grid (see
+    Microbial.tournament()). Fidelity is always reported as the number of trials behind a fitness value."""
+
+    def __init__(self, fitnessFunction, task, rungs=(12, 42), eta=3, margin=0.05, history=100, seed=0):
+        self.fitnessFunction = fitnessFunction
+        shape = (len(task['target_size']), len(task['initial_distance']), len(task['initial_velocity']))
+        self.ntrials = int(np.prod(shape))
+        self.rungs = sorted(set(r for r in rungs if 0 < r < self.ntrials)) + [self.ntrials]
+        self.eta = eta
+        self.margin = margin
+        self.order = stratifiedOrder(shape, seed)
+        self.scores = [deque(maxlen=history) for r in self.rungs]    # Recent scores on each rung, for deciding promotions
+        self.simulated = 0    # Number of trials simulated so far
+        self.evaluations = [0 for r in self.rungs]    # Number of genotypes evaluated on (or promoted to) each rung
+
+
+    def trials(self, rung):
+        """Returns the trial indices of the given rung (an index into self.rungs)."""
+        return self.order[:self.rungs[rung]]
+
+
+    def rung(self, fidelity):
+        """Returns the rung index of a fidelity (number of trials)."""
+        return self.rungs.index(fidelity)
+
+
+    def evaluate(self, genotype, fidelity=0, fitness=None):
+        """Returns the fitness of genotype on the next rung up from fidelity, and that rung's fidelity.
+        fitness is the genotype's fitness at the given fidelity, so only the new trials are run. With
+        the defaults, the genotype is evaluated on the first rung."""
+        rung = 0 if fidelity == 0 else self.rung(fidelity) + 1
+        new = self.order[fidelity:self.rungs[rung]]
+        t = instrument.start()
+        f = self.fitnessFunction(genotype, new)
+        instrument.lap('fitness evaluation', t)
+        instrument.count('evaluations')
+        self.simulated += len(new)
+        self.evaluations[rung] += 1
+        if fidelity > 0:
+            f = (fitness*fidelity + f*len(new))/self.rungs[rung]    # Both are averages, so weight them by their trial counts
+        return f, self.rungs[rung]
+
+
+    def promising(self, fitness, fidelity):
+        """Records a score on a rung, and returns True if it is good enough to be promoted from there."""
+        scores = self.scores[self.rung(fidelity)]
+        scores.append(fitness)
+        if len(scores) < self.eta:    # Not enough to go on yet
+            return True
+        return fitness >= np.quantile(scores, 1 - 1/self.eta)
+
+
+    def assess(self, genotype):
+        """Evaluates a new genotype on the first rung and promotes it for as long as it looks promising.
+        Returns its fitness and the fidelity of that fitness."""
+        f, fidelity = self.evaluate(genotype)
+        while (fidelity < self.ntrials) and self.promising(f, fidelity):
+            f, fidelity = self.evaluate(genotype, fidelity, f)
+        return f, fidelity
+
+
+    def close(self, fa, fb):
+        """Returns True if two fitnesses are too close to trust a comparison of them at low fidelity."""
+        return abs(fa - fb) <= self.margin
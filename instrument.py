@@ -0,0 +1,106 @@
+import cProfile
+import pstats
+import time
+
+"""This file contains opt-in instrumentation for the evolutionary loop: named timers and counters
+that Microbial, BatchAgentEnv, and the fitness evaluations add to as they run. Nothing is recorded
+until enable() is called, and while it is disabled every hook returns right away, so leaving the
+hooks in the hot paths costs next to nothing. Timers work like a stopwatch with laps:
+
+    t = instrument.start()
+    ...                                  # work
+    t = instrument.lap('some work', t)   # adds the time since t to 'some work'
+
+Counts and times are kept per process, so worker processes (see evaluation.py) keep their own.
+profileTournaments() runs a number of tournaments under cProfile, for a function-level breakdown."""
+
+
+enabled = False
+timers = {}    # Name -> total seconds
+counters = {}    # Name -> total count
+started = None    # When instrumentation was last enabled or reset
+
+
+def enable():
+    global enabled
+    enabled = True
+    reset()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global started
+    timers.clear()
+    counters.clear()
+    started = time.perf_counter()
+
+
+def start():
+    """Returns the current time if instrumentation is enabled, or None if not."""
+    if not enabled:
+        return None
+    return time.perf_counter()
+
+
+def lap(name, t):
+    """Adds the time since t (from start() or an earlier lap()) to the timer called name, and returns
+    the current time for the next lap."""
+    if t is None:
+        return None
+    now = time.perf_counter()
+    timers[name] = timers.get(name, 0.) + (now - t)
+    return now
+
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+def summary():
+    """Returns the timers and counters, along with a few rates derived from them."""
+    derived = {}
+    if counters.get('evaluations', 0) > 0:
+        derived['trials per evaluation'] = counters.get('trials', 0)/counters['evaluations']
+        if timers.get('fitness evaluation', 0) > 0:
+            derived['evaluations per sec (of evaluation time)'] = counters['evaluations']/timers['fitness evaluation']
+        derived['evaluations per sec (of wall time)'] = counters['evaluations']/(time.perf_counter()-started)
+    if counters.get('trials', 0) > 0:
+        derived['steps per trial'] = counters.get('steps', 0)/counters['trials']
+    return {'timers': dict(timers), 'counters': dict(counters), 'derived': derived}
+
+
+def report():
+    """Prints the summary."""
+    if not enabled:
+        return
+    stats = summary()
+    wall = time.perf_counter() - started
+    print('Instrumentation (%f sec since enabled):' % wall)
+    for name, seconds in sorted(stats['timers'].items(), key=lambda item: -item[1]):
+        print('    %-42s %12f sec  (%5.1f%%)' % (name, seconds, 100*seconds/wall))
+    for name, n in sorted(stats['counters'].items()):
+        print('    %-42s %12i' % (name, n))
+    for name, value in stats['derived'].items():
+        print('    %-42s %12f' % (name, value))
+
+
+def profileTournaments(mga, tournaments, filename=None, sort='cumulative', lines=25):
+    """Runs tournaments tournaments of mga (a Microbial) under cProfile and prints the lines most
+    expensive functions, sorted by sort. If filename is given, the raw profile is also saved there
+    (it can be opened with pstats or snakeviz). Returns the pstats.Stats object."""
+    mga.initStats()    # Evaluate the initial population first, so that it is not part of the profile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for t in range(tournaments):
+        mga.tournament()
+    profiler.disable()
+    if filename is not None:
+        profiler.dump_stats(filename)
+    stats = pstats.Stats(profiler).sort_stats(sort)
+    stats.print_stats(lines)
+    return stats
@@ -0,0 +1,227 @@
+from ctrnn import BatchCTRNN
+from agentEnv import BatchAgentEnv
+import simulation
+from scipy.special import expit
+import numpy as np
+import instrument
+
+"""This file contains an adaptive-step alternative to the fixed-step forward Euler integration used by
+AgentEnv and BatchAgentEnv. The CTRNN and the braking physics are treated as one system of ordinary
+differential equations (voltages, velocity, distance, and the jerk so far), which is integrated with
+the Bogacki-Shampine 3(2) embedded Runge-Kutta pair: each step is taken with a third order method,
+its error is estimated from the embedded second order one, and the step size of each trial grows or
+shrinks to keep that error below the tolerance. Steps end exactly at trial_length, and the other stop
+conditions (Distance reaching 0, Velocity dropping to 0.005) are located within the step on the
+cubic Hermite interpolant of the state, by bisection.
+
+In the Euler version, the optical variables that are rates (image expansion rate and tau-dot) are
+differences between consecutive steps of Dt. Here they are computed from the exact derivatives and
+then multiplied by Dt, so that the evolved controllers see inputs of the same size; likewise the jerk
+(a sum of squared changes in acceleration from one step of Dt to the next) becomes Dt times the
+integral of the squared rate of change of acceleration. So Dt still sets the scale of these inputs
+and of the jerk, but no longer the step size. compare() runs both engines side by side and reports
+their step counts and fitness."""
+
+
+class AdaptiveAgentEnv():
+    """Drop-in replacement for BatchAgentEnv (same arguments, plus tolerance) that integrates every trial
+    with its own adaptive step size. tolerance is used as both the relative and the absolute error
+    tolerance of each step. Steps counts the accepted steps of each trial and Rejected the rejected ones.
+    Crashed marks the trials that ended by reaching the target; these are left just past it (Distance
+    slightly below 0), so that the usual Distance < 0 test counts them as crashes."""
+
+    def __init__(self, genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, ntrials, tolerance=1e-4, inputWeights='last'):
+
+        #CONTROLLER ATTRIBUTES
+        self.Dt = Dt    # Scale of the optical rates and of jerk (see above); also the first step size
+        self.tolerance = tolerance
+        self.ntrials = ntrials
+        self.NN = BatchCTRNN(ntrials, Size)
+        self.NN.setParameters(genotype,WeightRange,BiasRange,TimeConstMin,TimeConstMax,InputWeightRange,inputWeights)
+
+        #AGENT ATTRIBUTES
+        self.Brake_constant = 3.    # Scale factor for motor neuron output --> brake force
+        self.Brake_effectiveness = 1.    # This is a scale factor that can be perturbed (scalar or one value per trial)
+        self.Acceleration = np.zeros(ntrials)
+        self.Velocity = np.zeros(ntrials)
+
+        #ENVIRONMENT ATTRIBUTES
+        self.Target_size = np.zeros(ntrials)
+        self.Distance = np.zeros(ntrials)
+        self.Time = np.zeros(ntrials)
+        self.Optical_variable = 5   # Which optical variable is this agent paying attention to? (0-4)
+
+        # TRIAL BOOKKEEPING
+        self.Running = np.zeros(ntrials, dtype=bool)
+        self.Steps = np.zeros(ntrials, dtype=int)
+        self.Rejected = np.zeros(ntrials, dtype=int)
+        self.Crashed = np.zeros(ntrials, dtype=bool)
+        self.Jerk = np.zeros(ntrials)
+        self.Step_size = np.full(ntrials, Dt)
+
+
+    def setInitialState(self, velocity, distance, target_size):
+        """Same starting state as BatchAgentEnv.setInitialState(). No warm-up is needed, since the optical
+        variables are computed from the state itself rather than from the previous step."""
+        self.Velocity = np.array(velocity, dtype=float)
+        self.Distance = np.array(distance, dtype=float)
+        self.Target_size = np.array(target_size, dtype=float)
+        self.Time = np.zeros(self.ntrials)
+        self.Jerk = np.zeros(self.ntrials)
+        self.NN.initializeState(np.zeros(self.NN.Size))
+        self.Acceleration = -self.NN.Output[:,0]*self.Brake_constant*self.Brake_effectiveness
+        self.Running = np.ones(self.ntrials, dtype=bool)
+        self.Steps = np.zeros(self.ntrials, dtype=int)
+        self.Rejected = np.zeros(self.ntrials, dtype=int)
+        self.Crashed = np.zeros(self.ntrials, dtype=bool)
+        self.Step_size = np.full(self.ntrials, self.Dt)
+
+
+    def optics(self, distance, velocity, acceleration):
+        """Returns the optical variables (rows as in AgentEnv.Optical_info) of the given states."""
+        ts = self.Target_size
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):    # Finished trials may be at singular points; they are ignored
+            q = distance**2 + ts**2
+            image_size = np.arctan(ts/distance)
+            expansion = ts*velocity/q    # Time derivative of image_size
+            expansion_rate = ts*acceleration/q + 2*ts*distance*velocity**2/q**2    # Second derivative of image_size
+            image_expansion_rate = self.Dt*expansion
+            tau = image_size/image_expansion_rate
+            tau_dot = 1 - image_size*expansion_rate/expansion**2    # Dt times the time derivative of tau
+            PR = tau/tau_dot
+        return np.array([image_size, image_expansion_rate, tau, tau_dot, PR])
+
+
+    def derivatives(self, y):
+        """Returns the time derivative of the state y, whose columns are the CTRNN voltages, velocity,
+        distance, and jerk so far (one row per trial)."""
+        n = self.NN.Size
+        voltage, velocity, distance = y[:,:n], y[:,n], y[:,n+1]
+        motor = expit(voltage[:,0]+self.NN.Bias[:,0])
+        acceleration = -motor*self.Brake_constant*self.Brake_effectiveness
+        inputs = self.optics(distance, velocity, acceleration)[self.Optical_variable]
+        with np.errstate(invalid='ignore', over='ignore'):
+            dvoltage = self.NN.derivative(voltage, inputs[:,None])
+            dacceleration = -motor*(1-motor)*dvoltage[:,0]*self.Brake_constant*self.Brake_effectiveness
+            return np.column_stack([dvoltage, acceleration, -velocity, self.Dt*dacceleration**2])
+
+
+    def run(self, trial_length, reducers=()):
+        """Integrates every trial until it hits one of the stop conditions."""
+        if reducers:
+            raise ValueError('Streaming reducers need fixed steps; adaptive-step integration has none')
+        n = self.NN.Size
+        y = np.column_stack([self.NN.Voltage, self.Velocity, self.Distance, self.Jerk])
+        t = self.Time.copy()
+        self.Running &= (self.Distance > 0) & (self.Velocity > 0.005) & (t < trial_length)
+        k1 = self.derivatives(y)
+        h = self.Step_size.copy()
+        while self.Running.any():
+            h = np.minimum(h, trial_length - t)    # Land exactly on trial_length
+            hh = h[:,None]
+            with np.errstate(invalid='ignore', over='ignore'):
+                k2 = self.derivatives(y + hh*k1/2)
+                k3 = self.derivatives(y + 3*hh*k2/4)
+                y1 = y + hh*(2*k1 + 3*k2 + 4*k3)/9    # Third order solution
+                k4 = self.derivatives(y1)
+                error = hh*(-5*k1/72 + k2/12 + k3/9 - k4/8)    # Difference from the embedded second order solution
+                scale = self.tolerance*(1 + np.maximum(np.abs(y), np.abs(y1)))
+                norm = np.sqrt(np.mean((error/scale)**2, axis=1))
+            accept = self.Running & (norm <= 1)
+            self.Rejected += self.Running & ~accept
+            self.Steps += accept
+
+            # Stop conditions reached within an accepted step are located on the interpolant
+            stop = accept & ((y1[:,n+1] <= 0) | (y1[:,n] <= 0.005))
+            theta = np.ones(len(t))
+            if stop.any():
+                theta[stop] = self.locate(y[stop], k1[stop], y1[stop], k4[stop], h[stop])
+                y1[stop] = hermite(y[stop], k1[stop], y1[stop], k4[stop], h[stop], theta[stop])
+                self.Crashed |= stop & (y1[:,n+1] <= y1[:,n] - 0.005)    # Whichever condition was reached first
+            y = np.where(accept[:,None], y1, y)
+            t = np.where(accept, t + theta*h, t)
+            k1 = np.where(accept[:,None], k4, k1)    # First same as last
+            self.Running &= ~stop & (t < trial_length*(1 - 1e-12))
+
+            # Next step size, from the error of this one
+            with np.errstate(divide='ignore', invalid='ignore'):
+                factor = np.clip(0.9*norm**(-1/3), 0.2, 5.)
+            h = np.where(np.isnan(factor), h/5, h*factor)
+            stalled = self.Running & (h < 1e-10)    # Give up on trials that cannot get under the tolerance
+            self.Running &= ~stalled
+
+        self.NN.Voltage = y[:,:n]
+        self.Velocity = y[:,n]
+        self.Distance = np.where(self.Crashed, -np.finfo(float).tiny, y[:,n+1])    # Just past the target (see above)
+        self.Jerk = y[:,n+2]
+        self.Time = t
+        self.Step_size = h
+        self.Acceleration = -expit(y[:,0]+self.NN.Bias[:,0])*self.Brake_constant*self.Brake_effectiveness
+        if instrument.enabled:
+            instrument.count('trials', self.ntrials)
+            instrument.count('steps', int(np.sum(self.Steps + self.Rejected)))
+
+
+    outcomes = BatchAgentEnv.outcomes    # Same categories; crashed trials end at a distance just below zero
+    outcomeMasks = BatchAgentEnv.outcomeMasks
+
+
+    def locate(self, y0, f0, y1, f1, h, iterations=50):
+        """Returns where (as a fraction of the step) the first stop condition is reached within a step
+        from y0 to y1, by bisection on the cubic Hermite interpolant."""
+        n = self.NN.Size
+        low = np.zeros(len(h))
+        high = np.ones(len(h))
+        for i in range(iterations):
+            middle = (low + high)/2
+            y = hermite(y0[:,n:n+2], f0[:,n:n+2], y1[:,n:n+2], f1[:,n:n+2], h, middle)
+            reached = (y[:,1] <= 0) | (y[:,0] <= 0.005)
+            high = np.where(reached, middle, high)
+            low = np.where(reached, low, middle)
+        return high
+
+
+def hermite(y0, f0, y1, f1, h, theta):
+    """Cubic Hermite interpolation between states y0 and y1 (with derivatives f0 and f1) a step h apart,
+    at the fractions theta of the step."""
+    theta = theta[:,None]
+    h = h[:,None]
+    return ((2*theta**3 - 3*theta**2 + 1)*y0 + (theta**3 - 2*theta**2 + theta)*h*f0 +
+            (-2*theta**3 + 3*theta**2)*y1 + (theta**3 - theta**2)*h*f1)
+
+
+def fitness(agent, velocities, distances, jweight):
+    """Fitness of a finished agent, as in DistanceVelocity (jweight 0) and DistanceVelocityJerk (jweight
+    1000) in run.py."""
+    final_distances = np.where(agent.Distance < 0, distances, agent.Distance)/distances
+    final_velocities = np.where(agent.Velocity < 0, velocities, agent.Velocity)/velocities
+    return ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - jweight*np.average(agent.Jerk)
+
+
+def compare(genotypes, task, jweight=1000., tolerance=1e-4, report=True):
+    """Runs each genotype on the full trial grid with both fixed-step Euler (BatchAgentEnv) and the
+    adaptive integrator, and returns a dictionary of arrays with one entry per genotype: the fitness
+    and number of steps taken (summed over trials) of each. task is the dictionary returned by
+    taskParams() in run.py. For the adaptive integrator, steps include rejected ones; each step costs
+    three evaluations of the derivatives, against one per Euler step."""
+    velocities, distances, sizes = simulation.trialGrid(task['target_size'], task['initial_distance'], task['initial_velocity'])
+    params = (task['Size'], task['WeightRange'], task['BiasRange'], task['TimeConstMin'], task['TimeConstMax'], task['InputWeightRange'], task['Dt'], len(velocities))
+    results = {'euler fitness': [], 'euler steps': [], 'adaptive fitness': [], 'adaptive steps': []}
+    for genotype in genotypes:
+        inputWeights = task.get('InputWeights', 'last')
+        for name, agent in [('euler', BatchAgentEnv(genotype, *params, inputWeights=inputWeights)),
+                            ('adaptive', AdaptiveAgentEnv(genotype, *params, tolerance, inputWeights))]:
+            agent.setInitialState(velocities, distances, sizes)
+            agent.Optical_variable = task['optical_variable']
+            agent.run(task['trial_length'])
+            results['%s fitness' % name].append(fitness(agent, velocities, distances, jweight))
+            results['%s steps' % name].append(np.sum(agent.Steps) + np.sum(getattr(agent, 'Rejected', 0)))
+    results = {name: np.array(values) for name, values in results.items()}
+    if report:
+        print('%12s %12s %12s %12s %12s' % ('Euler fit', 'Euler steps', 'RK fit', 'RK steps', 'Difference'))
+        for i in range(len(genotypes)):
+            print('%12f %12i %12f %12i %12f' % (results['euler fitness'][i], results['euler steps'][i], results['adaptive fitness'][i],
+                                               results['adaptive steps'][i], results['adaptive fitness'][i] - results['euler fitness'][i]))
+        print('Steps: %f times fewer; fitness: mean absolute difference %f' % (np.sum(results['euler steps'])/np.sum(results['adaptive steps']),
+                                                                              np.average(np.abs(results['adaptive fitness'] - results['euler fitness']))))
+    return results
@@ -0,0 +1,151 @@
+from multiprocessing import Process, Pipe
+from mga import Microbial
+from tools import CheckpointWriter
+from evaluation import initWorker
+import numpy as np
+import random
+import select
+import time
+import sys
+import os
+
+"""This file contains an island-model runner. Each island is an ordinary Microbial population that
+evolves on its own, in its own process, with the usual tournaments. Every few generations, each
+island sends copies of its best genotypes to its neighbours, and takes in whatever migrants have
+arrived from its own neighbours in place of its worst individuals. Islands never wait for each other:
+migrants are sent as raw float bytes through one-way pipes and picked up whenever the receiving island
+next migrates, so the runner scales with the number of cores. When a neighbour has fallen so far
+behind that its pipe is full, migrants for it are dropped rather than waiting for it to catch up. Who sends to whom is set by the
+topology: 'ring' (each island sends to the next one) or 'full' (each island sends to all the others).
+Each island checkpoints itself (see Microbial.checkpoint) as it goes."""
+
+
+def neighbours(k, islands, topology):
+    """Returns the islands that island k sends migrants to."""
+    if topology == 'ring':
+        return [(k+1) % islands] if islands > 1 else []
+    elif topology == 'full':
+        return [j for j in range(islands) if j != k]
+    raise ValueError('Unknown topology %s; use ring or full' % topology)
+
+
+def migrate(mga, incoming, outgoing, migrants, counts):
+    """Sends copies of the best migrants genotypes of mga (with their fitness) down every outgoing pipe
+    that has room, then puts every genotype that has arrived on the incoming pipes in place of the worst
+    individual, if it is fitter. counts is a dictionary of running totals (sent, dropped, received,
+    accepted). A pipe with room takes a message of up to select.PIPE_BUF bytes without blocking, so at
+    most that many migrants are sent at a time."""
+    mga.initStats()
+    migrants = max(1, min(migrants, (select.PIPE_BUF - 16)//((mga.genesize+1)*8)))    # 16 bytes for the message header
+    best = np.argsort(mga.fitness)[-migrants:]
+    migrants = len(best)
+    message = np.hstack([mga.pop[best], mga.fitness[best][:,None]]).tobytes()    # One row per migrant, fitness last
+    for pipe in list(outgoing):
+        try:
+            if not select.select([], [pipe], [], 0)[1]:    # Full: that island is behind, so drop these migrants rather than wait
+                counts['dropped'] += migrants
+                continue
+            pipe.send_bytes(message)
+            counts['sent'] += migrants
+        except (BrokenPipeError, OSError):    # That island has finished
+            outgoing.remove(pipe)
+    for pipe in list(incoming):
+        try:
+            while pipe.poll():    # Never wait for migrants that have not arrived yet
+                rows = np.frombuffer(pipe.recv_bytes()).reshape(-1, mga.genesize+1)
+                for row in rows:
+                    counts['received'] += 1
+                    worst = mga.fitness.argmin()
+                    if row[-1] > mga.fitness[worst]:
+                        mga.replace(worst, row[:-1].copy(), row[-1])
+                        mga.cache.put(row[:-1], row[-1])
+                        counts['accepted'] += 1
+        except EOFError:    # That island has finished and everything it sent has been read
+            incoming.remove(pipe)
+
+
+def island(k, fitnessFunction, params, settings, incoming, outgoing, filename, generations, save_interval):
+    """Runs island k in a worker process: settings is the dictionary built by IslandModel. Runs for the given
+    number of generations, or endlessly if that is None, checkpointing to filename every save_interval minutes
+    and at the end."""
+    initWorker(fitnessFunction, params)    # Same set up as the evaluation workers (see evaluation.py)
+    random.seed(settings['seed'] + k)
+    np.random.seed(settings['seed'] + k)
+    mga = Microbial(fitnessFunction, settings['popsize'], settings['genesize'], settings['recombProb'], settings['mutatProb'])
+    counts = {'sent': 0, 'dropped': 0, 'received': 0, 'accepted': 0}
+    writer = CheckpointWriter()
+    last_save = time.time()
+    try:
+        while (generations is None) or (mga.generationsRun < generations):
+            chunk = settings['interval']
+            if generations is not None:
+                chunk = min(chunk, generations - mga.generationsRun)
+            mga.runTournaments(int(chunk*mga.popsize), report=False)
+            migrate(mga, incoming, outgoing, settings['migrants'], counts)
+            if (time.time()-last_save) > (save_interval*60):
+                writer.submit(filename, *mga.snapshot(island=k, **counts))
+                last_save = time.time()
+    finally:
+        for pipe in outgoing:
+            pipe.close()
+        writer.submit(filename, *mga.snapshot(island=k, **counts))
+        writer.close()
+
+
+class IslandModel():
+    """Evolves islands Microbial populations of popsize each in parallel, one process per island, migrating
+    the best migrants genotypes of each island to its neighbours (see neighbours()) every interval
+    generations. params is the dictionary of globals that fitnessFunction reads (see taskParams() in run.py).
+    Island k is seeded with seed+k, and checkpoints to '<filename>_I<k>.npz'."""
+
+    def __init__(self, fitnessFunction, islands, popsize, genesize, recombProb, mutatProb, params=None,
+                 topology='ring', interval=5, migrants=2, seed=0):
+        self.fitnessFunction = fitnessFunction
+        self.islands = islands
+        self.params = params
+        self.topology = topology
+        self.settings = {'popsize': popsize, 'genesize': genesize, 'recombProb': recombProb, 'mutatProb': mutatProb,
+                         'interval': interval, 'migrants': migrants, 'seed': seed}
+        neighbours(0, islands, topology)    # Check the topology before starting anything
+
+
+    def filenames(self, filename):
+        return ['%s_I%i.npz' % (filename, k) for k in range(self.islands)]
+
+
+    def run(self, filename, generations=None, save_interval=15):
+        """Runs every island for the given number of generations, or until terminated if that is None,
+        checkpointing every save_interval minutes."""
+        incoming = [[] for k in range(self.islands)]
+        outgoing = [[] for k in range(self.islands)]
+        for k in range(self.islands):
+            for j in neighbours(k, self.islands, self.topology):
+                receiver, sender = Pipe(duplex=False)
+                outgoing[k].append(sender)
+                incoming[j].append(receiver)
+        processes = [Process(target=island, args=(k, self.fitnessFunction, self.params, self.settings, incoming[k], outgoing[k],
+                                                  name, generations, save_interval))
+                     for k, name in enumerate(self.filenames(filename))]
+        for process in processes:
+            process.start()
+        for pipes in incoming + outgoing:    # The islands have their own copies now
+            for pipe in pipes:
+                pipe.close()
+        for process in processes:
+            process.join()
+
+
+    def results(self, filename):
+        """Returns the islands' populations, read back from their checkpoints."""
+        return [Microbial.resume(name, self.fitnessFunction, restoreRandom=False) for name in self.filenames(filename)]
+
+
+if __name__ == '__main__':
+    import run_carbonate
+    i = int(sys.argv[1])    # Condition, as in run_carbonate.py
+    islands = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    run_carbonate.fitnessFunction, run_carbonate.optical_variable = run_carbonate.condition(i)
+    model = IslandModel(run_carbonate.fitnessFunction, islands, run_carbonate.Population, run_carbonate.GenotypeLength,
+                        run_carbonate.RecombProb, run_carbonate.MutatProb, run_carbonate.taskParams())
+    filename = '%s_V%i_P%i_T%i' % (run_carbonate.fitnessFunction.__name__, run_carbonate.optical_variable, run_carbonate.Population, run_carbonate.ntrials)
+    model.run(filename)    # Runs until terminated
@@ -2,8 +2,52 @@ import random
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import date
-from tools import save
+from tools import saveCheckpoint, readCheckpoint, CheckpointWriter
+from diversity import diversity, sampledDiversity, convergence, distanceSums
 import time
+import instrument
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+class FitnessCache():
+    """Bounded memo of fitness values, keyed by the genotype itself (its raw bytes). Because the 
+    simulation is fully deterministic, a genotype's fitness never changes, so there is no reason to 
+    simulate it twice. When the cache is full, the least recently used genotype is dropped. Hits 
+    and misses are counted so that the hit rate can be reported with the progress stats."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.fits = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, genotype):
+        """Returns the cached fitness of genotype, or None if it has not been evaluated."""
+        key = np.asarray(genotype, dtype=float).tobytes()
+        if key in self.fits:
+            self.hits += 1
+            self.fits.move_to_end(key)    # Mark as most recently used
+            return self.fits[key]
+        self.misses += 1
+        return None
+
+
+    def put(self, genotype, fitness):
+        key = np.asarray(genotype, dtype=float).tobytes()
+        self.fits[key] = fitness
+        self.fits.move_to_end(key)
+        while len(self.fits) > self.maxsize:
+            self.fits.popitem(last=False)    # Evict least recently used
+
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.
+        return self.hits/lookups
+
 
 class Microbial():
     """This class is a modified version of a microbial genetic algorithm class that I got from E. Izquierdo, which is in turn an
@@ -12,10 +56,12 @@ class Microbial():
     includes significant changes to run(). Now there are two options to running tournaments: it can be done with a preset number
     of tournaments in mind (runTournaments()) or it can run endlessly, saving along the way, until terminated (runEndless()). 
     Both versions can report progress updates and fitness snapshots along the way. They both rely on the same underlying method,
-    tournament(), which fully constitutes Harvey's MGA."""
+    tournament(), which fully constitutes Harvey's MGA. A third option, runParallel(), runs the same tournaments but evaluates 
+    many of them at once on a pool of worker processes. Tournaments can also be decided with less simulation, either by racing
+    (see racing.py) or by multi-fidelity evaluation on subsets of the trials (see fidelity.py)."""
     
     
-    def __init__(self, fitnessFunction, popsize, genesize, recombProb, mutatProb):
+    def __init__(self, fitnessFunction, popsize, genesize, recombProb, mutatProb, cacheSize=None, evaluator=None, racer=None, multiFidelity=None):
         self.fitnessFunction = fitnessFunction
         self.popsize = popsize
         self.genesize = genesize
@@ -30,6 +76,184 @@ class Microbial():
         self.generationsRun = 0
         self.dateCreated = str(date.today())
         self.dateEdited = str(date.today())
+        if cacheSize is None:
+            cacheSize = 10*popsize    # Enough to hold the current population plus recent losers
+        self.cache = FitnessCache(cacheSize)    # Memo of fitness values; see FitnessCache
+        self.fitness = None     # Fitness of each individual, kept up to date by tournament() (see initStats)
+        self.distSums = None    # Sum of Hamming distances from each genotype to all its peers, kept up to date by tournament()
+        self.evaluator = evaluator    # Optional backend for evaluating many genotypes at once (e.g. evaluation.PoolEvaluator)
+        self.racer = racer    # Optional racing comparator for tournaments (see racing.py)
+        self.multiFidelity = multiFidelity    # Optional multi-fidelity evaluation (see fidelity.py)
+        self.fidelity = None    # When multi-fidelity, number of trials behind each individual's fitness
+        self.metadata = {}    # Metadata read from a checkpoint, when resumed from one (see resume)
+        if (racer is not None) and (multiFidelity is not None):
+            raise ValueError('Racing and multi-fidelity evaluation cannot be used together')
+
+
+    def __getstate__(self):
+        """Runs when pickling. The evaluator holds live worker processes, so it is not saved."""
+        state = self.__dict__.copy()
+        state['evaluator'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        """Runs when unpickling. Objects saved before the fitness cache and incremental statistics 
+        existed get an empty cache, and their statistics are computed the next time they are needed."""
+        self.__dict__.update(state)
+        if 'cache' not in state:
+            self.cache = FitnessCache(10*self.popsize)
+        if 'fitness' not in state:
+            self.fitness = None
+            self.distSums = None
+        if 'evaluator' not in state:
+            self.evaluator = None
+        if 'racer' not in state:
+            self.racer = None
+        if 'multiFidelity' not in state:
+            self.multiFidelity = None
+            self.fidelity = None
+        if 'metadata' not in state:
+            self.metadata = {}
+
+
+    def fitnessName(self):
+        """Returns the name of the fitness function, which is known even when a run was resumed from a 
+        checkpoint without one."""
+        if self.fitnessFunction is not None:
+            return self.fitnessFunction.__name__
+        return self.metadata['fitness']
+
+
+    def checkpoint(self, filename, **metadata):
+        """Saves the run to filename in the checkpoint format (see tools.py), which holds plain arrays 
+        only: the population and its statistics, the fitness cache, the histories, and the states of 
+        both random number generators. Keyword arguments (e.g. optical_variable, ntrials) are stored 
+        with the rest of the metadata. See resume()."""
+        t = instrument.start()
+        saveCheckpoint(filename, *self.snapshot(**metadata))
+        instrument.lap('saving', t)
+
+
+    def snapshot(self, **metadata):
+        """Returns the arrays and metadata that checkpoint() saves. They are copies, so they stay 
+        consistent while tournaments carry on (see tools.CheckpointWriter)."""
+        keys = list(self.cache.fits)    # Least recently used first
+        pyversion, pystate, pygauss = random.getstate()
+        npname, npkeys, nppos, nphasgauss, npgauss = np.random.get_state()
+        arrays = {'pop': self.pop.copy(),
+                  'bestIndividual': np.array(self.bestIndividual, dtype=float),
+                  'avgHistory': np.array(self.avgHistory, dtype=float),
+                  'bestHistory': np.array(self.bestHistory, dtype=float),
+                  'divHistory': np.array(self.divHistory, dtype=float),
+                  'conHistory': np.array(self.conHistory, dtype=float),
+                  'cacheGenotypes': np.frombuffer(b''.join(keys), dtype=float).reshape(len(keys), self.genesize),
+                  'cacheFitness': np.array([self.cache.fits[k] for k in keys], dtype=float),
+                  'pyrandom': np.array(pystate, dtype=np.uint64),
+                  'nprandom': npkeys}
+        if self.fitness is not None:
+            arrays['fitness'] = self.fitness.copy()
+            arrays['distSums'] = self.distSums.copy()
+        if self.fidelity is not None:
+            arrays['fidelity'] = self.fidelity.copy()
+        info = dict(self.metadata)
+        info.update(metadata)
+        if len(self.bestHistory) > 0:
+            info.update({'bestFitness': float(self.bestHistory[-1]), 'avgFitness': float(self.avgHistory[-1])})
+        info.update({'fitness': self.fitnessName(), 'popsize': self.popsize, 'genesize': self.genesize,
+                     'recombProb': self.recombProb, 'mutatProb': self.mutatProb, 'generationsRun': self.generationsRun,
+                     'dateCreated': self.dateCreated, 'dateEdited': self.dateEdited, 'cacheSize': self.cache.maxsize, 
+                     'cacheHits': self.cache.hits, 'cacheMisses': self.cache.misses, 'pyrandomVersion': pyversion, 
+                     'pyrandomGauss': pygauss, 'nprandomPos': int(nppos), 'nprandomGauss': [int(nphasgauss), float(npgauss)]})
+        return arrays, info
+
+
+    @classmethod
+    def resume(cls, filename, fitnessFunction=None, evaluator=None, racer=None, multiFidelity=None, restoreRandom=True):
+        """Returns the run saved in filename by checkpoint(). Only arrays are read, so this is quick and 
+        does not need run.py. fitnessFunction is only needed to run more tournaments; if given, it must 
+        have the same name as the saved one. When restoreRandom is True, the random and np.random 
+        generators are put back the way they were at the checkpoint too, so the run carries on exactly 
+        as if it had never stopped."""
+        arrays, metadata = readCheckpoint(filename)
+        if (fitnessFunction is not None) and (fitnessFunction.__name__ != metadata['fitness']):
+            raise ValueError('%s was saved with %s, not %s' % (filename, metadata['fitness'], fitnessFunction.__name__))
+        self = cls.__new__(cls)    # Skip __init__, which would draw a new random population
+        self.fitnessFunction = fitnessFunction
+        for name in ['popsize', 'genesize', 'recombProb', 'mutatProb', 'generationsRun', 'dateCreated', 'dateEdited']:
+            setattr(self, name, metadata[name])
+        self.pop = arrays['pop']
+        self.bestIndividual = arrays['bestIndividual'] if arrays['bestIndividual'].ndim > 0 else -1
+        for name in ['avgHistory', 'bestHistory', 'divHistory', 'conHistory']:
+            setattr(self, name, arrays[name].tolist())
+        self.cache = FitnessCache(metadata['cacheSize'])
+        for genotype, f in zip(arrays['cacheGenotypes'], arrays['cacheFitness']):
+            self.cache.fits[genotype.tobytes()] = f
+        self.cache.hits = metadata['cacheHits']
+        self.cache.misses = metadata['cacheMisses']
+        self.fitness = arrays.get('fitness')
+        self.distSums = arrays.get('distSums')
+        self.fidelity = arrays.get('fidelity')
+        self.evaluator = evaluator
+        self.racer = racer
+        self.multiFidelity = multiFidelity
+        self.metadata = metadata
+        if (multiFidelity is not None) and (self.fidelity is None) and (self.fitness is not None):
+            self.fidelity = np.full(self.popsize, multiFidelity.ntrials)    # Saved without multi-fidelity, so every fitness is a full-grid one
+        if restoreRandom:
+            random.setstate((metadata['pyrandomVersion'], tuple(int(x) for x in arrays['pyrandom']), metadata['pyrandomGauss']))
+            np.random.set_state(('MT19937', arrays['nprandom'], metadata['nprandomPos']) + tuple(metadata['nprandomGauss']))
+        return self
+
+
+    def evaluate(self, genotype):
+        """Returns the fitness of genotype, only running the fitness function if the genotype is not 
+        already in the cache."""
+        f = self.cache.get(genotype)
+        if f is None:
+            t = instrument.start()
+            f = self.fitnessFunction(genotype)
+            instrument.lap('fitness evaluation', t)
+            instrument.count('evaluations')
+            self.cache.put(genotype, f)
+        return f
+
+
+    def evaluatePop(self, genotypes):
+        """Returns an array with the fitness of each genotype. Genotypes that are not in the cache 
+        are evaluated all at once by self.evaluator if there is one, or one by one otherwise."""
+        fits = np.array([self.cache.get(g) for g in genotypes], dtype=float)   # Cache misses come back as nan
+        missing = np.flatnonzero(np.isnan(fits))
+        if len(missing) > 0:
+            t = instrument.start()
+            instrument.count('evaluations', len(missing))
+            if self.evaluator is not None:
+                fits[missing] = self.evaluator.map([genotypes[i] for i in missing])
+            else:
+                fits[missing] = [self.fitnessFunction(genotypes[i]) for i in missing]
+            instrument.lap('fitness evaluation', t)
+            for i in missing:
+                self.cache.put(genotypes[i], fits[i])
+        return fits
+
+
+    def assess(self, genotype):
+        """Returns the fitness of a new genotype along with the number of trials behind it, evaluating 
+        it as cheaply as self.multiFidelity allows. Only fitnesses from the full grid go in the cache."""
+        f = self.cache.get(genotype)
+        if f is not None:
+            return f, self.multiFidelity.ntrials
+        f, fidelity = self.multiFidelity.assess(genotype)
+        if fidelity == self.multiFidelity.ntrials:
+            self.cache.put(genotype, f)
+        return f, fidelity
+
+
+    def promote(self, i):
+        """Re-evaluates individual i on the next rung up (see fidelity.py)."""
+        self.fitness[i], self.fidelity[i] = self.multiFidelity.evaluate(self.pop[i], self.fidelity[i], self.fitness[i])
+        if self.fidelity[i] == self.multiFidelity.ntrials:
+            self.cache.put(self.pop[i], self.fitness[i])
 
 
     def showFitness(self, savename=''):
@@ -57,41 +281,66 @@ class Microbial():
             
 
     def fitStats(self):
-        bestfit = -999999
-        bestind = -1
-        sumfit = 0.0
-        for i in self.pop:
-            f = self.fitnessFunction(i)
-            sumfit += f
-            if (f > bestfit):
-                bestfit = f
-                bestind = i
-                
-        self.bestIndividual = bestind
-        return sumfit/self.popsize, bestfit, self.getDiversity(), self.getConvergence()
-
-
-    def getDiversity(self):  # Returns average Hamming distance of all genotypes to all their peers
-        ahd = np.zeros(self.popsize)  # Vector of average Hamming distance of *each* genotype to all its peers
-        for i in range(self.popsize): 
-            a = self.pop[i]
-            hd = np.zeros(self.popsize)     # Create temporary vector of Hamming distances from a particular genotype to all others
-            for j in range(self.popsize): 
-                b = self.pop[j]
-                diff = abs(a-b)    # Compare the two genotypes
-                hd[j] = np.sum(diff) # Sum the two genotypes being compared and add to temporary vector of Hamming distances
-                
-            ahd[i] = np.average(hd)
-            
-        return np.average(ahd)/self.genesize  # Return (normalized) average of averages
+        """Returns average fitness, best fitness, diversity, and convergence of the population. These 
+        are read from the per-individual fitness array and pairwise distance sums that tournament() 
+        keeps up to date, so nothing is re-simulated or recomputed from scratch here (except when racing, 
+        which leaves some fitnesses unfinished; see finishRaces). With multi-fidelity evaluation, the best 
+        individual is promoted to the full grid first, so the best fitness is always a full-grid one."""
+        self.finishRaces()
+        bestind = self.fitness.argmax()
+        if self.multiFidelity is not None:
+            while self.fidelity[bestind] < self.multiFidelity.ntrials:
+                self.promote(bestind)
+                bestind = self.fitness.argmax()
+        t = instrument.start()
+        self.bestIndividual = self.pop[bestind].copy()
+        diversity = np.sum(self.distSums)/(self.popsize*self.popsize)/self.genesize    # Same as getDiversity()
+        convergence = self.distSums[bestind]/self.popsize/self.genesize    # Same as getConvergence()
+        instrument.lap('statistics', t)
+        return np.average(self.fitness), self.fitness[bestind], diversity, convergence
 
 
-    def getConvergence(self):  # Returns the average Hamming distance of all genotypes to the best genotype
-        hd = np.zeros(self.popsize)  
-        for i in range(self.popsize): 
-            hd[i] = sum(abs(self.bestIndividual-self.pop[i]))    # Compare the two genotypes and add to vector of HDs
+    def initStats(self):
+        """Evaluates every individual and computes the sum of Hamming distances from each genotype to 
+        all its peers. This only does anything the first time it is called (or after the population 
+        has been replaced wholesale by setting self.fitness to None); after that, tournament() keeps 
+        both up to date."""
+        if self.fitness is not None:
+            return
+        if self.multiFidelity is not None:
+            fits = [self.assess(g) for g in self.pop]
+            self.fitness = np.array([f for f, fidelity in fits])
+            self.fidelity = np.array([fidelity for f, fidelity in fits])
+        else:
+            self.fitness = self.evaluatePop(self.pop)
+        self.distSums = distanceSums(self.pop)
+
+
+    def finishRaces(self):
+        """When racing (see racing.py), finishes evaluating every individual whose fitness is not yet 
+        fully known."""
+        self.initStats()
+        if self.racer is None:
+            return
+        unknown = np.flatnonzero(np.isnan(self.fitness))
+        self.fitness[unknown] = self.evaluatePop(self.pop[unknown])
+
+
+    def rowDistances(self, i):
+        """Returns the vector of Hamming distances from genotype i to every genotype in the population."""
+        return np.sum(np.abs(self.pop - self.pop[i]), axis=1)
 
-        return np.average(hd)/self.genesize  # Return (normalized) average Hamming distance to best genotype
+
+    def getDiversity(self, samples=None):  # Returns average Hamming distance of all genotypes to all their peers
+        """Recomputes diversity from scratch (see diversity.py). For very large populations, samples 
+        can be set to a number of random pairs to estimate it from instead."""
+        if samples is not None:
+            return sampledDiversity(self.pop, samples)
+        return diversity(self.pop)
+
+
+    def getConvergence(self):  # Returns the average Hamming distance of all genotypes to the best genotype
+        return convergence(self.pop, self.bestIndividual)
 
 
     def tournament(self):
@@ -102,25 +351,75 @@ class Microbial():
             b = random.randint(0,self.popsize-1)
 
         # Step 2: Compare their fitness
-        if (self.fitnessFunction(self.pop[a]) > self.fitnessFunction(self.pop[b])):
+        self.initStats()
+        if (self.racer is not None) and (np.isnan(self.fitness[a]) or np.isnan(self.fitness[b])):
+            a_wins, fa, fb = self.racer.compare(self.pop[a], self.fitness[a], self.pop[b], self.fitness[b])   # See racing.py
+            for i, f in [(a, fa), (b, fb)]:
+                if np.isnan(self.fitness[i]) and not np.isnan(f):    # Races that ran to the end give the full fitness
+                    self.fitness[i] = f
+                    self.cache.put(self.pop[i], f)
+        else:
+            if self.multiFidelity is not None:     # Promote close contestants until the comparison is clear
+                full = self.multiFidelity.ntrials
+                while self.multiFidelity.close(self.fitness[a], self.fitness[b]) and min(self.fidelity[a], self.fidelity[b]) < full:
+                    lowest = min(self.fidelity[a], self.fidelity[b])
+                    for i in [a, b]:
+                        if self.fidelity[i] == lowest:
+                            self.promote(i)
+            a_wins = (self.fitness[a] > self.fitness[b])
+        if a_wins:
             winner = a
             loser = b
         else:
             winner = b
             loser = a
 
+        # Steps 3 and 4: Transfect and mutate loser (see offspring)
+        child = self.offspring(winner, loser)
+
+        # Step 5: Put the new genotype in place of the loser, along with its fitness. When racing, the 
+        # new genotype is not evaluated until it takes part in a tournament or statistics are needed.
+        if self.racer is not None:
+            f = self.cache.get(child)
+            self.replace(loser, child, np.nan if f is None else f)
+        elif self.multiFidelity is not None:
+            f, fidelity = self.assess(child)
+            self.replace(loser, child, f)
+            self.fidelity[loser] = fidelity
+        else:
+            self.replace(loser, child, self.evaluate(child))
+
+
+    def offspring(self, winner, loser):
+        """Returns the loser of a tournament after transfecting it with the winner's genes and mutating 
+        it. The population itself is not changed; see replace()."""
+        child = self.pop[loser].copy()
+
         # Step 3: Transfect loser with winner
         for g in range(self.genesize):
             if (random.random() < self.recombProb):
-                self.pop[loser][g] = self.pop[winner][g]
+                child[g] = self.pop[winner][g]
 
         # Step 4: Mutate loser and ensure new genes stay within bounds
         for g in range(self.genesize):
-            self.pop[loser][g] += random.gauss(0.0,self.mutatProb)
-            if self.pop[loser][g] > 1.0:
-                self.pop[loser][g] = 1.0
-            if self.pop[loser][g] < -1.0:
-                self.pop[loser][g] = -1.0
+            child[g] += random.gauss(0.0,self.mutatProb)
+            if child[g] > 1.0:
+                child[g] = 1.0
+            if child[g] < -1.0:
+                child[g] = -1.0
+
+        return child
+
+
+    def replace(self, i, genotype, fitness):
+        """Puts genotype in the population at index i, and updates the fitness array and pairwise 
+        distance sums to match."""
+        old_distances = self.rowDistances(i)    # Distances to peers, before the genotype changes
+        self.pop[i] = genotype
+        new_distances = self.rowDistances(i)
+        self.distSums += new_distances - old_distances
+        self.distSums[i] = np.sum(new_distances)
+        self.fitness[i] = fitness
 
 
     def runTournaments(self, tournaments, report=True):
@@ -140,7 +439,13 @@ class Microbial():
             if (report==True) and (i/tournaments*100 > report_progress):    # If it is time (and if enabled) print status updates to console and iterate
                 print(' \n%d%% Complete' % (report_progress))
                 print('Fitness Avg=%f, Max=%f, Div=%f, Con=%f' % tuple(self.fitStats()))
+                print('Cache hit rate: %f (%i hits / %i misses)' % (self.cache.hitRate(), self.cache.hits, self.cache.misses))
+                if self.racer is not None:
+                    print('Racing: %i trial simulations run, %i skipped' % (self.racer.simulated, self.racer.skipped))
+                if self.multiFidelity is not None:
+                    print('Fidelity: %f trials per individual on average, %i trial simulations run' % (np.average(self.fidelity), self.multiFidelity.simulated))
                 print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 )) 
+                instrument.report()    # Only prints when instrumentation is enabled
                 report_progress += 10
         
         # After running evolutionary loop, update metadata and give final status update
@@ -149,31 +454,140 @@ class Microbial():
         if report==True:
             print(' \n100% Complete')
             print('Fitness Avg=%f, Max=%f, Div=%f, Con=%f' % tuple(self.fitStats()))
+            print('Cache hit rate: %f (%i hits / %i misses)' % (self.cache.hitRate(), self.cache.hits, self.cache.misses))
+            if self.racer is not None:
+                print('Racing: %i trial simulations run, %i skipped' % (self.racer.simulated, self.racer.skipped))
+            if self.multiFidelity is not None:
+                print('Fidelity: %f trials per individual on average, %i trial simulations run' % (np.average(self.fidelity), self.multiFidelity.simulated))
             print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 )) 
+            instrument.report()    # Only prints when instrumentation is enabled
         
         
-    def runEndless(self, filename, interval=15):
-        """Run tournaments endlessly until terminated, and save data every so often. The interval between 
-        saves/progress reports can be modifed by the keyword interval (minutes)."""
+    def runParallel(self, tournaments, report=True):
+        """Runs a set number of tournaments, evaluating the new losers concurrently on self.evaluator 
+        (an evaluation.PoolEvaluator). Each tournament is the same as in tournament(): two individuals 
+        are picked at random, the one with the lower fitness is transfected with the winner's genes and 
+        mutated, and it then replaces the loser. The difference is that the next tournaments are drawn 
+        while earlier offspring are still being evaluated, and each offspring replaces its loser as soon 
+        as its fitness comes back, so the population and its statistics always match. Losers whose 
+        offspring are still pending are left out of new tournaments until then, which keeps the pairs 
+        in flight disjoint. Status reports include throughput in tournaments per second. Racing and 
+        multi-fidelity evaluation are not supported here, since every offspring is evaluated on the 
+        full grid by a worker."""
+        if (self.racer is not None) or (self.multiFidelity is not None):
+            raise ValueError('runParallel() evaluates every offspring on the full grid, so it cannot be used with racing or multi-fidelity evaluation')
         start = time.time()
-        last_report = start
-        t = 0   # Counter for triggering generational recording of statistics
-        while True:  # Evolutionary loop
-            self.tournament()   # Run one tournament
-            if (t%self.popsize==0):                 # Record statistics every generation
+        self.finishRaces()
+        inflight = 2*self.evaluator.workers    # Enough pending evaluations to keep every worker busy
+        pending = {}    # Future -> (index of loser, offspring being evaluated)
+        busy = set()    # Losers whose offspring are still being evaluated
+        started = 0
+        completed = 0
+        recorded = 0    # Generations of statistics recorded so far in this call
+        report_progress = 0    # Used later for reporting progress updates to console
+        while completed < tournaments:     # Evolutionary loop
+            # Start as many tournaments as there are free slots and idle individuals
+            while (started < tournaments) and (len(pending) < inflight) and (self.popsize-len(busy) >= 2):
+                a, b = random.sample([i for i in range(self.popsize) if i not in busy], 2)
+                if (self.fitness[a] > self.fitness[b]):
+                    winner = a
+                    loser = b
+                else:
+                    winner = b
+                    loser = a
+                child = self.offspring(winner, loser)
+                f = self.cache.get(child)
+                if f is None:
+                    pending[self.evaluator.submit(child)] = (loser, child)
+                    busy.add(loser)
+                else:
+                    self.replace(loser, child, f)
+                    completed += 1
+                started += 1
+
+            # Apply results as they come back
+            done = []
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                loser, child = pending.pop(future)
+                busy.discard(loser)
+                self.cache.put(child, future.result())
+                self.replace(loser, child, future.result())
+                completed += 1
+
+            while (completed > recorded*self.popsize):     # Every generation, record statistics
                 af, bf, d, c = self.fitStats()
                 self.avgHistory.append(af)
                 self.bestHistory.append(bf)
                 self.divHistory.append(d)
                 self.conHistory.append(c)
-                self.dateEdited = str(date.today())
-                
-            if (time.time()-last_report) > (interval*60):     # If it's been more than N minutes since last report/save, save/report
-                print("\nSaving...")
-                save(filename, self)
-                print('Generations Run: %i' % int(self.generationsRun))     # Print generations run so far
+                recorded += 1
+
+            if (report==True) and (completed/tournaments*100 > report_progress) and (completed < tournaments):    # If it is time (and if enabled) print status updates to console and iterate
+                print(' \n%d%% Complete' % (report_progress))
                 print('Fitness Avg=%f, Max=%f, Div=%f, Con=%f' % tuple(self.fitStats()))
-                print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 )) 
-                last_report = time.time()
-                
-            t += 1
\ No newline at end of file
+                print('Cache hit rate: %f (%i hits / %i misses)' % (self.cache.hitRate(), self.cache.hits, self.cache.misses))
+                print('Throughput: %f tournaments/sec on %i workers' % (completed/(time.time()-start), self.evaluator.workers))
+                print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 ))
+                instrument.report()    # Only prints when instrumentation is enabled
+                report_progress += 10
+
+        # After running evolutionary loop, update metadata and give final status update
+        self.generationsRun += (tournaments/self.popsize)
+        self.dateEdited = str(date.today())
+        if report==True:
+            print(' \n100% Complete')
+            print('Fitness Avg=%f, Max=%f, Div=%f, Con=%f' % tuple(self.fitStats()))
+            print('Cache hit rate: %f (%i hits / %i misses)' % (self.cache.hitRate(), self.cache.hits, self.cache.misses))
+            print('Throughput: %f tournaments/sec on %i workers' % (tournaments/(time.time()-start), self.evaluator.workers))
+            print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 ))
+            instrument.report()    # Only prints when instrumentation is enabled
+
+
+    def runEndless(self, filename, interval=15, **metadata):
+        """Run tournaments endlessly until terminated, and save data every so often. The interval between 
+        saves/progress reports can be modifed by the keyword interval (minutes). Saves are checkpoints 
+        (see checkpoint(); keyword arguments are stored as metadata), and they are written by a background 
+        thread from a snapshot of the run, so tournaments carry on while the file is being written. The 
+        progress report says how long the last save took and how far behind the run it was by the time it 
+        was written."""
+        start = time.time()
+        last_report = start
+        writer = CheckpointWriter()
+        t = 0   # Counter for triggering generational recording of statistics
+        try:
+            while True:  # Evolutionary loop
+                self.tournament()   # Run one tournament
+                if (t%self.popsize==0):                 # Record statistics every generation
+                    af, bf, d, c = self.fitStats()
+                    self.avgHistory.append(af)
+                    self.bestHistory.append(bf)
+                    self.divHistory.append(d)
+                    self.conHistory.append(c)
+                    self.dateEdited = str(date.today())
+                    if t > 0:
+                        self.generationsRun += 1    # Kept current, so that checkpoints record it
+                    
+                if (time.time()-last_report) > (interval*60):     # If it's been more than N minutes since last report/save, save/report
+                    print("\nSaving...")
+                    timer = instrument.start()
+                    writer.submit(filename, *self.snapshot(**metadata))
+                    instrument.lap('saving (snapshot)', timer)    # The file itself is written in the background
+                    print('Generations Run: %i' % int(self.generationsRun))     # Print generations run so far
+                    print('Fitness Avg=%f, Max=%f, Div=%f, Con=%f' % (self.avgHistory[-1], self.bestHistory[-1], self.divHistory[-1], self.conHistory[-1]))    # As of the last generation recorded
+                    print('Cache hit rate: %f (%i hits / %i misses)' % (self.cache.hitRate(), self.cache.hits, self.cache.misses))
+                    if self.racer is not None:
+                        print('Racing: %i trial simulations run, %i skipped' % (self.racer.simulated, self.racer.skipped))
+                    if self.multiFidelity is not None:
+                        print('Fidelity: %f trials per individual on average, %i trial simulations run' % (np.average(self.fidelity), self.multiFidelity.simulated))
+                    if writer.saves:
+                        name, seconds, lag = writer.saves[-1]
+                        print('Last save: %f sec to write, %f sec behind the run when written (%i snapshots skipped)' % (seconds, lag, writer.skipped))
+                    print('Time elapsed: %f sec / %f min / %f hours' % ( (time.time()-start), (time.time()-start)/60, (time.time()-start)/3600 )) 
+                    instrument.report()    # Only prints when instrumentation is enabled
+                    last_report = time.time()
+                    
+                t += 1
+        finally:
+            writer.close()    # Finish writing the last snapshot, even when stopped with Ctrl-C
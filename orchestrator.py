@@ -0,0 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor
+from mga import Microbial
+from tools import readCheckpoint
+import run_carbonate
+import numpy as np
+import random
+import time
+import sys
+import os
+
+"""This file runs a whole sweep of experimental conditions on the cores of one machine, instead of
+submitting one single-core SLURM job per condition (conditions.sh). Each condition's run is cut into
+chunks of a few generations. A chunk resumes the condition from its checkpoint (see
+Microbial.checkpoint), runs its generations, and checkpoints again, so any chunk can run on any core
+and a sweep that is stopped part way picks up where it left off. LocalQueue stands in for SLURM's
+submit/monitor step (sbatch/squeue). The Orchestrator keeps every core busy and balances the load
+using the evaluations/sec measured for each condition: when a core frees up, it gets a chunk of the
+condition with the most estimated time left, so all the conditions finish at about the same time."""
+
+
+def conditionMatrix():
+    """Returns the 10 conditions of run_carbonate.py (2 fitness functions X 5 optical variables), as
+    a list of (fitness function name, optical variable) pairs in the same order as conditions.sh."""
+    matrix = []
+    for i in range(10):
+        fitnessFunction, optical_variable = run_carbonate.condition(i)
+        matrix.append((fitnessFunction.__name__, optical_variable))
+    return matrix
+
+
+def checkpointName(directory, fitnessName, optical_variable):
+    return os.path.join(directory, '%s_V%i_P%i_T%i.npz' % (fitnessName, optical_variable, run_carbonate.Population, run_carbonate.ntrials))
+
+
+def runChunk(fitnessName, optical_variable, generations, filename, seed):
+    """Runs one chunk of a condition in a worker process, and returns the number of generations run so
+    far, the number of evaluations in this chunk, and how long it took (sec). The condition is resumed
+    from filename if it exists, or started from seed if not. Because the checkpoint holds the random
+    number generator states, the result does not depend on which worker ran which chunk."""
+    start = time.time()
+    run_carbonate.fitnessFunction = getattr(run_carbonate, fitnessName)    # The fitness functions read these as globals
+    run_carbonate.optical_variable = optical_variable
+    racer, multiFidelity = run_carbonate.evaluationOptions()
+    if os.path.exists(filename):
+        mga = Microbial.resume(filename, run_carbonate.fitnessFunction, racer=racer, multiFidelity=multiFidelity)
+    else:
+        random.seed(seed)
+        np.random.seed(seed)
+        mga = Microbial(run_carbonate.fitnessFunction, run_carbonate.Population, run_carbonate.GenotypeLength,
+                        run_carbonate.RecombProb, run_carbonate.MutatProb, racer=racer, multiFidelity=multiFidelity)
+    misses = mga.cache.misses
+    mga.runTournaments(generations*mga.popsize, report=False)
+    evaluations = mga.cache.misses - misses    # Every cache miss is one run of the fitness function
+    mga.checkpoint(filename, optical_variable=optical_variable, ntrials=run_carbonate.ntrials)
+    return mga.generationsRun, evaluations, time.time()-start
+
+
+class LocalQueue():
+    """Local stand-in for a SLURM queue, backed by a pool of worker processes (one per core by default).
+    submit() returns a job id right away, like sbatch; status() reports the state of a job, like squeue
+    (PENDING, RUNNING, COMPLETED, or FAILED); and result() waits for a job and returns what it returned."""
+
+    def __init__(self, cores=None):
+        if cores is None:
+            cores = os.cpu_count()
+        self.cores = cores
+        self.executor = ProcessPoolExecutor(max_workers=cores)
+        self.jobs = {}    # Job id -> Future
+        self.nextId = 0
+
+
+    def submit(self, function, *args):
+        jobid = self.nextId
+        self.nextId += 1
+        self.jobs[jobid] = self.executor.submit(function, *args)
+        return jobid
+
+
+    def status(self, jobid):
+        future = self.jobs[jobid]
+        if future.running():
+            return 'RUNNING'
+        if not future.done():
+            return 'PENDING'
+        if future.exception() is not None:
+            return 'FAILED'
+        return 'COMPLETED'
+
+
+    def finished(self):
+        """Returns the ids of the jobs that are done (completed or failed)."""
+        return [jobid for jobid, future in self.jobs.items() if future.done()]
+
+
+    def result(self, jobid):
+        """Waits for a job, forgets it, and returns its result (or raises its error)."""
+        return self.jobs.pop(jobid).result()
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class Orchestrator():
+    """Runs every condition in matrix (see conditionMatrix()) for the given number of generations, save_interval
+    generations at a time, with one checkpoint per condition in directory. Conditions that already have a
+    checkpoint there carry on from it. Condition k is seeded with seed+k."""
+
+    def __init__(self, matrix=None, generations=None, save_interval=25, directory='.', cores=None, seed=0):
+        if matrix is None:
+            matrix = conditionMatrix()
+        if generations is None:
+            generations = run_carbonate.Generations
+        self.matrix = matrix
+        self.generations = generations
+        self.save_interval = save_interval
+        self.directory = directory
+        self.seed = seed
+        self.queue = LocalQueue(cores)
+        self.filenames = [checkpointName(directory, name, ov) for name, ov in matrix]
+        self.done = [0 for c in matrix]    # Generations run so far in each condition
+        for k, filename in enumerate(self.filenames):
+            if os.path.exists(filename):
+                self.done[k] = int(readCheckpoint(filename)[1]['generationsRun'])
+        self.rates = [None for c in matrix]    # Measured evaluations/sec of each condition
+        self.evalsPerGen = [None for c in matrix]    # Measured evaluations per generation of each condition
+        self.running = {}    # Job id -> condition
+        self.failed = {}    # Condition -> error, for conditions whose last chunk failed; they are not retried
+
+
+    def timeLeft(self, k):
+        """Estimated time (sec) that condition k still needs on one core. Conditions that have not been
+        measured yet come first."""
+        if self.rates[k] is None:
+            return np.inf
+        return (self.generations - self.done[k])*self.evalsPerGen[k]/self.rates[k]
+
+
+    def schedule(self):
+        """Submits chunks until every core is busy or no condition is waiting. Each condition has at most
+        one chunk running at a time, since chunks of the same condition must run in order."""
+        busy = set(self.running.values())
+        waiting = [k for k in range(len(self.matrix)) if (k not in busy) and (k not in self.failed) and (self.done[k] < self.generations)]
+        waiting.sort(key=self.timeLeft, reverse=True)    # Longest estimated time left first
+        for k in waiting[:self.queue.cores-len(self.running)]:
+            name, ov = self.matrix[k]
+            generations = min(self.save_interval, self.generations-self.done[k])
+            jobid = self.queue.submit(runChunk, name, ov, generations, self.filenames[k], self.seed+k)
+            self.running[jobid] = k
+
+
+    def monitor(self):
+        """Prints the state of every condition."""
+        states = {k: self.queue.status(jobid) for jobid, k in self.running.items()}
+        for k, (name, ov) in enumerate(self.matrix):
+            state = states.get(k, 'COMPLETED' if self.done[k] >= self.generations else 'FAILED' if k in self.failed else 'WAITING')
+            rate = 'n/a' if self.rates[k] is None else '%.1f evals/sec' % self.rates[k]
+            print('%-22s V%i  G%i/%i  %-9s %s' % (name, ov, self.done[k], self.generations, state, rate))
+
+
+    def run(self, interval=60):
+        """Runs the whole sweep, printing the state of every condition every interval seconds."""
+        start = time.time()
+        last_report = start
+        try:
+            self.schedule()
+            while self.running:
+                time.sleep(0.1)
+                for jobid in self.queue.finished():
+                    k = self.running.pop(jobid)
+                    try:
+                        generationsRun, evaluations, seconds = self.queue.result(jobid)
+                    except Exception as error:    # Keep the other conditions going; this one stays at its last checkpoint
+                        print('Condition %s V%i failed: %r' % (self.matrix[k] + (error,)))
+                        self.failed[k] = error
+                        continue
+                    chunk = generationsRun - self.done[k]
+                    self.done[k] = int(generationsRun)
+                    if (evaluations > 0) and (chunk > 0):    # A chunk without evaluations (e.g. all cache hits) says nothing about the rate
+                        self.rates[k] = evaluations/seconds
+                        self.evalsPerGen[k] = evaluations/chunk
+                self.schedule()
+                if time.time()-last_report > interval:
+                    print('\n%f sec elapsed' % (time.time()-start))
+                    self.monitor()
+                    last_report = time.time()
+        finally:
+            self.queue.close()
+        print('\nSweep finished in %f sec' % (time.time()-start))
+        self.monitor()
+
+
+if __name__ == '__main__':
+    cores = None
+    if len(sys.argv) > 1:
+        cores = int(sys.argv[1])    # Defaults to every core on the machine
+    Orchestrator(cores=cores).run()
@@ -0,0 +1,165 @@
+from agentEnv import BatchAgentEnv
+from trajectory import maxSteps
+import simulation
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import itertools
+import os
+
+"""This file contains a sweep engine for perturbation experiments. A perturbation condition is a
+tuple of (kind, magnitude, onset, duration):
+
+    'Position'  magnitude (m) is added to the distance once, on the step at onset (sec)
+    'Velocity'  magnitude (m/sec) is added to the velocity once, on the step at onset
+    'Mapping'   the brake effectiveness is set to magnitude from onset on, for duration sec
+    'Delay'     the motor output is delayed by magnitude steps from onset on, for duration sec
+
+(duration is None for the rest of the trial, and is ignored by the impulse kinds). Each condition is
+turned into per-step schedules, and every trial of every condition runs in lockstep in one
+PerturbedAgentEnv, so a whole grid of conditions costs about as many numpy calls as a single
+perturbationAnalysis() trial. Motor delays are kept in a ring buffer with one row per trial. For
+large grids the conditions can also be split across worker processes. Results come back as a table
+(a structured array) with one row per condition."""
+
+
+kinds = ['Position', 'Velocity', 'Mapping', 'Delay']
+
+resultsDtype = np.dtype([('kind', 'U8'), ('magnitude', float), ('onset', float), ('duration', float), ('fitness', float),
+                         ('successes', int), ('crashes', int), ('early_stops', int), ('timeouts', int)])
+
+
+def conditionGrid(magnitudes, onsets=(0.,), durations=(None,)):
+    """Returns every combination of kind and magnitude (magnitudes is a dictionary of kind -> list of
+    magnitudes) with each onset and duration. Impulse kinds only get one condition per onset, since
+    they have no duration."""
+    conditions = []
+    for kind, values in magnitudes.items():
+        if kind not in kinds:
+            raise ValueError('Unknown perturbation kind %s (should be one of %s)' % (kind, kinds))
+        if kind in ['Position', 'Velocity']:
+            conditions += [(kind, m, onset, None) for m, onset in itertools.product(values, onsets)]
+        else:
+            conditions += [(kind, m, onset, duration) for m, onset, duration in itertools.product(values, onsets, durations)]
+    return conditions
+
+
+def schedules(conditions, steps, Dt):
+    """Turns conditions into per-step schedules, each an array with one row per condition and one
+    column per step: distance and velocity added after the step, brake effectiveness during the
+    step, and motor delay (in steps) during the step."""
+    schedule = emptySchedule(len(conditions), steps)
+    for c, (kind, magnitude, onset, duration) in enumerate(conditions):
+        if kind not in kinds:
+            raise ValueError('Unknown perturbation kind %s (should be one of %s)' % (kind, kinds))
+        start = int(round(onset/Dt))
+        if kind in ['Position', 'Velocity']:
+            if start < steps:
+                schedule[kind][c, start] = magnitude
+        else:
+            stop = steps if duration is None else min(steps, start + int(round(duration/Dt)))
+            schedule[kind][c, start:stop] = magnitude
+    return schedule
+
+
+def emptySchedule(n, steps):
+    """Schedules of n conditions without any perturbation."""
+    return {'Position': np.zeros((n, steps)), 'Velocity': np.zeros((n, steps)), 'Mapping': np.ones((n, steps)),
+            'Delay': np.zeros((n, steps), dtype=int)}
+
+
+def vectorSchedule(kind, perturbations, steps):
+    """Schedule of a single condition given the way analyzedData.perturbationAnalysis() takes it: a
+    vector with a value for every step, applied once that step has been taken (so a Mapping value
+    takes effect on the next step), or for Delay, a number of steps."""
+    if kind not in kinds:
+        raise ValueError('Unknown perturbation kind %s (should be one of %s)' % (kind, kinds))
+    schedule = emptySchedule(1, steps)
+    if kind == 'Delay':
+        schedule['Delay'][0] = perturbations
+    elif kind == 'Mapping':
+        values = np.asarray(perturbations, dtype=float)[:steps-1]
+        schedule['Mapping'][0, 1:len(values)+1] = values
+    else:
+        values = np.asarray(perturbations, dtype=float)[:steps]
+        schedule[kind][0, :len(values)] = values
+    return schedule
+
+
+class PerturbedAgentEnv(BatchAgentEnv):
+    """BatchAgentEnv whose trials each follow the schedules of one perturbation condition (see
+    schedules()). condition holds the condition number of each trial. The motor outputs of the last
+    few steps of each trial are kept in a ring buffer (one row per trial), so a delayed output is a
+    single lookup rather than a list that is shifted every step."""
+
+    def setPerturbations(self, schedule, condition):
+        self.Schedule = {kind: (values if kind == 'Delay' else values.astype(self.dtype, copy=False)) for kind, values in schedule.items()}    # In the agent's precision
+        self.Condition = np.asarray(condition)
+        self.Trial = np.arange(self.ntrials)
+        self.Outputs = np.zeros((self.ntrials, int(schedule['Delay'].max()) + 1), self.dtype)    # Ring buffer of motor outputs
+
+
+    def setInitialState(self, velocity, distance, target_size):
+        BatchAgentEnv.setInitialState(self, velocity, distance, target_size)
+        if hasattr(self, 'Outputs'):
+            self.Outputs[:] = 0.
+
+
+    def step(self, trial_length):
+        """Same as BatchAgentEnv.step(), with the perturbations of this step applied."""
+        i = np.minimum(self.Steps, self.Schedule['Delay'].shape[1] - 1)    # Step number of each trial
+        self.sense()
+        self.think()
+        size = self.Outputs.shape[1]
+        self.Outputs[self.Trial, self.Steps % size] = self.output
+        self.output = np.where(self.Running, self.Outputs[self.Trial, (self.Steps - self.Schedule['Delay'][self.Condition, i]) % size], self.output)
+        self.Brake_effectiveness = self.Schedule['Mapping'][self.Condition, i]
+        running = self.Running.copy()
+        self.act()
+        self.Distance = np.where(running, self.Distance + self.Schedule['Position'][self.Condition, i], self.Distance)
+        self.Velocity = np.where(running, self.Velocity + self.Schedule['Velocity'][self.Condition, i], self.Velocity)
+        self.Running &= (self.Distance > 0) & (self.Velocity > 0.005) & (self.Time < trial_length)
+
+
+def sweep(genotype, conditions, task, jweight=1000):
+    """Runs genotype on the full trial grid under every condition, all in one batch, and returns the
+    results table. task is a dictionary of the task and CTRNN parameters (see taskParams() in run.py).
+    Fitness is computed as in analyzedData.perturbationAnalysis()."""
+    velocities, distances, sizes = simulation.trialGrid(task['target_size'], task['initial_distance'], task['initial_velocity'])
+    n = len(velocities)
+    agent = PerturbedAgentEnv(genotype, task['Size'], task['WeightRange'], task['BiasRange'], task['TimeConstMin'], task['TimeConstMax'],
+                              task['InputWeightRange'], task['Dt'], n*len(conditions), task.get('Precision', 'float64'),
+                              task.get('InputWeights', 'last'))
+    agent.setPerturbations(schedules(conditions, maxSteps(task['trial_length'], task['Dt']), task['Dt']), np.repeat(np.arange(len(conditions)), n))
+    reducers = [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk(), simulation.Outcome(task['trial_length'])]
+    results = simulation.simulate(agent, np.tile(velocities, len(conditions)), np.tile(distances, len(conditions)), np.tile(sizes, len(conditions)),
+                                  task['optical_variable'], task['trial_length'], reducers)
+    fitness = [simulation.distanceVelocityJerk({name: values[c*n:(c+1)*n] for name, values in results.items()}, jweight) for c in range(len(conditions))]
+    outcomes = results['outcome'].reshape(-1, n)
+    table = np.zeros(len(conditions), dtype=resultsDtype)
+    for c, (kind, magnitude, onset, duration) in enumerate(conditions):
+        table[c] = (kind, magnitude, onset, np.nan if duration is None else duration, fitness[c], 0, 0, 0, 0)
+    for field, outcome in [('successes', 'stop'), ('crashes', 'crash'), ('early_stops', 'early stop'), ('timeouts', 'timeout')]:
+        table[field] = (outcomes == simulation.outcomeNames.index(outcome)).sum(axis=1)
+    return table
+
+
+def sweepChunk(args):    # Runs in a worker process
+    return sweep(*args)
+
+
+def parallelSweep(genotype, conditions, task, jweight=1000, workers=None, chunk=16):
+    """Same as sweep(), but splits the conditions into chunks of up to chunk conditions and runs the
+    chunks across workers processes (the number of cores by default)."""
+    if workers is None:
+        workers = os.cpu_count()
+    chunks = [conditions[i:i+chunk] for i in range(0, len(conditions), chunk)]
+    if (workers <= 1) or (len(chunks) <= 1):
+        return np.concatenate([sweep(genotype, c, task, jweight) for c in chunks]) if chunks else np.zeros(0, dtype=resultsDtype)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return np.concatenate(list(executor.map(sweepChunk, [(genotype, c, task, jweight) for c in chunks])))
+
+
+def printTable(table):
+    print('%-9s %9s %7s %8s %10s %9s %7s %11s %8s' % ('Kind', 'Magnitude', 'Onset', 'Duration', 'Fitness', 'Successes', 'Crashes', 'Early stops', 'Timeouts'))
+    for row in table:
+        print('%-9s %9.3f %7.2f %8.2f %10.4f %9i %7i %11i %8i' % tuple(row))
@@ -0,0 +1,131 @@
+from runIndex import runFiles, loadRun
+from racing import jweights
+import run_carbonate
+import simulation
+import numpy as np
+import time
+import sys
+
+"""This file checks what single precision costs. The fixed-step simulation (BatchAgentEnv and its
+BatchCTRNN) can run in float32 instead of float64 (set Precision in run.py or run_carbonate.py), which
+halves the memory each step reads and writes. compare() evaluates genotypes on the full trial grid of
+run_carbonate.py in both precisions and reports, per genotype, the two fitness values, how many trials
+ended in a different way (see simulation.outcomeNames), and how long an evaluation took. Since the
+microbial GA only ever compares two fitness values, it also counts the pairs of genotypes whose order
+changes, i.e. the tournaments float32 would decide differently. compareDirectory() does this for the
+final population of every run in a directory:
+
+    python precision.py Data
+
+Be aware that some differences come from trials that end on a knife edge rather than from a loss of
+accuracy along the way. An agent that brakes at full force takes off the same velocity every step, and
+when that lands exactly on 0, the sign of the last rounding error decides whether the fitness function
+resets the final velocity (see simulation.FinalVelocity)."""
+
+
+precisions = ['float64', 'float32']
+
+
+def evaluate(genotype, fitnessFunction, precision):
+    """Returns the fitness of genotype, the outcome of each of its trials, and the time the evaluation
+    took, with the simulation in the given precision. Fitness and outcomes come from one simulation of
+    the trial grid, so only the KBB15 fitness functions (see racing.jweights) are supported."""
+    run_carbonate.Precision = precision
+    start = time.perf_counter()
+    results = run_carbonate.simulateTrials(genotype, None, [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk(),
+                                                            simulation.Outcome(run_carbonate.trial_length)])
+    fitness = simulation.distanceVelocityJerk(results, jweights[fitnessFunction.__name__])
+    elapsed = time.perf_counter() - start
+    return fitness, results['outcome'], elapsed
+
+
+def compare(genotypes, fitnessFunction, optical_variable, report=True):
+    """Evaluates each genotype with fitnessFunction (one of those in run_carbonate.py) in float64 and in
+    float32, and returns a dictionary of arrays with one entry per genotype: the fitness and evaluation
+    time in each precision, and the number of trials whose outcome differs. 'flipped pairs' holds the
+    fraction of pairs of genotypes whose order by fitness differs between the two. The agent of each
+    precision is built (see run_carbonate.agents) before anything is timed."""
+    if run_carbonate.Tolerance is not None:
+        raise ValueError('Precision only applies to fixed-step Euler, but run_carbonate.Tolerance is set')
+    if fitnessFunction.__name__ not in jweights:
+        raise ValueError('Only %s can be compared, not %s' % (' and '.join(jweights), fitnessFunction.__name__))
+    previous = run_carbonate.Precision, run_carbonate.optical_variable
+    run_carbonate.optical_variable = optical_variable    # The fitness functions read this as a global
+    results = {'%s %s' % (precision, name): [] for precision in precisions for name in ['fitness', 'time']}
+    results['outcome changes'] = []
+    try:
+        if len(genotypes) > 0:
+            for precision in precisions:
+                evaluate(genotypes[0], fitnessFunction, precision)    # Warm up, so that the first timing does not include building the agent
+        for genotype in genotypes:
+            outcomes = {}
+            for precision in precisions:
+                fitness, outcomes[precision], elapsed = evaluate(genotype, fitnessFunction, precision)
+                results['%s fitness' % precision].append(fitness)
+                results['%s time' % precision].append(elapsed)
+            results['outcome changes'].append(np.sum(outcomes['float64'] != outcomes['float32']))
+    finally:
+        run_carbonate.Precision, run_carbonate.optical_variable = previous
+    results = {name: np.array(values) for name, values in results.items()}
+    results['flipped pairs'] = flippedPairs(results['float64 fitness'], results['float32 fitness'])
+    if report:
+        print('%12s %12s %12s %9s %10s %10s' % ('float64 fit', 'float32 fit', 'Difference', 'Outcomes', '64 (ms)', '32 (ms)'))
+        for i in range(len(genotypes)):
+            print('%12f %12f %12f %9i %10.2f %10.2f' % (results['float64 fitness'][i], results['float32 fitness'][i],
+                  results['float32 fitness'][i] - results['float64 fitness'][i], results['outcome changes'][i],
+                  1000*results['float64 time'][i], 1000*results['float32 time'][i]))
+        summarize(results)
+    return results
+
+
+def flippedPairs(a, b):
+    """Returns the fraction of pairs (i, j) that a and b put in a different order (ties count as an order)."""
+    if len(a) < 2:
+        return 0.
+    order_a = np.sign(a[:,None] - a[None,:])
+    order_b = np.sign(b[:,None] - b[None,:])
+    upper = np.triu_indices(len(a), 1)
+    return float(np.average(order_a[upper] != order_b[upper]))
+
+
+def summarize(results, population=True):
+    """Prints the results of compare(). population is False when the genotypes do not come from a single
+    population, in which case whether the best genotype changes is left out."""
+    difference = np.abs(results['float32 fitness'] - results['float64 fitness'])
+    print('Fitness: mean absolute difference %g, max %g' % (np.average(difference), np.max(difference)))
+    if population:
+        print('Best genotype: %s' % ('unchanged' if results['float64 fitness'].argmax() == results['float32 fitness'].argmax() else 'CHANGED'))
+    print('Trials with a different outcome: %i of %i; tournaments decided differently: %.2f%%' % (np.sum(results['outcome changes']),
+          len(difference)*run_carbonate.ntrials, 100*results['flipped pairs']))
+    print('Time per evaluation: %.2f ms (float64), %.2f ms (float32)' % (1000*np.average(results['float64 time']),
+                                                                          1000*np.average(results['float32 time'])))
+
+
+def compareDirectory(directory='Data', report=True):
+    """Runs compare() on the final population of every run in directory that uses a KBB15 fitness
+    function, each with its own fitness function and optical variable. Returns a dictionary of
+    filename -> results, and prints a summary of each run, then of all of them together."""
+    allResults = {}
+    for filename in runFiles(directory):
+        mga, optical_variable = loadRun(filename)
+        if mga.fitnessName() not in jweights:
+            print('Skipping %s (fitness function %s)' % (filename, mga.fitnessName()))
+            continue
+        fitnessFunction = getattr(run_carbonate, mga.fitnessName())
+        results = compare(mga.pop, fitnessFunction, optical_variable, report=False)
+        allResults[filename] = results
+        if report:
+            print(filename)
+            summarize(results)
+            print('')
+    if report and (len(allResults) > 0):
+        print('All runs')
+        combined = {name: np.concatenate([results[name] for results in allResults.values()]) for name in
+                    ['float64 fitness', 'float32 fitness', 'float64 time', 'float32 time', 'outcome changes']}
+        combined['flipped pairs'] = np.average([results['flipped pairs'] for results in allResults.values()])    # Within runs only
+        summarize(combined, population=False)
+    return allResults
+
+
+if __name__ == '__main__':
+    compareDirectory(sys.argv[1] if len(sys.argv) > 1 else 'Data')
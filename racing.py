@@ -0,0 +1,111 @@
+from agentEnv import BatchAgentEnv
+import simulation
+import numpy as np
+import instrument
+
+"""This file contains a racing comparator for tournaments. A tournament only needs to know which of two
+genotypes is fitter, not how fit each one is. Under DistanceVelocity and DistanceVelocityJerk, each
+trial scores 1 - (final distance + final velocity)/2 - jweight*jerk, where the normalized final
+distance and velocity are both in [0, 1] and the jerk can only grow as a trial goes on. So while the
+trials are running, each contestant's fitness is already known to lie within an interval, which
+narrows as trials finish and as jerk accumulates. The racer runs the trials of both contestants in
+lockstep and stops as soon as the two intervals no longer overlap."""
+
+
+jweights = {'DistanceVelocity': 0., 'DistanceVelocityJerk': 1000.}    # Must match the fitness functions in run.py
+
+
+class Racer():
+    """Races genotypes against each other on the full trial grid. fitnessName is the name of the fitness
+    function being raced (DistanceVelocity or DistanceVelocityJerk), and task is the dictionary of task
+    parameters returned by taskParams() in run.py. The bounds are checked every check steps. Trials
+    that were cut short because a race was already decided are counted in self.skipped."""
+
+    def __init__(self, fitnessName, task, check=10):
+        if fitnessName not in jweights:
+            raise ValueError('Racing is only possible for %s, not %s' % (' and '.join(jweights), fitnessName))
+        if task.get('Tolerance') is not None:
+            raise ValueError('Racing simulates with fixed-step Euler, so it cannot be used with adaptive-step integration')
+        self.jweight = jweights[fitnessName]
+        self.task = task
+        self.check = check
+        self.velocities, self.distances, self.sizes = simulation.trialGrid(task['target_size'], task['initial_distance'], task['initial_velocity'])
+        self.ntrials = len(self.velocities)
+        self.maxJerkStep = 3.**2    # Acceleration is between -3 and 0, so one step adds at most this to the jerk
+        self.simulated = 0    # Number of trials that were simulated to the end
+        self.skipped = 0      # Number of trials cut short because the race was already decided
+
+
+    def scores(self, agent, velocities, distances):
+        """Returns the lowest and highest score each trial can still end up with. For trials that have
+        stopped, both are the trial's actual score."""
+        final_distances = np.where(agent.Distance < 0, distances, agent.Distance)/distances    # If agent crashed, reset distance to starting position
+        final_velocities = np.where(agent.Velocity < 0, velocities, agent.Velocity)/velocities    # If agent finishes moving backwards, reset velocity to starting velocity
+        exact = 1 - (final_distances + final_velocities)/2 - self.jweight*agent.Jerk
+        steps_left = (self.task['trial_length'] - agent.Time)/self.task['Dt'] + 2
+        low = np.where(agent.Running, -self.jweight*(agent.Jerk + self.maxJerkStep*steps_left), exact)
+        high = np.where(agent.Running, 1 - self.jweight*agent.Jerk, exact)
+        return low, high
+
+
+    def fitness(self, distance, velocity, jerk):
+        """Fitness from the final distance, velocity, and jerk of every trial in the grid, computed the 
+        same way as in run.py."""
+        final_distances = np.where(distance < 0, self.distances, distance)/self.distances
+        final_velocities = np.where(velocity < 0, self.velocities, velocity)/self.velocities
+        return ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - self.jweight*np.average(jerk)
+
+
+    def compare(self, a, fa, b, fb):
+        """Returns True if genotype a is fitter than genotype b, simulating as little as possible. fa and
+        fb are their fitnesses if already known, or nan if not. Ties go to b, as in Microbial.tournament().
+        Also returns the fitnesses, with any that were unknown filled in, except for a loser whose trials 
+        were cut short (its fitness stays nan). Only the loser is ever cut short: the winner stays in the 
+        population, so its fitness will be needed anyway."""
+        if not np.isnan(fa) and not np.isnan(fb):
+            return fa > fb, fa, fb
+
+        # Stack the trials of every contestant whose fitness is unknown into one batch
+        t = instrument.start()
+        task = self.task
+        n = self.ntrials
+        fits = [fa, fb]
+        racers = [k for k in range(2) if np.isnan(fits[k])]    # Which contestants are being simulated (0 is a, 1 is b)
+        trials = {k: slice(i*n, (i+1)*n) for i, k in enumerate(racers)}     # Where each one's trials are in the batch
+        velocities = np.tile(self.velocities, len(racers))
+        distances = np.tile(self.distances, len(racers))
+        agent = BatchAgentEnv(np.repeat([[a, b][k] for k in racers], n, axis=0), task['Size'], task['WeightRange'], task['BiasRange'], 
+                              task['TimeConstMin'], task['TimeConstMax'], task['InputWeightRange'], task['Dt'], len(racers)*n, task.get('Precision', 'float64'), 
+                              task.get('InputWeights', 'last'))
+        agent.setInitialState(velocities, distances, np.tile(self.sizes, len(racers)))
+        agent.Optical_variable = task['optical_variable']
+        agent.Running &= (agent.Distance > 0) & (agent.Velocity > 0.005) & (agent.Time < task['trial_length'])
+
+        a_wins = None    # Outcome, once decided
+        step = 0
+        while agent.Running.any():
+            if (a_wins is None) and (step % self.check == 0):
+                low, high = self.scores(agent, velocities, distances)
+                bounds = [(f, f) if not np.isnan(f) else (np.average(low[trials[k]]), np.average(high[trials[k]])) for k, f in enumerate(fits)]
+                (low_a, high_a), (low_b, high_b) = bounds
+                margin = 1e-9*(1 + max(abs(high_a), abs(high_b)))   # Allow for rounding
+                if (high_a < low_b - margin) or (low_a > high_b + margin):     # Decided
+                    a_wins = (low_a > high_b + margin)
+                    loser = 1 if a_wins else 0
+                    if loser in trials:     # Stop simulating the loser
+                        cut = np.sum(agent.Running[trials[loser]])
+                        self.skipped += cut
+                        self.simulated += n - cut
+                        agent.Running[trials[loser]] = False
+                        del trials[loser]
+            agent.step(task['trial_length'])
+            step += 1
+
+        for k in trials:    # Every remaining contestant ran to the end
+            fits[k] = self.fitness(agent.Distance[trials[k]], agent.Velocity[trials[k]], agent.Jerk[trials[k]])
+        self.simulated += len(trials)*n
+        if a_wins is None:
+            a_wins = (fits[0] > fits[1])
+        instrument.lap('fitness evaluation (racing)', t)
+        instrument.count('races')
+        return a_wins, fits[0], fits[1]
@@ -1,6 +1,12 @@
-from agentEnv import AgentEnv
+from agentEnv import AgentEnv, AgentPool
 from mga import Microbial
-from tools import save, read
+from tools import read
+from evaluation import PoolEvaluator
+from racing import Racer
+from fidelity import MultiFidelity
+from integrator import AdaptiveAgentEnv
+import simulation
+import instrument
 from matplotlib import pyplot as plt
 import numpy as np
 import time
@@ -9,139 +15,69 @@ import time
 #==========================================    FITNESS FUNCTIONS    ============================================================
 
 
-def FinalDistance(genotype):
+# Every fitness function below is an average over trials of a per-trial score. The optional trials argument is an array of 
+# indices into the trial grid (see trialGrid()); when it is given, only those trials are run and averaged. See fidelity.py.
+# The optional optical_variable argument overrides the global optical_variable (see runIndex.RunFitness).
+
+
+def FinalDistance(genotype, trials=None, optical_variable=None):
     """First version of the fitness function. Here we evolve agents simply on their ability to end 
     the trial near the target - crashes count, too!"""
     
-    final_distances = np.empty(ntrials)
-    i = 0
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                # While distance is still positive, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-    
-                final_distances[i] = agent.Distance
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(reset=False, relative=False)], optical_variable)    # See simulation.py
 
-    return (1 - np.average(final_distances))
+    return (1 - np.average(results['distance']))
 
 
-def FinalDistanceNoCrash(genotype):
+def FinalDistanceNoCrash(genotype, trials=None, optical_variable=None):
     """Second version of the fitness function. Here we evolve agents on their ability to end the 
     trial near the target, WITHOUT crashing. Crashes result in a default fitness of the initial 
     distance."""
     
-    final_distances = np.empty(ntrials)
-    i = 0
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-    
-                if agent.Distance < 0:   # if agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                final_distances[i] = agent.Distance/d   # fitness is proportion of distance
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance()], optical_variable)   # Crashes reset to starting position; fitness is proportion of distance
 
-    return (1 - np.average(final_distances))
+    return (1 - np.average(results['distance']))
 
 
-def DistanceVelocity(genotype):
+def DistanceVelocity(genotype, trials=None, optical_variable=None):
     """Third version of the fitness function. This is the first one used in Kadihasanoglu et al. 2015. 
     Here we evolve agents based on minimizing their final distance and final velocity."""
     
-    final_distances = np.empty(ntrials)
-    final_velocities = np.empty(ntrials)
-    jerks = np.empty(ntrials)
-    i = 0
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                accelerations = []
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-                    accelerations.append(agent.Acceleration)
-    
-                if agent.Distance < 0:   # If agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                if agent.Velocity < 0:   # If agent finishes moving backwards, reset velocity to starting velocity
-                    agent.Velocity = v
-                    
-                final_distances[i] = agent.Distance/d
-                final_velocities[i] = agent.Velocity/v
-                jerks[i] = jerk(accelerations)
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk()], optical_variable)
                 
     jweight = 0.
-    fitness= ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - jweight*np.average(jerks)
-    return fitness
+    return simulation.distanceVelocityJerk(results, jweight)
 
 
-def DistanceVelocityJerk(genotype):
+def DistanceVelocityJerk(genotype, trials=None, optical_variable=None):
     """Fourth and final version of the fitness function. This is the second one used in Kadihasanoglu et al. 2015. 
     Here we evolve agents based on minimizing their final distance, final velocity, and average jerk."""
     
-    final_distances = np.empty(ntrials)
-    final_velocities = np.empty(ntrials)
-    jerks = np.empty(ntrials)
-    i = 0
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                accelerations = []
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-                    accelerations.append(agent.Acceleration)
-    
-                if agent.Distance < 0:   # If agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                if agent.Velocity < 0:   # If agent finishes moving backwards, reset velocity to starting velocity
-                    agent.Velocity = v
-                    
-                final_distances[i] = agent.Distance/d
-                final_velocities[i] = agent.Velocity/v
-                jerks[i] = jerk(accelerations)
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk()], optical_variable)
                 
     jweight = 1000.   # This value is the only difference from the above fitness function DistanceVelocity; empirical value from KBB15
-    fitness= ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - jweight*np.average(jerks)
-    return fitness
+    return simulation.distanceVelocityJerk(results, jweight)
+
+
+def simulateTrials(genotype, trials, reducers, optical_variable=None):   # Sub-function that runs the trial grid (or the trials given) and returns the results of reducers
+    if optical_variable is None:
+        optical_variable = globals()['optical_variable']    # The one set for this run
+    velocities, distances, sizes = trialGrid(trials)
+    agent = newAgent(genotype, len(velocities))
+    return simulation.simulate(agent, velocities, distances, sizes, optical_variable, trial_length, reducers)
+
 
+def newAgent(genotype, trials):   # Sub-function that builds the agent for a batch of trials, using the integrator picked by Tolerance
+    if Tolerance is None:
+        return agents.agent(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, trials, Precision, InputWeights)
+    return AdaptiveAgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, trials, Tolerance, InputWeights)
 
-def jerk(accelerations):   # Sub-function used for calculating total jerk in a series of accelerations
-    jerk = 0
-    for i in range(1, len(accelerations)):
-        jerk += (accelerations[i] - accelerations[i-1])**2
-    return jerk 
+
+agents = AgentPool()    # Agents reused from one evaluation to the next (see agentEnv.py)
+
+
+def trialGrid(trials=None):   # Sub-function that lays out the trial grid as arrays, in the same order as the nested loops used before
+    return simulation.trialGrid(target_size, initial_distance, initial_velocity, trials)   # By default, every trial in the grid
 
 
 #============================================    PARAMETERS     ================================================================
@@ -156,6 +92,8 @@ target_size = [55, 65]               # Limited set of parameters for testing
 initial_distance = [150, 165, 180]   # Limited set of parameters for testing
 initial_velocity = [12, 13]          # Limited set of parameters for testing
 trial_length = 50       # 50 is the KBB15 value (sec)
+Tolerance = None    # Error tolerance for adaptive-step integration, e.g. 1e-3 (see integrator.py); None uses fixed-step Euler like KBB15
+Precision = 'float64'    # dtype of the simulation state; 'float32' halves its memory traffic (see precision.py for the accuracy cost); only used by fixed-step Euler
 optical_variable = 4     # 0-4 are valid values, See AgentEnv class for glossary
 fitnessFunction = DistanceVelocity
 ntrials = len(target_size) * len(initial_distance) * len(initial_velocity) 
@@ -168,6 +106,7 @@ BiasRange = 16
 TimeConstMin = 1
 TimeConstMax = 10
 InputWeightRange = 16
+InputWeights = 'last'    # 'last' gives every neuron the input weight of the last gene, as every run in Data/ was evolved; 'each' gives each neuron its own (see GenotypeLayout in ctrnn.py)
 GenotypeLength = Size*Size + Size*3 
 
 
@@ -178,50 +117,87 @@ RecombProb = 0.5
 MutatProb = 0.1
 Generations = 50 # No KBB15 value reported
 Tournaments = Generations * Population
+Workers = 1    # Number of processes used to evaluate populations; 1 evaluates everything in this process
+Racing = False    # Decide tournaments by simulating as little as possible (see racing.py); only used when Workers is 1
+Fidelity = None    # Trials in each rung below the full grid for multi-fidelity evaluation, e.g. [4] (see fidelity.py); None always uses the full grid; only used when Workers is 1
+Instrument = False    # Record where the time goes and print it with the progress reports (see instrument.py)
 
 
 # ===========================================    RUNTIME FUNCTIONS   ===============================
 
 
+def taskParams():
+    """Returns the task and CTRNN parameters that the fitness functions read as globals, so that they 
+    can be handed to worker processes (see evaluation.py)."""
+    names = ['Dt', 'target_size', 'initial_distance', 'initial_velocity', 'trial_length', 'optical_variable', 
+             'ntrials', 'Tolerance', 'Precision', 'Size', 'WeightRange', 'BiasRange', 'TimeConstMin', 'TimeConstMax', 'InputWeightRange', 
+             'InputWeights']
+    return {name: globals()[name] for name in names}
+
+
 def run_continue(filename, generations, save_interval):
     """Run a set number of tournaments, saving along the way every save_interval generations."""
     start = time.time()
-    mga = read(filename)
+    if filename.endswith('.npz'):    # Checkpoint (see Microbial.checkpoint)
+        mga = Microbial.resume(filename)
+        mga.fitnessFunction = globals()[mga.fitnessName()]
+        filename = filename[:-4]
+    else:    # Pickled Microbial object
+        mga = read(filename)
+    if Workers > 1:
+        mga.evaluator = PoolEvaluator(mga.fitnessFunction, Workers, taskParams())
     for g in range(int(generations/save_interval)):     # Run X generations and save every Y generations
         print('Running generations %i - %i...' % (g*save_interval, (g+1)*save_interval))
         # Run simulation
-        mga.runTournaments(save_interval*mga.popsize, report=True)
+        if Workers > 1:
+            mga.runParallel(save_interval*mga.popsize, report=True)
+        else:
+            mga.runTournaments(save_interval*mga.popsize, report=True)
         # Save data
         generation = int(mga.generationsRun)
         date = mga.dateEdited
         filename = '%s_G%i_%s' % (filename[:-14], generation, date)
-        save(filename, mga)
+        mga.checkpoint(filename + '.npz', optical_variable=optical_variable, ntrials=ntrials)
         print('%f sec elapsed so far \n' % (time.time()-start) )
 
 
 # ===========================================    RUNTIME   =========================================
 
 
-#run_continue('DistanceVelocityJerk_V2_P150_T168_G175_2021-04-28', 25, 25)
-
-
-# Set up  
-start = time.time()
-print('Number of Evaluation Trials: %i' % ntrials)    
-# Run simulation
-mga = Microbial(fitnessFunction, Population, GenotypeLength, RecombProb, MutatProb)
-mga.runTournaments(Tournaments)
-# Save data
-ffname = str(mga.fitnessFunction.__name__)
-generation = int(mga.generationsRun)
-filename = '%s_V%i_test' % ( ffname, optical_variable)
-save(filename, mga)
-#Report runtime
-print('TOTAL TIME ELAPSED: %i sec' % (int(time.time()-start))) 
-# Show graphs and save them too
-mga.showFitness()
-mga.showDiversity()
-# Show trajectories of best individual
-agent = AgentEnv(mga.bestIndividual, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-agent.showTrajectory(optical_variable, target_size[0], initial_distance[0], initial_velocity[0])
-   
\ No newline at end of file
+if __name__ == '__main__':    # Keeps worker processes that import this file from starting runs of their own
+    #run_continue('DistanceVelocityJerk_V2_P150_T168_G175_2021-04-28', 25, 25)
+
+
+    # Set up  
+    start = time.time()
+    if Instrument:
+        instrument.enable()
+    print('Number of Evaluation Trials: %i' % ntrials)    
+    # Run simulation
+    evaluator = None
+    if Workers > 1:
+        evaluator = PoolEvaluator(fitnessFunction, Workers, taskParams())
+    racer = None
+    if Racing and (Workers == 1):    # See Microbial.runParallel()
+        racer = Racer(fitnessFunction.__name__, taskParams())
+    multiFidelity = None
+    if (Fidelity is not None) and (Workers == 1):
+        multiFidelity = MultiFidelity(fitnessFunction, taskParams(), Fidelity)
+    mga = Microbial(fitnessFunction, Population, GenotypeLength, RecombProb, MutatProb, evaluator=evaluator, racer=racer, multiFidelity=multiFidelity)
+    if Workers > 1:
+        mga.runParallel(Tournaments)
+    else:
+        mga.runTournaments(Tournaments)
+    # Save data
+    ffname = str(mga.fitnessFunction.__name__)
+    generation = int(mga.generationsRun)
+    filename = '%s_V%i_test' % ( ffname, optical_variable)
+    mga.checkpoint(filename + '.npz', optical_variable=optical_variable, ntrials=ntrials)    # See Microbial.checkpoint
+    #Report runtime
+    print('TOTAL TIME ELAPSED: %i sec' % (int(time.time()-start))) 
+    # Show graphs and save them too
+    mga.showFitness()
+    mga.showDiversity()
+    # Show trajectories of best individual
+    agent = AgentEnv(mga.bestIndividual, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, InputWeights)
+    agent.showTrajectory(optical_variable, target_size[0], initial_distance[0], initial_velocity[0])
@@ -0,0 +1,220 @@
+from mga import Microbial
+from tools import readSidecar, saveSidecar, SIDECAR_FIELDS
+import run_carbonate
+import numpy as np
+import pickle
+import re
+import os
+
+"""This file contains an index over the runs saved in a directory. Every checkpoint gets a small
+JSON sidecar when it is saved (see tools.saveCheckpoint()), holding the fitness function, optical
+variable, population size, number of trials, generations run, and best and average fitness. Older
+runs (pickled Microbial objects) are given one the first time the directory is indexed, and a
+sidecar is rewritten whenever its run file has changed. After that, runs can be listed and filtered
+by reading the sidecars only:
+
+    index = RunIndex('Data')
+    index.find(fitness='DistanceVelocityJerk', generationsRun=lambda g: g >= 75)
+
+and index.open() returns a LazyRun, which reads the population or the histories of a run only when
+they are first used."""
+
+
+fitnessNames = ['FinalDistance', 'FinalDistanceNoCrash', 'DistanceVelocity', 'DistanceVelocityJerk']
+runName = re.compile(r'^(?P<fitness>[A-Za-z]+)_V(?P<optical_variable>\d+)(?:_P(?P<popsize>\d+)_T(?P<ntrials>\d+))?')    # See run_checkpointing(); run.py's own runs are just <fitness>_V<n>_test
+
+
+class RunUnpickler(pickle.Unpickler):
+    """Runs were pickled from run.py or run_carbonate.py as the main script, so their fitness function
+    is stored as __main__.<name>. This looks such names up in run_carbonate.py instead, so that runs
+    can be loaded from any script or worker process."""
+
+    def find_class(self, module, name):
+        if (module == '__main__') and (name in fitnessNames):
+            return getattr(run_carbonate, name)
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def runFiles(directory):
+    """Returns the saved runs in directory (pickled Microbial objects and .npz checkpoints), whose names
+    start with the name of a fitness function and the optical variable (e.g. DistanceVelocity_V2_...; see
+    runName)."""
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.endswith('.tmp') or name.endswith('.json') or ('_Analyzed' in name) or ('_Trajectories' in name):
+            continue
+        match = runName.match(name)
+        if (match is not None) and (match.group('fitness') in fitnessNames):
+            files.append(path)
+    return files
+
+
+def parseName(filename):
+    """Returns what the name of a run file says about it (fitness function, optical variable, and if
+    given, population size and number of trials), or an empty dictionary if it does not follow the
+    naming scheme."""
+    match = runName.match(os.path.basename(filename))
+    if match is None:
+        return {}
+    info = {name: value for name, value in match.groupdict().items() if value is not None}
+    return {name: (value if name == 'fitness' else int(value)) for name, value in info.items()}
+
+
+class RunFitness():
+    """Fitness function of a loaded run, bound to the run's optical variable. The fitness functions of 
+    run.py and run_carbonate.py otherwise read the optical variable from a global of their module, 
+    which is whatever the last run set it to. Calls go to function(genotype, trials, optical_variable=...), 
+    and __name__ is the function's, so Microbial.fitnessName() still works."""
+
+    def __init__(self, function, optical_variable):
+        self.function = function
+        self.optical_variable = optical_variable
+        self.__name__ = function.__name__
+
+
+    def __call__(self, genotype, trials=None):
+        return self.function(genotype, trials, optical_variable=self.optical_variable)
+
+
+def loadRun(filename, fitnessFunction=None):
+    """Returns the Microbial object saved in filename (pickle or checkpoint), and its optical variable.
+    fitnessFunction is only used for checkpoints (see Microbial.resume()). The run's fitness function is 
+    bound to its optical variable (see RunFitness)."""
+    if filename.endswith('.npz'):
+        mga = Microbial.resume(filename, fitnessFunction, restoreRandom=False)
+        optical_variable = mga.metadata['optical_variable']
+    else:
+        file_object = open(filename, 'rb')
+        mga = RunUnpickler(file_object, encoding='bytes').load()
+        file_object.close()
+        info = parseName(filename)
+        if 'optical_variable' not in info:
+            raise ValueError('Cannot tell the optical variable of %s from its name (should start with <fitness function>_V<n>)' % filename)
+        optical_variable = info['optical_variable']
+    if (mga.fitnessFunction is not None) and not isinstance(mga.fitnessFunction, RunFitness):
+        mga.fitnessFunction = RunFitness(mga.fitnessFunction, optical_variable)
+    return mga, optical_variable
+
+
+def describeRun(filename):
+    """Loads the run saved in filename and writes its sidecar. Returns the sidecar's contents."""
+    mga, optical_variable = loadRun(filename)
+    info = parseName(filename)
+    info.update({'fitness': mga.fitnessName(), 'optical_variable': optical_variable, 'popsize': mga.popsize, 'genesize': mga.genesize,
+                 'generationsRun': getattr(mga, 'generationsRun', None), 'dateCreated': getattr(mga, 'dateCreated', None),
+                 'dateEdited': getattr(mga, 'dateEdited', None)})
+    if filename.endswith('.npz'):
+        info['ntrials'] = mga.metadata.get('ntrials', info.get('ntrials'))
+    if len(mga.bestHistory) > 0:
+        info.update({'bestFitness': float(mga.bestHistory[-1]), 'avgFitness': float(mga.avgHistory[-1])})
+    info = {name: info.get(name) for name in SIDECAR_FIELDS}
+    info['arrays'] = {'pop': list(np.shape(mga.pop))}
+    for name in ['avgHistory', 'bestHistory', 'divHistory', 'conHistory']:
+        info['arrays'][name] = [len(getattr(mga, name, []))]
+    saveSidecar(filename, info, 'npz' if filename.endswith('.npz') else 'pickle')
+    return readSidecar(filename)
+
+
+class RunIndex():
+    """Index of the runs saved in directory, built from their sidecars. Runs without an up-to-date
+    sidecar are loaded once to write one (unless rebuild is False, in which case they are left out).
+    self.entries holds one dictionary per run: the sidecar, plus the run's filename under 'file'."""
+
+    def __init__(self, directory, rebuild=True):
+        self.directory = directory
+        self.entries = []
+        self.refresh(rebuild)
+
+
+    def refresh(self, rebuild=True):
+        """Reads the sidecars again, e.g. after more runs have been saved."""
+        self.entries = []
+        for filename in runFiles(self.directory):
+            info = readSidecar(filename)
+            if (info is None) and rebuild:
+                info = describeRun(filename)
+            if info is not None:
+                self.entries.append(dict(info, file=filename))
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def find(self, **criteria):
+        """Returns the entries that match every criterion. A criterion is either a value, which the
+        entry's field must equal, or a function of the field's value that returns True for a match,
+        e.g. find(optical_variable=2, bestFitness=lambda f: f > 0.5)."""
+        matches = []
+        for entry in self.entries:
+            for name, wanted in criteria.items():
+                value = entry.get(name)
+                if callable(wanted):
+                    if (value is None) or not wanted(value):
+                        break
+                elif value != wanted:
+                    break
+            else:
+                matches.append(entry)
+        return matches
+
+
+    def best(self, **criteria):
+        """Returns the entry with the highest bestFitness among those that match criteria (see find())."""
+        matches = [entry for entry in self.find(**criteria) if entry.get('bestFitness') is not None]
+        if len(matches) == 0:
+            return None
+        return max(matches, key=lambda entry: entry['bestFitness'])
+
+
+    def open(self, entry):
+        """Returns a LazyRun for an entry (or a filename)."""
+        if isinstance(entry, str):
+            return LazyRun(entry)
+        return LazyRun(entry['file'], entry)
+
+
+class LazyRun():
+    """Handle on a saved run whose sidecar fields (fitness, optical_variable, generationsRun, etc.) are
+    attributes right away, while the population, histories, and everything else are only read from the
+    file when first used. For checkpoints, each array is read on its own, since .npz members can be
+    loaded separately; a pickle has to be loaded whole, which happens once, on first use."""
+
+    arrayNames = ['pop', 'bestIndividual', 'avgHistory', 'bestHistory', 'divHistory', 'conHistory', 'fidelity']
+
+    def __init__(self, filename, info=None):
+        self.filename = filename
+        if info is None:
+            info = readSidecar(filename)
+            if info is None:
+                info = describeRun(filename)
+        self.info = info
+        self.run = None    # The whole Microbial object, once it has been loaded
+
+
+    def __getattr__(self, name):    # Only called for attributes that have not been set yet
+        if name in ['filename', 'info', 'run']:
+            raise AttributeError(name)
+        if name in self.info:
+            return self.info[name]
+        if self.filename.endswith('.npz') and (name in self.arrayNames):
+            archive = np.load(self.filename, allow_pickle=False)
+            if name not in archive.files:
+                archive.close()
+                raise AttributeError('%s has no %s' % (self.filename, name))
+            value = archive[name]
+            archive.close()
+        else:
+            if self.run is None:
+                self.run = loadRun(self.filename)[0]
+            value = getattr(self.run, name)
+        setattr(self, name, value)    # Keep it, so that the file is only read once
+        return value
+
+
+    def load(self):
+        """Returns the whole Microbial object."""
+        if self.run is None:
+            self.run = loadRun(self.filename)[0]
+        return self.run
@@ -1,6 +1,12 @@
-from agentEnv import AgentEnv
+from agentEnv import AgentPool
 from mga import Microbial
-from tools import save, read
+from tools import read
+from evaluation import PoolEvaluator
+from racing import Racer
+from fidelity import MultiFidelity
+from integrator import AdaptiveAgentEnv
+import simulation
+import instrument
 from matplotlib import pyplot as plt
 import numpy as np
 import time
@@ -13,143 +19,69 @@ fitness functions. """
 #==========================================    FITNESS FUNCTIONS    ============================================================
 
 
-def FinalDistance(genotype):
+# Every fitness function below is an average over trials of a per-trial score. The optional trials argument is an array of 
+# indices into the trial grid (see trialGrid()); when it is given, only those trials are run and averaged. See fidelity.py.
+# The optional optical_variable argument overrides the global optical_variable (see runIndex.RunFitness).
+
+
+def FinalDistance(genotype, trials=None, optical_variable=None):
     """First version of the fitness function. Here we evolve agents simply on their ability to end 
     the trial near the target - crashes count, too!"""
     
-    final_distances = np.empty(ntrials)
-    i = 0
-    
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                # While distance is still positive, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-    
-                final_distances[i] = agent.Distance
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(reset=False, relative=False)], optical_variable)    # See simulation.py
 
-    return (1 - np.average(final_distances))
+    return (1 - np.average(results['distance']))
 
 
-def FinalDistanceNoCrash(genotype):
+def FinalDistanceNoCrash(genotype, trials=None, optical_variable=None):
     """Second version of the fitness function. Here we evolve agents on their ability to end the 
     trial near the target, WITHOUT crashing. Crashes result in a default fitness of the initial 
     distance."""
     
-    final_distances = np.empty(ntrials)
-    i = 0
-    
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-    
-                if agent.Distance < 0:   # if agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                final_distances[i] = agent.Distance/d   # fitness is proportion of distance
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance()], optical_variable)   # Crashes reset to starting position; fitness is proportion of distance
 
-    return (1 - np.average(final_distances))
+    return (1 - np.average(results['distance']))
 
 
-def DistanceVelocity(genotype):
+def DistanceVelocity(genotype, trials=None, optical_variable=None):
     """Third version of the fitness function. This is the first one used in Kadihasanoglu et al. 2015. 
     Here we evolve agents based on minimizing their final distance and final velocity."""
     
-    final_distances = np.empty(ntrials)
-    final_velocities = np.empty(ntrials)
-    jerks = np.empty(ntrials)
-    i = 0
-    
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                accelerations = []
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-                    accelerations.append(agent.Acceleration)
-    
-                if agent.Distance < 0:   # If agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                if agent.Velocity < 0: 
-                    agent.Velocity = v
-                    
-                final_distances[i] = agent.Distance/d
-                final_velocities[i] = agent.Velocity/v
-                jerks[i] = jerk(accelerations)
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk()], optical_variable)
                 
     jweight = 0.
-    fitness= ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - jweight*np.average(jerks)
-    return fitness
+    return simulation.distanceVelocityJerk(results, jweight)
 
 
-def DistanceVelocityJerk(genotype):
+def DistanceVelocityJerk(genotype, trials=None, optical_variable=None):
     """Fourth and final version of the fitness function. This is the second one used in Kadihasanoglu et al. 2015. 
     Here we evolve agents based on minimizing their final distance, final velocity, and average jerk."""
     
-    final_distances = np.empty(ntrials)
-    final_velocities = np.empty(ntrials)
-    jerks = np.empty(ntrials)
-    i = 0
-    
-    agent = AgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt)
-    for ts in target_size:
-        for d in initial_distance:
-            for v in initial_velocity:  
-                agent.setInitialState(v, d, ts)
-                agent.Optical_variable = optical_variable
-                accelerations = []
-                # While agent hasn't crashed, agent is still moving forward significantly, and not too much time has elapsed
-                while (agent.Distance > 0) and (agent.Velocity > 0.005) and (agent.Time < trial_length):
-                    agent.sense()
-                    agent.think()
-                    agent.act()
-                    accelerations.append(agent.Acceleration)
-    
-                if agent.Distance < 0:   # if agent crashed, reset distance to starting position
-                    agent.Distance = d
-                    
-                if agent.Velocity < 0: 
-                    agent.Velocity = v
-                    
-                final_distances[i] = agent.Distance/d
-                final_velocities[i] = agent.Velocity/v
-                jerks[i] = jerk(accelerations)
-                i += 1
+    results = simulateTrials(genotype, trials, [simulation.FinalDistance(), simulation.FinalVelocity(), simulation.SquaredJerk()], optical_variable)
                 
     jweight = 1000.   # This value is the only difference from the above fitness function DistanceVelocity; empirical value from KBB15
-    fitness= ( (1-np.average(final_distances)) + (1-np.average(final_velocities)) )/2 - jweight*np.average(jerks)
-    return fitness
+    return simulation.distanceVelocityJerk(results, jweight)
 
 
-def jerk(accelerations):
-    jerk = 0
-    for i in range(1, len(accelerations)):
-        jerk += (accelerations[i] - accelerations[i-1])**2
-    return jerk 
+def simulateTrials(genotype, trials, reducers, optical_variable=None):   # Sub-function that runs the trial grid (or the trials given) and returns the results of reducers
+    if optical_variable is None:
+        optical_variable = globals()['optical_variable']    # The one set for this run
+    velocities, distances, sizes = trialGrid(trials)
+    agent = newAgent(genotype, len(velocities))
+    return simulation.simulate(agent, velocities, distances, sizes, optical_variable, trial_length, reducers)
+
+
+def newAgent(genotype, trials):   # Sub-function that builds the agent for a batch of trials, using the integrator picked by Tolerance
+    if Tolerance is None:
+        return agents.agent(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, trials, Precision, InputWeights)
+    return AdaptiveAgentEnv(genotype, Size, WeightRange, BiasRange, TimeConstMin, TimeConstMax, InputWeightRange, Dt, trials, Tolerance, InputWeights)
+
+
+agents = AgentPool()    # Agents reused from one evaluation to the next (see agentEnv.py)
+
+
+def trialGrid(trials=None):   # Sub-function that lays out the trial grid as arrays, in the same order as the nested loops used before
+    return simulation.trialGrid(target_size, initial_distance, initial_velocity, trials)   # By default, every trial in the grid
 
 
 #============================================    PARAMETERS     ================================================================
@@ -164,6 +96,8 @@ initial_velocity = [10, 11, 12, 13, 14, 15]
 #initial_distance = [150, 165, 180]   # Limited set of parameters for testing
 #initial_velocity = [12, 13]          # Limited set of parameters for testing
 trial_length = 50 # (sec), 50 is the DBB15 value
+Tolerance = None    # Error tolerance for adaptive-step integration, e.g. 1e-3 (see integrator.py); None uses fixed-step Euler like KBB15
+Precision = 'float64'    # dtype of the simulation state; 'float32' halves its memory traffic (see precision.py for the accuracy cost); only used by fixed-step Euler
 optical_variable = 0
 fitnessFunction = DistanceVelocity
 ntrials = len(target_size) * len(initial_distance) * len(initial_velocity) 
@@ -176,6 +110,7 @@ BiasRange = 16
 TimeConstMin = 1
 TimeConstMax = 10
 InputWeightRange = 16
+InputWeights = 'last'    # 'last' gives every neuron the input weight of the last gene, as every run in Data/ was evolved; 'each' gives each neuron its own (see GenotypeLayout in ctrnn.py)
 GenotypeLength = Size*Size + Size*3 
 
 
@@ -185,42 +120,83 @@ Population = 150    # KBB15 value is 150
 RecombProb = 0.5
 MutatProb = 0.1
 Generations = 200 # No KBB15 value reported
+Workers = 1    # Number of processes used to evaluate populations; 1 evaluates everything in this process
+Racing = False    # Decide tournaments by simulating as little as possible (see racing.py); only used when Workers is 1
+Fidelity = None    # Trials in each rung below the full grid for multi-fidelity evaluation, e.g. [12, 42] (see fidelity.py); None always uses the full grid; only used when Workers is 1
+Instrument = False    # Record where the time goes and print it with the progress reports (see instrument.py)
 
 
 # ======================================    RUNTIME FUNCTIONS ======================================
 
 
+def taskParams():
+    """Returns the task and CTRNN parameters that the fitness functions read as globals, so that they 
+    can be handed to worker processes (see evaluation.py)."""
+    names = ['Dt', 'target_size', 'initial_distance', 'initial_velocity', 'trial_length', 'optical_variable', 
+             'ntrials', 'Tolerance', 'Precision', 'Size', 'WeightRange', 'BiasRange', 'TimeConstMin', 'TimeConstMax', 'InputWeightRange', 
+             'InputWeights']
+    return {name: globals()[name] for name in names}
+
+
+def condition(i):
+    """Returns the fitness function and optical variable of condition i (0-9). Conditions 0-4 use 
+    DistanceVelocity and 5-9 use DistanceVelocityJerk, each with optical variables 0-4."""
+    if i < 5:   # Half of the conditions should be with DistanceVelocity FF
+        return DistanceVelocity, i
+    elif 5 <= i < 10: # Other half should be with DistanceVelocityJerk FF
+        return DistanceVelocityJerk, i-5
+    else:
+        raise ValueError('Condition %i is out of bounds (0-9)' % i)
+
+
+def evaluationOptions():
+    """Returns the racer and multi-fidelity evaluator set up by the Racing and Fidelity parameters 
+    (either can be None). Both are None when Workers is more than 1, since Microbial.runParallel() 
+    evaluates every offspring on the full grid."""
+    if Workers > 1:
+        return None, None
+    racer = None
+    if Racing:
+        racer = Racer(fitnessFunction.__name__, taskParams())
+    multiFidelity = None
+    if Fidelity is not None:
+        multiFidelity = MultiFidelity(fitnessFunction, taskParams(), Fidelity)
+    return racer, multiFidelity
+
+
 def run_checkpointing(save_interval):
     """Run a set number of tournaments, saving along the way every save_interval generations."""
     start = time.time()
     print('Iterator: %i' % i)  # For reading error files
-    mga = Microbial(fitnessFunction, Population, GenotypeLength, RecombProb, MutatProb)
+    if Instrument:
+        instrument.enable()
+    evaluator = None
+    if Workers > 1:
+        evaluator = PoolEvaluator(fitnessFunction, Workers, taskParams())
+    racer, multiFidelity = evaluationOptions()
+    mga = Microbial(fitnessFunction, Population, GenotypeLength, RecombProb, MutatProb, evaluator=evaluator, racer=racer, multiFidelity=multiFidelity)
     for g in range(int(Generations/save_interval)):     # Run X generations and save every Y generations
         print('Running generations %i - %i...' % (g*save_interval, (g+1)*save_interval))
         # Run simulation
-        mga.runTournaments(save_interval*Population, report=True)
+        if Workers > 1:
+            mga.runParallel(save_interval*Population, report=True)
+        else:
+            mga.runTournaments(save_interval*Population, report=True)
         # Save data
-        ffname = str(mga.fitnessFunction.__name__)
+        ffname = mga.fitnessName()
         generation = int(mga.generationsRun)
         popsize = mga.popsize
         date = mga.dateCreated
         filename = '%s_V%i_P%i_T%i_G%i_%s' % ( ffname, optical_variable, popsize, ntrials, generation, date)
-        save(filename, mga)
+        mga.checkpoint(filename + '.npz', optical_variable=optical_variable, ntrials=ntrials)    # See Microbial.checkpoint
         print('%f sec elapsed so far \n' % (time.time()-start) )
 
 
 # ===========================================    RUNTIME    ========================================
 
 
-i = int(sys.argv[1])    # Gets sys arg from conditions.sh file, i iterates from 0-9
-
-if i < 5:   # Half of the conditions should be with DistanceVelocity FF
-    fitnessFunction = DistanceVelocity
-    optical_variable = i
-elif 5 <= i < 10: # Other half should be with DistanceVelocityJerk FF
-    fitnessFunction = DistanceVelocityJerk
-    optical_variable = i-5
-else:
-    print('ERROR: i is out of bounds.')
+if __name__ == '__main__':    # Keeps worker processes that import this file from starting runs of their own
+    i = int(sys.argv[1])    # Gets sys arg from conditions.sh file, i iterates from 0-9
+    fitnessFunction, optical_variable = condition(i)    # See orchestrator.py for running all of them on one machine
 
-run_checkpointing(25)    # Run tournaments, all the while saving data every 25 gens
+    run_checkpointing(25)    # Run tournaments, all the while saving data every 25 gens
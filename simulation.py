@@ -0,0 +1,153 @@
+import numpy as np
+
+"""This file contains the simulation loop shared by the fitness functions, the analyses, and the
+trajectory store, along with the reducers that turn a batch of trials into results. simulate() sets
+up the trials of a BatchAgentEnv (or any of its variants), runs them to their stop condition, and
+hands back one result per reducer, each an array with one entry per trial. A reducer only keeps O(1)
+state per trial, whatever the length of the trials:
+
+    FinalDistance, FinalVelocity    read the final state, optionally reset and made relative
+    SquaredJerk                     the running sum of squared changes in acceleration
+    Outcome                         how each trial ended (see outcomeNames)
+    Trajectory                      records every step into a TrajectoryRecorder (for plots)
+
+Reducers that need to see every step (streaming = True) get update() after each step; the rest are
+only asked for their result at the end, so the loop runs at full speed unless something streams.
+A fitness function is then a combination of reducer results, e.g. distanceVelocityJerk()."""
+
+
+outcomeNames = ['early stop', 'crash', 'timeout', 'stop']    # Outcome codes, in order
+
+
+class Reducer():
+    """Base class of the reducers. name is the key of the result in the dictionary simulate() returns.
+    Subclasses must define result(agent, velocities, distances), which returns the result once every
+    trial has stopped, given the initial velocities and distances of the trials."""
+    name = None
+    streaming = False
+
+    def start(self, agent):
+        """Called once the trials are set up, before the first step."""
+        pass
+
+    def update(self, agent, took):
+        """Called after every step of a streaming reducer; took marks the trials that took the step."""
+        pass
+
+
+class FinalDistance(Reducer):
+    """Distance to the target at the end of each trial. With reset, a crash counts as the initial
+    distance; with relative, distances are divided by the initial distance."""
+    name = 'distance'
+
+    def __init__(self, reset=True, relative=True):
+        self.reset = reset
+        self.relative = relative
+
+    def result(self, agent, velocities, distances):
+        final = agent.Distance
+        if self.reset:
+            final = np.where(final < 0, distances, final)    # If agent crashed, reset distance to starting position
+        if self.relative:
+            final = final/distances
+        return final
+
+
+class FinalVelocity(Reducer):
+    """Velocity at the end of each trial. With reset, finishing backwards counts as the initial velocity;
+    with relative, velocities are divided by the initial velocity."""
+    name = 'velocity'
+
+    def __init__(self, reset=True, relative=True):
+        self.reset = reset
+        self.relative = relative
+
+    def result(self, agent, velocities, distances):
+        final = agent.Velocity
+        if self.reset:
+            final = np.where(final < 0, velocities, final)    # If agent finishes moving backwards, reset velocity to starting velocity
+        if self.relative:
+            final = final/velocities
+        return final
+
+
+class SquaredJerk(Reducer):
+    """Sum of squared changes in acceleration over each trial. The agent keeps this sum itself as it
+    steps (see BatchAgentEnv.act()), since racing needs it while the trials are still running."""
+    name = 'jerk'
+
+    def result(self, agent, velocities, distances):
+        return agent.Jerk
+
+
+class Outcome(Reducer):
+    """Index into outcomeNames of how each trial ended (see BatchAgentEnv.outcomeMasks())."""
+    name = 'outcome'
+
+    def __init__(self, trial_length):
+        self.trial_length = trial_length
+
+    def result(self, agent, velocities, distances):
+        masks = agent.outcomeMasks(self.trial_length)
+        codes = np.zeros(agent.ntrials, dtype=int)
+        for code, outcome in enumerate(outcomeNames):
+            codes[masks[outcome]] = code
+        return codes
+
+
+class Trajectory(Reducer):
+    """Records every step of every trial into recorder (a TrajectoryRecorder with one trajectory per
+    trial), and returns it."""
+    name = 'trajectory'
+    streaming = True
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def start(self, agent):
+        self.recorder.reset()
+
+    def update(self, agent, took):
+        self.recorder.recordBatch(agent)
+
+    def result(self, agent, velocities, distances):
+        return self.recorder
+
+
+def trialGrid(target_size, initial_distance, initial_velocity, trials=None):
+    """Lays out the trial grid (every combination of target size, initial distance, and initial velocity)
+    as arrays of initial velocities, initial distances, and target sizes, in the same order as the nested
+    loops used before. trials is an optional array of indices into the grid; only those trials are
+    returned when it is given."""
+    sizes, distances, velocities = np.meshgrid(target_size, initial_distance, initial_velocity, indexing='ij')
+    velocities, distances, sizes = velocities.ravel(), distances.ravel(), sizes.ravel()
+    if trials is not None:
+        velocities, distances, sizes = velocities[trials], distances[trials], sizes[trials]
+    return velocities.astype(float), distances.astype(float), sizes.astype(float)
+
+
+def simulate(agent, velocities, distances, sizes, optical_variable, trial_length, reducers):
+    """Runs one trial per entry of velocities, distances, and sizes on agent, and returns a dictionary
+    of the result of each reducer."""
+    agent.setInitialState(velocities, distances, sizes)
+    agent.Optical_variable = optical_variable
+    for reducer in reducers:
+        reducer.start(agent)
+    streaming = [reducer for reducer in reducers if reducer.streaming]
+    if len(streaming) > 0:
+        agent.run(trial_length, streaming)
+    else:
+        agent.run(trial_length)    # Run every trial in lockstep until each one stops
+    return {reducer.name: reducer.result(agent, velocities, distances) for reducer in reducers}
+
+
+def outcomeCounts(outcomes):
+    """Returns how many trials ended in each way, given the result of Outcome."""
+    counts = np.bincount(outcomes, minlength=len(outcomeNames))
+    return {name: int(counts[code]) for code, name in enumerate(outcomeNames)}
+
+
+def distanceVelocityJerk(results, jweight):
+    """Fitness of KBB15 (DistanceVelocity when jweight is 0, DistanceVelocityJerk when it is 1000), from
+    the results of FinalDistance, FinalVelocity, and SquaredJerk."""
+    return ( (1-np.average(results['distance'])) + (1-np.average(results['velocity'])) )/2 - jweight*np.average(results['jerk'])
@@ -1,7 +1,21 @@
 import pickle 
+import numpy as np
+import json
+import os
+import threading
+import time
+import sys
 
 """This file contains some very short wrappers for the pickle module that can be used to easily 
-save and read data, particularly when working with binary files."""
+save and read data, particularly when working with binary files. It also contains the checkpoint 
+format used by Microbial.checkpoint() and Microbial.resume(): a NumPy .npz archive of plain arrays 
+plus a JSON string of metadata, which (unlike a pickle) can be read without importing run.py. Next to
+every checkpoint goes a small JSON sidecar (see runIndex.py) with the few numbers needed to list and
+filter runs without opening them."""
+
+CHECKPOINT_VERSION = 1    # Bump whenever the layout of checkpoint arrays changes
+SIDECAR_FIELDS = ['fitness', 'optical_variable', 'popsize', 'genesize', 'ntrials', 'generationsRun', 'bestFitness', 
+                  'avgFitness', 'dateCreated', 'dateEdited']    # Metadata copied into the sidecar of a checkpoint
 
 def save(filename, item):
     file_object = open((str(filename)), 'wb')    # Create file object with filename
@@ -11,3 +25,137 @@ def save(filename, item):
 
 def read(filename):
     return pickle.load(open(filename, "rb"), encoding='bytes')
+
+def saveCheckpoint(filename, arrays, metadata):
+    """Writes a dictionary of numpy arrays and a dictionary of metadata (anything JSON can hold) to 
+    filename. The file is written under a temporary name first and then renamed, so a crash part way 
+    through a save never leaves a broken checkpoint behind."""
+    metadata = dict(metadata, version=CHECKPOINT_VERSION)
+    temp = '%s.tmp' % filename
+    file_object = open(temp, 'wb')
+    np.savez(file_object, metadata=np.array(json.dumps(metadata)), **arrays)
+    file_object.flush()
+    os.fsync(file_object.fileno())    # Make sure the data is on disk before the rename
+    file_object.close()
+    os.replace(temp, filename)    # Atomic, so readers see either the old checkpoint or the new one
+    info = {name: metadata[name] for name in SIDECAR_FIELDS if name in metadata}
+    info['arrays'] = {name: list(np.shape(array)) for name, array in arrays.items()}
+    saveSidecar(filename, info, 'npz')
+
+def sidecarName(filename):
+    return '%s.json' % filename
+
+def saveSidecar(filename, info, format):
+    """Writes info (a dictionary) to the sidecar of the run saved in filename, along with the format of 
+    the run file and its size and modification time, which tell whether the sidecar is still up to 
+    date (see readSidecar())."""
+    stat = os.stat(filename)
+    info = dict(info, format=format, size=stat.st_size, mtime=stat.st_mtime)
+    temp = '%s.tmp' % sidecarName(filename)
+    file_object = open(temp, 'w')
+    json.dump(info, file_object)
+    file_object.close()
+    os.replace(temp, sidecarName(filename))
+
+def readSidecar(filename):
+    """Returns the sidecar of the run saved in filename, or None if it has none or the run file has 
+    changed since the sidecar was written."""
+    try:
+        info = json.load(open(sidecarName(filename)))
+        stat = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    if (info.get('size') != stat.st_size) or (info.get('mtime') != stat.st_mtime):
+        return None
+    return info
+
+def readCheckpoint(filename):
+    """Returns the arrays and metadata written by saveCheckpoint(), as two dictionaries."""
+    archive = np.load(filename, allow_pickle=False)
+    metadata = json.loads(str(archive['metadata']))
+    if metadata['version'] > CHECKPOINT_VERSION:
+        raise ValueError('%s is a version %i checkpoint; this code reads up to version %i' % (filename, metadata['version'], CHECKPOINT_VERSION))
+    arrays = {name: archive[name] for name in archive.files if name != 'metadata'}
+    archive.close()
+    return arrays, metadata
+
+class CheckpointWriter():
+    """Writes checkpoints on a background thread, so that the caller can carry on working while a 
+    file is being written. submit() hands over a snapshot (copies of the arrays, e.g. from 
+    Microbial.snapshot()) and returns right away. If a new snapshot arrives while an older one is 
+    still waiting, only the newer one is written, and the older one is counted in self.skipped. For 
+    every save, self.saves records the filename, how long writing took, and the lag: how long after 
+    the snapshot was taken the file was in place (sec). If a save fails, the error is raised again in 
+    the caller's thread by the next call to submit(), flush(), or close(), except that close() only 
+    prints it when another exception (e.g. a KeyboardInterrupt) is already on its way up."""
+
+    def __init__(self):
+        self.pending = None    # Next snapshot to write, with the time it was taken
+        self.writing = False
+        self.closed = False
+        self.saves = []
+        self.skipped = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, filename, arrays, metadata):
+        self.check()
+        with self.condition:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (filename, arrays, metadata, time.time())
+            self.condition.notify_all()
+
+    def work(self):    # Runs on the background thread
+        while True:
+            with self.condition:
+                while (self.pending is None) and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:    # Closed, and nothing left to write
+                    return
+                filename, arrays, metadata, taken = self.pending
+                self.pending = None
+                self.writing = True
+            started = time.time()
+            failed = False
+            try:
+                saveCheckpoint(filename, arrays, metadata)
+            except Exception as error:    # Handed back to the caller by check()
+                self.error = error
+                failed = True
+            finished = time.time()
+            with self.condition:
+                if not failed:    # Record this save even if an earlier one failed
+                    self.saves.append((filename, finished-started, finished-taken))
+                self.writing = False
+                self.condition.notify_all()
+
+    def check(self):
+        """Raises the error of a failed save, if there was one."""
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def flush(self):
+        """Waits until every snapshot submitted so far has been written."""
+        with self.condition:
+            while (self.pending is not None) or self.writing:
+                self.condition.wait()
+        self.check()
+
+    def close(self):
+        """Writes anything still pending, then stops the background thread. When called while an 
+        exception is being raised (e.g. from a finally clause), a failed save is printed rather than 
+        raised, so that it does not hide that exception."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if (self.error is not None) and (sys.exc_info()[0] is not None):
+            print('A checkpoint could not be saved: %r' % self.error)
+            self.error = None
+            return
+        self.check()
@@ -0,0 +1,77 @@
+import numpy as np
+
+"""This file contains a recorder for agent trajectories. Rather than appending to Python lists at
+every step, it writes each step into a preallocated structured NumPy buffer with one row per step,
+and hands back views of the buffer that are trimmed to the steps actually taken. Every row holds
+the time at the end of the step, so the time axis of a plot is just the 'time' field and always has
+the right length."""
+
+
+ov_labels = ['Image size', 'Image expansion rate', 'Tau', 'Tau-dot', 'Proportional Rate']
+
+
+def trajectoryDtype(size):
+    """Returns the structured dtype of one step of a trajectory, for a CTRNN of size neurons."""
+    return np.dtype([('time', float), ('distance', float), ('velocity', float), ('acceleration', float),
+                     ('output', float), ('optical', float, (5,)), ('voltage', float, (size,))])
+
+
+def maxSteps(trial_length, Dt):
+    """Upper bound on the number of steps in a trial of trial_length seconds (with some slack for
+    rounding in the stop condition)."""
+    return int(np.ceil(trial_length/Dt)) + 2
+
+
+class TrajectoryRecorder():
+    """Records trajectories of ntrials trials, with up to max_steps steps each, of agents whose CTRNN has
+    size neurons. record() takes one step of an AgentEnv (for trial number trial), and recordBatch()
+    takes one step of every trial of a BatchAgentEnv, skipping trials that have already stopped. The
+    buffer is allocated once; reset() starts over without allocating anything."""
+
+    def __init__(self, size, max_steps, ntrials=1):
+        self.buffer = np.zeros((ntrials, max_steps), dtype=trajectoryDtype(size))
+        self.lengths = np.zeros(ntrials, dtype=int)    # Steps recorded so far in each trial
+
+
+    def reset(self):
+        self.lengths[:] = 0
+
+
+    def record(self, agent, trial=0):
+        """Records the current state of agent (an AgentEnv) as the next step of trial."""
+        i = self.lengths[trial]
+        if i >= self.buffer.shape[1]:
+            raise IndexError('Trajectory buffer is full (%i steps); make max_steps larger' % self.buffer.shape[1])
+        row = self.buffer[trial]
+        row['time'][i] = agent.Time
+        row['distance'][i] = agent.Distance
+        row['velocity'][i] = agent.Velocity
+        row['acceleration'][i] = agent.Acceleration
+        row['output'][i] = agent.output
+        row['optical'][i] = agent.Optical_info
+        row['voltage'][i] = agent.NN.Voltage
+        self.lengths[trial] = i + 1
+
+
+    def recordBatch(self, agent):
+        """Records the current state of every trial of agent (a BatchAgentEnv with one trial per trajectory)
+        that has taken a step since the last call."""
+        took = np.flatnonzero(agent.Steps > self.lengths)    # Trials that took the last step
+        i = self.lengths[took]
+        if np.any(i >= self.buffer.shape[1]):
+            raise IndexError('Trajectory buffer is full (%i steps); make max_steps larger' % self.buffer.shape[1])
+        buffer = self.buffer
+        buffer['time'][took, i] = agent.Time[took]    # Field views, so these write straight into the buffer
+        buffer['distance'][took, i] = agent.Distance[took]
+        buffer['velocity'][took, i] = agent.Velocity[took]
+        buffer['acceleration'][took, i] = agent.Acceleration[took]
+        buffer['output'][took, i] = agent.output[took]
+        buffer['optical'][took, i] = agent.Optical_info[:,took].T
+        buffer['voltage'][took, i] = agent.NN.Voltage[took]
+        self.lengths[took] = i + 1
+
+
+    def trajectory(self, trial=0):
+        """Returns a view of the steps recorded for trial. Its fields can be read by name, e.g.
+        trajectory['distance'] or trajectory['optical'][:,4]. Copy it if the recorder will be reused."""
+        return self.buffer[trial, :self.lengths[trial]]
@@ -0,0 +1,121 @@
+from agentEnv import BatchAgentEnv
+from trajectory import TrajectoryRecorder, trajectoryDtype, maxSteps
+from simulation import simulate, trialGrid, Trajectory
+import numpy as np
+import json
+import os
+
+"""This file contains an on-disk store of trajectories. Since the simulation is deterministic, every
+trial of every genotype in a population can be simulated once and written out, and from then on any
+trial can be read back instead of re-simulated. writeStore() saves the trajectories (rows of the
+structured dtype in trajectory.py, one trial after another) to a flat binary file, plus an index
+file that gives, for each trial, its genotype, target size, initial distance, and initial velocity,
+and where its rows start in the data file and how many there are. TrajectoryStore opens the data
+file as a read-only np.memmap, so only the pages of the trials actually looked at are read from
+disk, and nothing is ever simulated again."""
+
+
+def storeNames(filename):
+    """Returns the names of the data and index files of a store."""
+    return '%s.traj' % filename, '%s.index.npz' % filename
+
+
+def writeStore(filename, genotypes, task):
+    """Simulates every trial of the trial grid for each genotype and writes the trajectories to a store
+    called filename. task is a dictionary of the task and CTRNN parameters, with the same names as
+    taskParams() in run.py. All trials of a genotype are simulated at once (see BatchAgentEnv), and
+    each genotype is written out before the next one starts, so memory use does not grow with the
+    population."""
+    velocities, distances, sizes = trialGrid(task['target_size'], task['initial_distance'], task['initial_velocity'])
+    ntrials = len(velocities)
+    recorder = TrajectoryRecorder(task['Size'], maxSteps(task['trial_length'], task['Dt']), ntrials)
+    datafile, indexfile = storeNames(filename)
+    lengths = []
+    file_object = open(datafile, 'wb')
+    for genotype in genotypes:
+        agent = BatchAgentEnv(genotype, task['Size'], task['WeightRange'], task['BiasRange'], task['TimeConstMin'], task['TimeConstMax'],
+                              task['InputWeightRange'], task['Dt'], ntrials, task.get('Precision', 'float64'),
+                              task.get('InputWeights', 'last'))
+        simulate(agent, velocities, distances, sizes, task['optical_variable'], task['trial_length'], [Trajectory(recorder)])
+        for k in range(ntrials):
+            file_object.write(recorder.trajectory(k).tobytes())
+        lengths.extend(recorder.lengths)
+    file_object.close()
+    lengths = np.array(lengths, dtype=np.int64)
+    index = {'genotype': np.repeat(np.arange(len(genotypes)), ntrials), 'target_size': np.tile(sizes, len(genotypes)),
+             'initial_distance': np.tile(distances, len(genotypes)), 'initial_velocity': np.tile(velocities, len(genotypes)),
+             'offset': np.cumsum(lengths) - lengths, 'length': lengths}
+    metadata = {'Size': task['Size'], 'Dt': task['Dt'], 'trial_length': task['trial_length'], 'optical_variable': task['optical_variable'],
+                'genotypes': len(genotypes)}
+    np.savez(indexfile, metadata=np.array(json.dumps(metadata)), genotypes=np.asarray(genotypes, dtype=float), **index)
+
+
+class TrajectoryStore():
+    """Read-only view of a store written by writeStore(). self.index holds the index arrays (one entry
+    per trial), self.genotypes the genotypes, and self.data the memory-mapped rows of every trial."""
+
+    def __init__(self, filename):
+        self.open(filename)
+
+
+    def open(self, filename):
+        self.filename = filename
+        datafile, indexfile = storeNames(filename)
+        archive = np.load(indexfile, allow_pickle=False)
+        self.metadata = json.loads(str(archive['metadata']))
+        self.genotypes = archive['genotypes']
+        self.index = {name: archive[name] for name in archive.files if name not in ['metadata', 'genotypes']}
+        archive.close()
+        dtype = trajectoryDtype(self.metadata['Size'])
+        if os.path.getsize(datafile) == 0:    # np.memmap cannot map an empty file
+            self.data = np.zeros(0, dtype=dtype)
+        else:
+            self.data = np.memmap(datafile, dtype=dtype, mode='r')
+
+
+    def __getstate__(self):    # Pickle only the name, so that saving an analyzedData does not copy the whole file
+        return {'filename': self.filename}
+
+
+    def __setstate__(self, state):
+        self.open(state['filename'])
+
+
+    def __len__(self):
+        return len(self.index['offset'])
+
+
+    def find(self, genotype=None, target_size=None, initial_distance=None, initial_velocity=None):
+        """Returns the positions in the index of the trials that match every argument given."""
+        match = np.ones(len(self), dtype=bool)
+        for name, value in [('genotype', genotype), ('target_size', target_size), ('initial_distance', initial_distance),
+                            ('initial_velocity', initial_velocity)]:
+            if value is not None:
+                match &= (self.index[name] == value)
+        return np.flatnonzero(match)
+
+
+    def trajectory(self, position):
+        """Returns the rows of the trial at the given position in the index, as a read-only view of the
+        file (nothing is read from disk until the rows are used)."""
+        start = self.index['offset'][position]
+        return self.data[start:start+self.index['length'][position]]
+
+
+    def trial(self, genotype, target_size, initial_distance, initial_velocity):
+        """Returns the trajectory of one trial of one genotype (see trajectory())."""
+        positions = self.find(genotype, target_size, initial_distance, initial_velocity)
+        if len(positions) != 1:
+            raise KeyError('No trial (%s, %s, %s, %s) in this store' % (genotype, target_size, initial_distance, initial_velocity))
+        return self.trajectory(positions[0])
+
+
+    def final(self, field, positions=None):
+        """Returns the value of field at the last step of each trial (all of them, or those at positions),
+        reading only those rows. Trials that never took a step get nan."""
+        if positions is None:
+            positions = np.arange(len(self))
+        lengths = self.index['length'][positions]
+        last = self.index['offset'][positions] + np.maximum(lengths, 1) - 1
+        values = np.array(self.data[field][last], dtype=float) if len(self.data) else np.full(len(positions), np.nan)
+        return np.where(lengths > 0, values, np.nan)